@@ -0,0 +1,116 @@
+"""Replays group traffic with raids through the anti-flood detector
+
+Usage: python benchmarks/bench_antiflood.py [--messages N] [--rate R] [--users U ...]
+
+Each trace is N messages at R messages per second of trace time from U distinct users:
+mostly chatter, with floods from single users, copy-paste raids and join waves mixed
+in. The cost per message should stay the same however many users there are, and the
+number of tracked windows and the memory they take should stay bounded.
+"""
+import argparse
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+
+from typing import List, Tuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from tgfloofbot.models import AntiFloodConfig
+from tgfloofbot.plugins.antiflood import detector
+
+
+## (trace time, user ID, message ID, text), a None text is a join
+Event = Tuple[float, int, int, object]
+
+
+def trace(messages: int, rate: float, users: int, seed: int = 1) -> List[Event]:
+    rng = random.Random(seed)
+    events: List[Event] = list()
+    now = 0.0
+    message_id = 0
+    while len(events) < messages:
+        now += rng.expovariate(rate)
+        message_id += 1
+        roll = rng.random()
+        if roll < 0.002:
+            ## A single user flooding
+            user_id = rng.randrange(users)
+            for it in range(15):
+                events.append((now + it * 0.2, user_id, message_id, f"flood {it}"))
+                message_id += 1
+        elif roll < 0.003:
+            ## Fresh accounts pasting the same text
+            text = f"free crypto giveaway, join my channel t.me/raid{message_id}"
+            for it in range(8):
+                events.append((now + it * 0.5, users + message_id, message_id, text))
+                message_id += 1
+        elif roll < 0.00301:
+            for it in range(20):
+                events.append((now + it * 0.1, users + message_id, message_id, None))
+                message_id += 1
+        else:
+            text = f"message {rng.randrange(1_000_000)} about nothing in particular"
+            events.append((now, rng.randrange(users), message_id, text))
+    events.sort(key=lambda event: event[0])
+    return events[:messages]
+
+
+def run(events: List[Event]) -> detector.FloodDetector:
+    flood_detector = detector.FloodDetector(AntiFloodConfig())
+    message = flood_detector.message
+    join = flood_detector.join
+    for now, user_id, message_id, text in events:
+        if text is None:
+            join(now, user_id, message_id)
+        else:
+            message(now, user_id, message_id, text)  # type: ignore
+    return flood_detector
+
+
+def replay(events: List[Event]) -> dict:
+    started = time.perf_counter()
+    flood_detector = run(events)
+    elapsed = time.perf_counter() - started
+    ## Tracing slows the replay down, so memory is measured in a second one
+    tracemalloc.start()
+    run(events)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "messages_per_sec": len(events) / elapsed,
+        "us_per_message": elapsed / len(events) * 1e6,
+        "peak_kb": peak / 1024,
+        **flood_detector.stats(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--rate", type=float, default=2000.0)
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parsed = parser.parse_args()
+
+    print(
+        f"{'users':>9} {'msgs/s':>9} {'us/msg':>7} {'peak KB':>8} {'tracked':>8} "
+        f"{'floods':>7} {'repeats':>8} {'joins':>6} {'evicted':>8}"
+    )
+    for users in parsed.users:
+        result = replay(trace(parsed.messages, parsed.rate, users))
+        print(
+            f"{users:>9} {result['messages_per_sec']:>9.0f} "
+            f"{result['us_per_message']:>7.2f} {result['peak_kb']:>8.0f} "
+            f"{result['flood_tracked'] + result['repeat_tracked']:>8} "
+            f"{result['flood_detections']:>7} {result['repeat_detections']:>8} "
+            f"{result['join_detections']:>6} "
+            f"{result['flood_evicted'] + result['repeat_evicted']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compares the compiled argument parsers with the previous shlex + argparse + pydantic path
+
+Usage: python benchmarks/bench_argument_parsing.py [--iterations N]
+
+Before timing, every sample is run through both paths to check that they produce the
+same arguments or the same error message.
+"""
+import argparse
+import pathlib
+import shlex
+import sys
+import timeit
+import typing
+
+from typing import Optional, Union
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import pydantic
+
+from tgfloofbot import loader
+from tgfloofbot.plugins.administration import commands
+from tgfloofbot.plugins.extra import commands
+
+
+class HelpCommandArgs(pydantic.BaseModel):
+    command: Optional[str] = pydantic.Field(None, description="Name of the command")
+
+
+SAMPLES = {
+    "warn": [
+        " 123456789 spamming",
+        ' 123456789 "posting the same link over and over"',
+        " 123456789",
+        " 123456789 too many words",
+    ],
+    "note": [" 123456789 'keeps arguing with mods'", " 42 ok"],
+    "id": ["", " 123456789", " @someone extra"],
+    "help": ["", " warn", " warn extra"],
+}
+
+
+class LegacyArgParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise SyntaxError(message)
+
+
+def legacy_parser(parse: pydantic.BaseModel):
+    """Rebuilds the argparse parser the loader used to create for a model"""
+    parser = LegacyArgParser()
+    for argument_name, argument_data in parse.schema()["properties"].items():
+        argument_type = loader.ARGUMENT_TYPES[argument_data.get("type")]
+        argument_hint = typing.get_type_hints(parse)[argument_name]
+        is_optional = "default" in argument_data or (
+            typing.get_origin(argument_hint) is Union
+            and type(None) in typing.get_args(argument_hint)
+        )
+        parser.add_argument(
+            argument_name,
+            type=argument_type,
+            default=argument_data.get("default"),
+            nargs="?" if is_optional else None,
+        )
+
+    def parse_legacy(text: str) -> pydantic.BaseModel:
+        return parse(**vars(parser.parse_args(shlex.split(text))))
+
+    return parse_legacy
+
+
+def outcome(function, text: str) -> str:
+    try:
+        return repr(function(text).dict())
+    except Exception as err:
+        return f"error: {err}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20_000)
+    parsed = parser.parse_args()
+
+    compiled = {name: loader.commands[name].parse for name in ("warn", "note", "id")}
+    compiled["help"] = HelpCommandArgs
+
+    print(f"{'command':>8} {'legacy us':>10} {'compiled us':>12} {'speedup':>8}")
+    for name, model in compiled.items():
+        legacy = legacy_parser(model)
+        fast = loader.build_argument_parser(model).parse
+        for text in SAMPLES[name]:
+            expected, actual = outcome(legacy, text), outcome(fast, text)
+            if expected != actual:
+                raise SystemExit(f"/{name}{text!r}: {expected} != {actual}")
+
+        def run_all(function):
+            for text in SAMPLES[name]:
+                try:
+                    function(text)
+                except Exception:
+                    pass
+
+        legacy_time = timeit.timeit(lambda: run_all(legacy), number=parsed.iterations)
+        fast_time = timeit.timeit(lambda: run_all(fast), number=parsed.iterations)
+        calls = parsed.iterations * len(SAMPLES[name])
+        print(
+            f"{name:>8} {legacy_time / calls * 1e6:>10.2f} "
+            f"{fast_time / calls * 1e6:>12.2f} {legacy_time / fast_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
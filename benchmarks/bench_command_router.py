@@ -0,0 +1,100 @@
+"""Compares routing one update through a CommandHandler per command with the CommandRouter
+
+Usage: python benchmarks/bench_command_router.py [--iterations N]
+"""
+import argparse
+import pathlib
+import sys
+import time
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import telegram
+import telegram.ext
+
+from tgfloofbot import models
+from tgfloofbot.router import CommandRouter
+
+
+def make_bot() -> telegram.Bot:
+    bot = telegram.Bot("123:benchmark")
+    bot._bot = telegram.User(1, "bench", True, username="benchbot")
+    return bot
+
+
+def make_update(bot: telegram.Bot, text: str) -> telegram.Update:
+    entities = []
+    if text.startswith("/"):
+        entities.append(
+            {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+        )
+    return telegram.Update.de_json(
+        {
+            "update_id": 1,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": -100, "type": "supergroup"},
+                "from": {"id": 2, "is_bot": False, "first_name": "bench"},
+                "text": text,
+                "entities": entities,
+            },
+        },
+        bot,
+    )
+
+
+def route_handler_chain(handlers, update) -> None:
+    """Mirrors Dispatcher.process_update scanning one handler group"""
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20_000)
+    parsed = parser.parse_args()
+
+    bot = make_bot()
+    callback = lambda update, context: None
+    print(
+        f"{'commands':>8} {'update':>10} {'chain us':>10} {'router us':>10} {'speedup':>8}"
+    )
+    for command_count in (5, 25, 100, 400):
+        names = [f"command{it}" for it in range(command_count)]
+        handlers = [telegram.ext.CommandHandler(name, callback) for name in names]
+        routes = {
+            name: models.CommandData(
+                function=callback,
+                name=name,
+                parse=None,
+                help_data=None,
+                callback=callback,
+            )
+            for name in names
+        }
+        router = CommandRouter(routes)
+        updates = {
+            "last cmd": make_update(bot, f"/{names[-1]} some args"),
+            "chatter": make_update(bot, "just chatting in the group"),
+        }
+        for label, update in updates.items():
+            chain = timeit.timeit(
+                lambda: route_handler_chain(handlers, update), number=parsed.iterations
+            )
+            routed = timeit.timeit(
+                lambda: router.check_update(update), number=parsed.iterations
+            )
+            chain_us = chain / parsed.iterations * 1e6
+            routed_us = routed / parsed.iterations * 1e6
+            print(
+                f"{command_count:>8} {label:>10} {chain_us:>10.2f} "
+                f"{routed_us:>10.2f} {chain_us / routed_us:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
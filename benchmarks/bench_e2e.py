@@ -0,0 +1,300 @@
+"""End-to-end throughput benchmark against a local fake Bot API
+
+Usage: python benchmarks/bench_e2e.py [--updates N] [--scenario NAME]
+                                      [--json PATH] [--baseline PATH]
+
+The bot runs unmodified with its Updater pointed at fake_telegram.FakeTelegram and
+long-polls replayed synthetic update streams. Each scenario runs in its own process
+and reports updates/sec, p50/p99 handler latency (from the bot's own histograms) and
+the Bot API calls made per update. With --baseline, the run fails if throughput drops
+or API calls per update grow by more than --tolerance compared to an earlier --json.
+"""
+import argparse
+import itertools
+import json
+import pathlib
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterator, List
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from fake_telegram import (
+    FakeTelegram,
+    TOKEN,
+    UNLIMITED_OUTBOUND,
+    message_update,
+    run_worker,
+    user,
+)
+
+
+MAIN_GROUP = -1001
+ADMIN_GROUP = -1002
+ADMINS = (42, 43)
+CHATS = [MAIN_GROUP] + [-2000 - it for it in range(49)]
+## Calls made by the polling loop itself, which are not caused by updates
+POLLING_METHODS = {"getUpdates", "getMe", "deleteWebhook"}
+
+## Positional callback data of the help menu's "Next" button
+HELP_NEXT_BUTTON = 'help_menu_page;"n"'
+
+
+def callback_update(update_id: int, chat_id: int, user_id: int, data: str) -> Dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user(user_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "Benchmark"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Floofbot"},
+                "text": "Commands list: page 1/2\n/groupid: Shows the group's ID number",
+            },
+        },
+    }
+
+
+def commands(update_ids: Iterator[int], rng: random.Random) -> Dict:
+    text = rng.choice(["/ping", "/id", "/groupid", "/help", "/help warn", "/id 7"])
+    return message_update(
+        next(update_ids), rng.choice(CHATS), rng.randrange(100, 10_000), text
+    )
+
+
+def help_buttons(update_ids: Iterator[int], rng: random.Random) -> Dict:
+    return callback_update(
+        next(update_ids),
+        rng.choice(CHATS),
+        rng.randrange(100, 10_000),
+        HELP_NEXT_BUTTON,
+    )
+
+
+def warn_burst(update_ids: Iterator[int], rng: random.Random) -> Dict:
+    target = rng.randrange(100, 10_000)
+    text = rng.choice([f"/warn {target} spamming", f"/note {target} keeps arguing"])
+    update = message_update(next(update_ids), MAIN_GROUP, rng.choice(ADMINS), text)
+    update["message"]["from"]["username"] = "moderator"
+    return update
+
+
+def chatter(update_ids: Iterator[int], rng: random.Random) -> Dict:
+    return message_update(
+        next(update_ids),
+        rng.choice(CHATS),
+        rng.randrange(100, 10_000),
+        rng.choice(["hello", "how is everyone", "nice", "lol", "good morning"]),
+    )
+
+
+def mixed(update_ids: Iterator[int], rng: random.Random) -> Dict:
+    generator = rng.choices(
+        [chatter, commands, help_buttons, warn_burst], weights=[70, 15, 10, 5]
+    )[0]
+    return generator(update_ids, rng)
+
+
+SCENARIOS: Dict[str, Callable[[Iterator[int], random.Random], Dict]] = {
+    "commands": commands,
+    "help_buttons": help_buttons,
+    "warn_burst": warn_burst,
+    "chatter": chatter,
+    "mixed": mixed,
+}
+
+
+def merged_quantiles(bot_metrics: Any, baseline: Dict) -> Dict[str, float]:
+    """p50/p99 of the total handler time of every handler, minus the warmup"""
+    from tgfloofbot import metrics
+
+    merged = metrics.Histogram(bot_metrics.buckets)
+    histograms, _ = bot_metrics.snapshot()
+    for (metric, labels), histogram in histograms.items():
+        if metric != metrics.HANDLER_SECONDS or labels[2] != "total":
+            continue
+        before = baseline.get((metric, labels))
+        for index, count in enumerate(histogram.counts):
+            merged.counts[index] += count - (before.counts[index] if before else 0)
+        merged.count += histogram.count - (before.count if before else 0)
+    return {
+        "handled": merged.count,
+        "p50_ms": merged.quantile(0.5) * 1000,
+        "p99_ms": merged.quantile(0.99) * 1000,
+    }
+
+
+def wait_until_idle(fake: FakeTelegram, bot_client: Any, timeout: float) -> float:
+    """Waits until every queued update was fetched and fully handled
+
+    Returns the perf_counter() time at which the bot was first seen idle.
+    """
+    deadline = time.monotonic() + timeout
+    idle_since = None
+    while time.monotonic() < deadline:
+        with fake.lock:
+            fetched = not fake.pending_updates or (
+                fake.pending_updates[-1]["update_id"]
+                < bot_client.updater.last_update_id
+            )
+        busy = (
+            not fetched
+            or bot_client.dispatcher.update_queue.qsize()
+            or (bot_client.workers and bot_client.workers.backlog)
+            or bot_client.outbound.depth
+            or bot_client.outbound.in_flight
+        )
+        if busy:
+            idle_since = None
+        elif idle_since is None:
+            idle_since = time.perf_counter()
+        elif time.perf_counter() - idle_since > 0.05:
+            return idle_since
+        time.sleep(0.002)
+    raise TimeoutError("The bot did not finish handling the updates in time")
+
+
+def run_scenario(name: str, update_count: int, seed: int) -> Dict[str, Any]:
+    from tgfloofbot import models
+    from tgfloofbot.client import TGFloofbotClient
+
+    fake = FakeTelegram(admins=ADMINS).start()
+    workdir = pathlib.Path(tempfile.mkdtemp())
+    config = models.Config(
+        token=TOKEN,
+        base_url=fake.base_url,
+        database=workdir / "bench.db",
+        main_group=MAIN_GROUP,
+        admin_groups=[ADMIN_GROUP],
+        log={"filename": workdir / "bench.log"},
+        outbound=UNLIMITED_OUTBOUND,
+    )
+    bot_client = TGFloofbotClient(config)
+    rng = random.Random(seed)
+    update_ids = itertools.count(1)
+    generator = SCENARIOS[name]
+    result: Dict[str, Any] = dict()
+
+    def drive() -> None:
+        try:
+            ## Warm up so lazy plugin imports and cold caches are not measured
+            fake.queue_updates([mixed(update_ids, rng) for _ in range(200)])
+            wait_until_idle(fake, bot_client, 60)
+            calls_before = dict(fake.calls)
+            histograms_before, _ = bot_client.metrics.snapshot()
+
+            updates = [generator(update_ids, rng) for _ in range(update_count)]
+            started = time.perf_counter()
+            fake.queue_updates(updates)
+            elapsed = wait_until_idle(fake, bot_client, 300) - started
+
+            api_calls = {
+                method: count - calls_before.get(method, 0)
+                for method, count in fake.calls.items()
+                if method not in POLLING_METHODS and count - calls_before.get(method, 0)
+            }
+            result.update(
+                scenario=name,
+                updates=update_count,
+                updates_per_sec=update_count / elapsed,
+                api_calls_per_update=sum(api_calls.values()) / update_count,
+                api_calls=api_calls,
+                **merged_quantiles(bot_client.metrics, histograms_before),
+            )
+        finally:
+            fake.interrupt_polling()
+            bot_client.stop()
+
+    threading.Thread(target=drive, daemon=True).start()
+    bot_client.run()
+    fake.stop()
+    return result
+
+
+def regressions(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float
+) -> List[str]:
+    previous = {result["scenario"]: result for result in baseline}
+    found = list()
+    for result in results:
+        before = previous.get(result["scenario"])
+        if before is None:
+            continue
+        if result["updates_per_sec"] < before["updates_per_sec"] * (1 - tolerance):
+            found.append(
+                f"{result['scenario']}: {result['updates_per_sec']:.0f} updates/s, "
+                f"was {before['updates_per_sec']:.0f}"
+            )
+        if result["api_calls_per_update"] > before["api_calls_per_update"] * (
+            1 + tolerance
+        ):
+            found.append(
+                f"{result['scenario']}: {result['api_calls_per_update']:.2f} API "
+                f"calls per update, was {before['api_calls_per_update']:.2f}"
+            )
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--scenario", choices=tuple(SCENARIOS), action="append")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", type=pathlib.Path, help="Write the results here")
+    parser.add_argument(
+        "--baseline", type=pathlib.Path, help="Results of an earlier --json run"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+
+    if parsed.worker:
+        result = run_scenario(parsed.scenario[0], parsed.updates, parsed.seed)
+        print(json.dumps(result), flush=True)
+        return
+
+    results = list()
+    print(
+        f"{'scenario':>12} {'updates/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'API calls/update':>17}"
+    )
+    for scenario in parsed.scenario or SCENARIOS:
+        result = run_worker(
+            __file__,
+            "--worker",
+            "--scenario",
+            scenario,
+            "--updates",
+            str(parsed.updates),
+            "--seed",
+            str(parsed.seed),
+        )
+        results.append(result)
+        print(
+            f"{scenario:>12} {result['updates_per_sec']:>10.0f} "
+            f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+            f"{result['api_calls_per_update']:>17.2f}"
+        )
+
+    if parsed.json:
+        parsed.json.write_text(json.dumps(results, indent=2))
+    if parsed.baseline:
+        found = regressions(
+            results, json.loads(parsed.baseline.read_text()), parsed.tolerance
+        )
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
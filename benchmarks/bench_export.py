@@ -0,0 +1,131 @@
+"""Measures streaming exports of the moderation records and their peak memory
+
+Usage: python benchmarks/bench_export.py [--rows N] [--format csv jsonl]
+
+Fills a temporary database with N records, then exports a tenth of them and all of
+them in every format, with and without gzip, each in its own process. Exports stream
+through a server side cursor, so the peak RSS should be the same for both sizes.
+"""
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+
+STARTED = datetime.datetime(2020, 1, 1)
+
+
+def fill(database: pathlib.Path, rows: int) -> None:
+    import sqlalchemy
+
+    from tgfloofbot.plugins.administration import models
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{database}")
+    models.Warning.__table__.create(engine)
+    engine.dispose()
+    connection = sqlite3.connect(database)
+    connection.executemany(
+        "INSERT INTO tg_warnings (id, user_id, date_added, forgiven, forgiven_by, "
+        "forgiven_by_id, warned_by, warned_by_id, reason, is_usernote) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            (
+                it + 1,
+                100 + it % 5000,
+                (STARTED + datetime.timedelta(seconds=it)).isoformat(
+                    " ", "microseconds"
+                ),
+                it % 7 == 0,
+                "moderator" if it % 7 == 0 else None,
+                42 if it % 7 == 0 else None,
+                "moderator",
+                42,
+                f"Spamming links in the group, record {it}",
+                it % 3 == 0,
+            )
+            for it in range(rows)
+        ),
+    )
+    connection.commit()
+    connection.close()
+
+
+def run_export(database: pathlib.Path, rows: int, fmt: str, compress: bool) -> dict:
+    import sqlalchemy
+    import sqlalchemy.orm
+
+    from tgfloofbot.plugins.administration import export
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    engine = sqlalchemy.create_engine(f"sqlite:///{database}")
+    db = sqlalchemy.orm.Session(bind=engine)
+    filters = export.ExportFilter(until=STARTED + datetime.timedelta(seconds=rows))
+    started = time.perf_counter()
+    with open(os.devnull, "wb") as output:
+        count = export.write_records(
+            export.iter_records(db, filters), output, fmt, compress
+        )
+    elapsed = time.perf_counter() - started
+    db.close()
+    return {
+        "rows": count,
+        "rows_per_sec": count / elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "growth_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+        / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--format", nargs="+", default=["csv", "jsonl"])
+    parser.add_argument("--database", type=pathlib.Path, help=argparse.SUPPRESS)
+    parser.add_argument("--gzip", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+
+    if parsed.worker:
+        result = run_export(parsed.database, parsed.rows, parsed.format[0], parsed.gzip)
+        print(json.dumps(result), flush=True)
+        return
+
+    database = pathlib.Path(tempfile.mkdtemp()) / "export.db"
+    started = time.perf_counter()
+    fill(database, parsed.rows)
+    print(f"Filled {parsed.rows} records in {time.perf_counter() - started:.1f}s")
+    print(
+        f"{'format':>8} {'rows':>9} {'rows/s':>9} {'peak RSS MB':>12} "
+        f"{'growth MB':>10}"
+    )
+    for fmt in parsed.format:
+        for compress in (False, True):
+            for rows in (parsed.rows // 10, parsed.rows):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--worker", "--format", fmt]
+                    + ["--rows", str(rows), "--database", str(database)]
+                    + (["--gzip"] if compress else []),
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+                result = json.loads(output.splitlines()[-1])
+                label = f"{fmt}.gz" if compress else fmt
+                print(
+                    f"{label:>8} {result['rows']:>9} {result['rows_per_sec']:>9.0f} "
+                    f"{result['peak_rss_mb']:>12.1f} {result['growth_mb']:>10.1f}"
+                )
+    database.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Compares update latency and throughput of polling and webhook ingestion
+
+Usage: python benchmarks/bench_ingest.py [--updates N] [--posters N]
+
+Each mode runs the bot in its own process against a fake Bot API server. Every
+synthetic update is a /ping from a distinct chat, and latency is measured from the
+moment the update is handed to Telegram's side until the bot's reply arrives.
+"""
+import argparse
+import json
+import pathlib
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from fake_telegram import (
+    FakeTelegram,
+    TOKEN,
+    UNLIMITED_OUTBOUND,
+    WebhookPoster,
+    message_update,
+    run_worker,
+)
+
+
+SECRET = "benchmark-secret"
+
+
+def run_mode(mode: str, update_count: int, posters: int) -> None:
+    from tgfloofbot import models
+    from tgfloofbot.client import TGFloofbotClient
+
+    fake = FakeTelegram().start()
+    sent_at = dict()
+    latencies = list()
+    done = threading.Event()
+
+    def on_call(method, data):
+        if method == "sendMessage":
+            chat_id = int(data["chat_id"])
+            if chat_id in sent_at:
+                latencies.append(time.perf_counter() - sent_at[chat_id])
+                if len(latencies) == update_count:
+                    done.set()
+
+    fake.hooks.append(on_call)
+    workdir = pathlib.Path(tempfile.mkdtemp())
+    config = models.Config(
+        token=TOKEN,
+        base_url=fake.base_url,
+        database=workdir / "bench.db",
+        main_group=-1,
+        log={"filename": workdir / "bench.log"},
+        ingest=mode,
+        outbound=UNLIMITED_OUTBOUND,
+        webhook={
+            "url": "https://example.invalid/telegram",
+            "port": 0,
+            "secret_token": SECRET,
+        },
+    )
+    bot_client = TGFloofbotClient(config)
+    updates = [
+        message_update(it + 1, -1000 - it, 10 + it, "/ping")
+        for it in range(update_count)
+    ]
+
+    def drive() -> None:
+        time.sleep(0.5)
+        started = time.perf_counter()
+        if mode == "polling":
+            for update in updates:
+                sent_at[update["message"]["chat"]["id"]] = time.perf_counter()
+            fake.queue_updates(updates)
+        else:
+            pending: queue.Queue = queue.Queue()
+            for update in updates:
+                pending.put(update)
+            port = bot_client.webhook.server_address[1]
+
+            def post_all() -> None:
+                poster = WebhookPoster("127.0.0.1", port, config.webhook.path, SECRET)
+                while True:
+                    try:
+                        update = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    sent_at[update["message"]["chat"]["id"]] = time.perf_counter()
+                    while poster.post(update) == 503:
+                        time.sleep(0.01)
+
+            threads = [threading.Thread(target=post_all) for _ in range(posters)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        done.wait(120)
+        elapsed = time.perf_counter() - started
+        ordered = sorted(latencies)
+        print(
+            json.dumps(
+                {
+                    "mode": mode,
+                    "updates": len(latencies),
+                    "updates_per_sec": len(latencies) / elapsed,
+                    "p50_ms": statistics.median(ordered) * 1000,
+                    "p99_ms": ordered[int(len(ordered) * 0.99) - 1] * 1000,
+                }
+            ),
+            flush=True,
+        )
+        bot_client.stop()
+
+    threading.Thread(target=drive, daemon=True).start()
+    bot_client.run()
+    fake.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--posters", type=int, default=8)
+    parser.add_argument("--mode", choices=("polling", "webhook"))
+    parsed = parser.parse_args()
+
+    if parsed.mode:
+        run_mode(parsed.mode, parsed.updates, parsed.posters)
+        return
+
+    print(f"{'mode':>8} {'updates/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode in ("polling", "webhook"):
+        result = run_worker(
+            __file__,
+            "--mode",
+            mode,
+            "--updates",
+            str(parsed.updates),
+            "--posters",
+            str(parsed.posters),
+        )
+        print(
+            f"{mode:>8} {result['updates_per_sec']:>10.0f} "
+            f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Measures the per-update overhead of logging with debug output on and off
+
+Usage: python benchmarks/bench_logging.py [--updates N]
+
+Each configuration runs in its own process, dispatching a no-op command update through
+the bot's dispatcher with the worker pool disabled, so the measured time is spent on
+the dispatcher thread. Logging goes to a log file and to stdout, which is a pipe.
+"""
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from fake_telegram import TOKEN, message_update, run_worker
+
+
+CONFIGURATIONS = {
+    "debug off, queued": dict(debug=False, log_queue=True),
+    "debug off, direct": dict(debug=False, log_queue=False),
+    "debug on, queued": dict(debug=True, log_queue=True),
+    "debug on, direct": dict(debug=True, log_queue=False),
+}
+
+
+def run_configuration(name: str, update_count: int) -> None:
+    import telegram
+
+    from tgfloofbot import loader, models
+    from tgfloofbot.client import TGFloofbotClient
+    from tgfloofbot.logger import setup_logging
+
+    @loader.command(name="noop", requires_user=True)
+    def noop(client, update, context):
+        pass
+
+    workdir = pathlib.Path(tempfile.mkdtemp())
+    config = models.Config(
+        token=TOKEN,
+        database=workdir / "bench.db",
+        main_group=-1,
+        log={"filename": workdir / "bench.log"},
+        worker_pool={"workers": 0},
+        **CONFIGURATIONS[name],
+    )
+    listener = setup_logging(config)
+    bot_client = TGFloofbotClient(config)
+    bot = bot_client.updater.bot
+    updates = [
+        telegram.Update.de_json(message_update(it + 1, -1, 10, "/noop"), bot)
+        for it in range(update_count)
+    ]
+
+    started = time.perf_counter()
+    for update in updates:
+        bot_client.dispatcher.process_update(update)
+    elapsed = time.perf_counter() - started
+    if listener:
+        listener.stop()
+    drained = time.perf_counter() - started
+    print(
+        json.dumps(
+            {
+                "name": name,
+                "us_per_update": elapsed / update_count * 1e6,
+                "drained_s": drained,
+            }
+        ),
+        flush=True,
+    )
+    bot_client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--configuration", choices=tuple(CONFIGURATIONS))
+    parsed = parser.parse_args()
+
+    if parsed.configuration:
+        run_configuration(parsed.configuration, parsed.updates)
+        return
+
+    print(f"{'configuration':>18} {'us/update':>10} {'until flushed s':>16}")
+    for name in CONFIGURATIONS:
+        result = run_worker(
+            __file__, "--configuration", name, "--updates", str(parsed.updates)
+        )
+        print(
+            f"{name:>18} {result['us_per_update']:>10.1f} "
+            f"{result['drained_s']:>16.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Measures the overhead the metrics add to each command and Bot API call
+
+Usage: python benchmarks/bench_metrics.py [--iterations N]
+"""
+import argparse
+import pathlib
+import sys
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import telegram
+
+from fake_telegram import TOKEN
+from tgfloofbot import metrics
+
+
+def command_overhead(bot_metrics: metrics.Metrics, iterations: int) -> float:
+    def instrumented() -> None:
+        with metrics.command_scope("warn"), bot_metrics.timer(
+            "command", "warn"
+        ) as timer:
+            with timer.phase("parse"):
+                pass
+            with timer.phase("handler"):
+                pass
+
+    return timeit.timeit(instrumented, number=iterations) / iterations
+
+
+def api_call_overhead(bot_metrics: metrics.Metrics, iterations: int) -> float:
+    bot = telegram.Bot(TOKEN)
+    bot._post = lambda endpoint, *args, **kwargs: None
+    bare = timeit.timeit(lambda: bot._post("sendMessage"), number=iterations)
+    bot_metrics.instrument_bot(bot)
+    instrumented = timeit.timeit(lambda: bot._post("sendMessage"), number=iterations)
+    return (instrumented - bare) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200_000)
+    parsed = parser.parse_args()
+
+    bot_metrics = metrics.Metrics()
+    per_command = command_overhead(bot_metrics, parsed.iterations)
+    per_api_call = api_call_overhead(bot_metrics, parsed.iterations)
+    print(
+        f"per command (scope, total, parse and handler timers): {per_command * 1e6:.2f} us"
+    )
+    print(
+        f"per Bot API call (counter and latency histogram):     {per_api_call * 1e6:.2f} us"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Sends a burst of messages through the outbound queue to a Bot API that enforces limits
+
+Usage: python benchmarks/bench_outbound.py [--chats N] [--messages N]
+
+The fake Bot API answers 429 with retry_after whenever a chat receives more than one
+message per second or the bot sends more than 30 messages per second, like Telegram
+does. The same burst is sent once directly and once through the OutboundQueue.
+"""
+import argparse
+import collections
+import pathlib
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import telegram
+
+from fake_telegram import FakeTelegram, TOKEN
+from tgfloofbot import outbound
+
+
+class RateLimitEnforcer:
+    """Fake Bot API hook that rejects sends beyond Telegram's documented limits"""
+
+    def __init__(self, per_chat_interval: float = 1.0, global_rate: int = 30):
+        self.per_chat_interval = per_chat_interval
+        self.global_rate = global_rate
+        self.last_send = dict()
+        self.recent = collections.deque()
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def __call__(self, method, data):
+        if method != "sendMessage":
+            return None
+        now = time.monotonic()
+        chat_id = data["chat_id"]
+        with self.lock:
+            while self.recent and now - self.recent[0] > 1.0:
+                self.recent.popleft()
+            last = self.last_send.get(chat_id)
+            if (last is not None and now - last < self.per_chat_interval) or len(
+                self.recent
+            ) >= self.global_rate:
+                self.rejected += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }
+            self.last_send[chat_id] = now
+            self.recent.append(now)
+        return None
+
+
+def burst(chats: int, messages: int):
+    for message in range(messages):
+        for chat in range(chats):
+            priority = (
+                outbound.PRIORITY_MODERATION
+                if message % 3 == 0
+                else outbound.PRIORITY_COSMETIC
+            )
+            yield -1000 - chat, f"message {message}", priority
+
+
+def run_direct(bot: telegram.Bot, chats: int, messages: int) -> None:
+    failures = 0
+    started = time.perf_counter()
+    for chat_id, text, _ in burst(chats, messages):
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+        except telegram.error.RetryAfter:
+            failures += 1
+    elapsed = time.perf_counter() - started
+    total = chats * messages
+    print(
+        f"direct: {total - failures}/{total} delivered, "
+        f"{failures} RetryAfter errors surfaced, {elapsed:.1f}s"
+    )
+
+
+def run_queued(bot: telegram.Bot, chats: int, messages: int) -> None:
+    queue = outbound.OutboundQueue(bot, per_chat_burst=1.0)
+    queue.start()
+    started = time.perf_counter()
+    latencies = collections.defaultdict(list)
+    futures = list()
+    for chat_id, text, priority in burst(chats, messages):
+        submitted = time.perf_counter()
+        future = queue.send_message(chat_id, text, priority=priority)
+        future.add_done_callback(
+            lambda _, priority=priority, submitted=submitted: latencies[
+                priority
+            ].append(time.perf_counter() - submitted)
+        )
+        futures.append(future)
+
+    max_depth = 0
+    while not all(future.done() for future in futures):
+        max_depth = max(max_depth, queue.depth)
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    stats = queue.stats()
+    queue.stop()
+    failed = sum(1 for future in futures if future.exception())
+    print(
+        f"queued: {len(futures) - failed}/{len(futures)} delivered, "
+        f"{stats['rate_limited']} 429s absorbed, {stats['retried']} retries, "
+        f"max depth {max_depth}, {elapsed:.1f}s"
+    )
+    for priority, values in sorted(latencies.items()):
+        print(
+            f"  {outbound.PRIORITY_NAMES[priority]:>10}: "
+            f"p50 {statistics.median(values):.2f}s, max {max(values):.2f}s"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=40)
+    parser.add_argument("--messages", type=int, default=3)
+    parsed = parser.parse_args()
+
+    for runner in (run_direct, run_queued):
+        fake = FakeTelegram().start()
+        enforcer = RateLimitEnforcer()
+        fake.hooks.append(enforcer)
+        bot = telegram.Bot(TOKEN, base_url=fake.base_url)
+        runner(bot, parsed.chats, parsed.messages)
+        print(f"  Bot API rejected {enforcer.rejected} sends")
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
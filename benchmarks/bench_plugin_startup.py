@@ -0,0 +1,112 @@
+"""Compares bot startup with lazily and eagerly imported plugins
+
+Usage: python benchmarks/bench_plugin_startup.py [--plugins N]
+
+Generates N external plugins, each with a manifest, an argument model and a few
+commands, then starts the bot client against them in a fresh process with lazy
+loading on and off, reporting the startup time and the peak resident memory.
+"""
+import argparse
+import json
+import pathlib
+import resource
+import sys
+import tempfile
+import textwrap
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from fake_telegram import TOKEN, run_worker
+
+
+COMMANDS_PER_PLUGIN = 4
+
+
+def generate_plugins(directory: pathlib.Path, count: int) -> None:
+    for index in range(count):
+        plugin_directory = directory / f"generated{index}"
+        plugin_directory.mkdir()
+        (plugin_directory / "__init__.py").write_text("from . import commands\n")
+        commands = [f"cmd{index}x{it}" for it in range(COMMANDS_PER_PLUGIN)]
+        manifest = "commands:\n" + "".join(
+            f"  - name: {name}\n    help: Generated command\n" for name in commands
+        )
+        (plugin_directory / "plugin.yaml").write_text(manifest)
+        source = textwrap.dedent(
+            """\
+            import pydantic
+
+            from tgfloofbot import loader
+
+
+            class Args(pydantic.BaseModel):
+                user: int = pydantic.Field(..., description="A raw user ID")
+                reason: str = pydantic.Field("", description="Reason")
+
+            """
+        )
+        for name in commands:
+            source += textwrap.dedent(
+                f"""
+                @loader.command(help="Generated command")
+                def {name}(client, update, context, args: Args):
+                    pass
+                """
+            )
+        (plugin_directory / "commands.py").write_text(source)
+
+
+def run_startup(plugin_directory: str, lazy: bool) -> None:
+    from tgfloofbot import models
+    from tgfloofbot.client import TGFloofbotClient
+
+    workdir = pathlib.Path(tempfile.mkdtemp())
+    config = models.Config(
+        token=TOKEN,
+        database=workdir / "bench.db",
+        main_group=-1,
+        log={"filename": workdir / "bench.log"},
+        plugins={"directories": [plugin_directory], "lazy": lazy},
+    )
+    started = time.perf_counter()
+    bot_client = TGFloofbotClient(config)
+    elapsed = time.perf_counter() - started
+    print(
+        json.dumps(
+            {
+                "startup_ms": elapsed * 1000,
+                "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 1024,
+            }
+        ),
+        flush=True,
+    )
+    bot_client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plugins", type=int, default=200)
+    parser.add_argument("--directory")
+    parser.add_argument("--lazy", choices=("yes", "no"))
+    parsed = parser.parse_args()
+
+    if parsed.directory:
+        run_startup(parsed.directory, parsed.lazy == "yes")
+        return
+
+    directory = pathlib.Path(tempfile.mkdtemp())
+    generate_plugins(directory, parsed.plugins)
+    print(f"{parsed.plugins} plugins, {parsed.plugins * COMMANDS_PER_PLUGIN} commands")
+    print(f"{'loading':>8} {'startup ms':>11} {'max RSS MiB':>12}")
+    for lazy in ("yes", "no"):
+        result = run_worker(__file__, "--directory", str(directory), "--lazy", lazy)
+        print(
+            f"{'lazy' if lazy == 'yes' else 'eager':>8} "
+            f"{result['startup_ms']:>11.0f} {result['max_rss_mib']:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Measures command throughput with updates sharded across worker processes
+
+Usage: python benchmarks/bench_sharding.py [--updates N] [--shards 0 1 2 4]
+
+The bot polls a fake Bot API server and, for every shard count, handles a stream of
+commands spread over many chats. Every command answers with exactly one message, so
+the run ends once every reply has arrived. 0 shards handles everything in the ingest
+process, as without sharding. Throughput can only scale up to the number of cores.
+"""
+import argparse
+import itertools
+import json
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from fake_telegram import (
+    FakeTelegram,
+    TOKEN,
+    UNLIMITED_OUTBOUND,
+    message_update,
+    run_worker,
+)
+
+
+CHATS = [-5000 - it for it in range(64)]
+## Commands that answer with exactly one message and make no other Bot API calls
+COMMANDS = ["/id", "/groupid", "/help", "/help warn", "/help warnings"]
+
+
+def run_shards(shards: int, update_count: int, seed: int) -> None:
+    from tgfloofbot import models
+    from tgfloofbot.client import TGFloofbotClient
+
+    fake = FakeTelegram().start()
+    replies = itertools.count(1)
+    expected = [0]
+    done = threading.Event()
+
+    def on_call(method, data):
+        if method == "sendMessage" and next(replies) >= expected[0]:
+            done.set()
+
+    fake.hooks.append(on_call)
+    workdir = pathlib.Path(tempfile.mkdtemp())
+    config = models.Config(
+        token=TOKEN,
+        base_url=fake.base_url,
+        database=workdir / "bench.db",
+        main_group=-1,
+        log={"filename": workdir / "bench.log"},
+        sharding={"shards": shards},
+        outbound=UNLIMITED_OUTBOUND,
+    )
+    bot_client = TGFloofbotClient(config)
+    rng = random.Random(seed)
+    update_ids = itertools.count(1)
+
+    def batch(count: int):
+        return [
+            message_update(
+                next(update_ids),
+                rng.choice(CHATS),
+                rng.randrange(100, 10_000),
+                rng.choice(COMMANDS),
+            )
+            for _ in range(count)
+        ]
+
+    def drive() -> None:
+        try:
+            ## Warm up every shard, so process startup and lazy imports are not measured
+            warmup = batch(len(CHATS) * 4)
+            expected[0] = len(warmup)
+            fake.queue_updates(warmup)
+            if not done.wait(120):
+                raise TimeoutError("The warmup replies did not arrive in time")
+
+            done.clear()
+            updates = batch(update_count)
+            expected[0] += update_count
+            started = time.perf_counter()
+            fake.queue_updates(updates)
+            if not done.wait(300):
+                raise TimeoutError("The replies did not arrive in time")
+            elapsed = time.perf_counter() - started
+            print(
+                json.dumps(
+                    {
+                        "shards": shards,
+                        "updates": update_count,
+                        "updates_per_sec": update_count / elapsed,
+                    }
+                ),
+                flush=True,
+            )
+        finally:
+            fake.interrupt_polling()
+            bot_client.stop()
+
+    threading.Thread(target=drive, daemon=True).start()
+    bot_client.run()
+    fake.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+
+    if parsed.worker:
+        run_shards(parsed.shards[0], parsed.updates, parsed.seed)
+        return
+
+    print(f"{os.cpu_count()} cores")
+    print(f"{'shards':>6} {'updates/s':>10} {'speedup':>8}")
+    single = None
+    for shards in parsed.shards:
+        result = run_worker(
+            __file__,
+            "--worker",
+            "--shards",
+            str(shards),
+            "--updates",
+            str(parsed.updates),
+            "--seed",
+            str(parsed.seed),
+        )
+        single = single or result["updates_per_sec"]
+        print(
+            f"{shards:>6} {result['updates_per_sec']:>10.0f} "
+            f"{result['updates_per_sec'] / single:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
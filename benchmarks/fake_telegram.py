@@ -0,0 +1,230 @@
+"""Local stand-in for the Telegram Bot API, used by the benchmarks
+
+The server answers the Bot API methods the bot uses with plausible results, can serve
+queued updates through getUpdates, and records every call it receives. The helpers
+below are shared by the benchmarks that run the bot in worker processes.
+"""
+import http.client
+import http.server
+import itertools
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Floofbot", "username": "floofbot"}
+TOKEN = "123456:benchmark"
+
+## The fake Bot API has no rate limits, so replies should not be paced either
+UNLIMITED_OUTBOUND = {
+    "per_chat_rate": 100_000,
+    "per_chat_burst": 1000,
+    "global_rate": 100_000,
+    "global_burst": 1000,
+    "senders": 8,
+}
+
+
+def run_worker(script: str, *arguments: str) -> Dict[str, Any]:
+    """Runs a benchmark script in a fresh process and returns the result it printed
+
+    The worker prints its result as a line of JSON. The bot logs to stdout as well,
+    so the last line holding a JSON object is picked out.
+    """
+    output = subprocess.run(
+        [sys.executable, script, *arguments],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(
+        [line for line in output.splitlines() if line.startswith("{")][-1]
+    )
+
+
+def user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def message_update(
+    update_id: int,
+    chat_id: int,
+    user_id: int,
+    text: str,
+    date: Optional[int] = None,
+    **message_fields: Any,
+) -> Dict[str, Any]:
+    """Builds a synthetic message update, tagging a leading /command as an entity"""
+    entities = []
+    if text.startswith("/"):
+        entities.append(
+            {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+        )
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()) if date is None else date,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Benchmark"},
+            "from": user(user_id),
+            "text": text,
+            "entities": entities,
+            **message_fields,
+        },
+    }
+
+
+class FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    server: "FakeTelegram"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self) -> None:
+        method = self.path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        try:
+            data = json.loads(body) if body else dict()
+        except ValueError:
+            data = dict()
+        status, payload = self.server.call(method, data)
+        raw = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    do_GET = do_POST
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class FakeTelegram(http.server.ThreadingHTTPServer):
+    """Fake Bot API server listening on a free local port"""
+
+    daemon_threads = True
+
+    def __init__(self, admins: Tuple[int, ...] = ()):
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.admins = set(admins)
+        self.lock = threading.Condition()
+        self.pending_updates: List[Dict[str, Any]] = list()
+        self.calls: Dict[str, int] = dict()
+        self.message_ids = itertools.count(1)
+        ## Called with (method, data) for every request, may return a (status, payload)
+        ## to override the default answer
+        self.hooks: List[Callable[[str, Dict[str, Any]], Optional[Tuple]]] = list()
+        self.polling_interrupted = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def start(self) -> "FakeTelegram":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def interrupt_polling(self) -> None:
+        """Ends pending and future long polls at once, so the bot can stop quickly"""
+        with self.lock:
+            self.polling_interrupted = True
+            self.lock.notify_all()
+
+    def queue_updates(self, updates: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            self.pending_updates.extend(updates)
+            self.lock.notify_all()
+
+    def call(self, method: str, data: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        for hook in self.hooks:
+            override = hook(method, data)
+            if override is not None:
+                return override
+        answer = getattr(self, f"api_{method}", None)
+        if answer is None:
+            return 200, {"ok": True, "result": True}
+        return 200, {"ok": True, "result": answer(data)}
+
+    def api_getMe(self, data: Dict[str, Any]) -> Any:
+        return BOT_USER
+
+    def api_getUpdates(self, data: Dict[str, Any]) -> Any:
+        offset = int(data.get("offset") or 0)
+        limit = int(data.get("limit") or 100)
+        deadline = time.monotonic() + float(data.get("timeout") or 0)
+        with self.lock:
+            while True:
+                self.pending_updates = [
+                    update
+                    for update in self.pending_updates
+                    if update["update_id"] >= offset
+                ]
+                remaining = deadline - time.monotonic()
+                if self.pending_updates or remaining <= 0 or self.polling_interrupted:
+                    return self.pending_updates[:limit]
+                self.lock.wait(remaining)
+
+    def _message(self, data: Dict[str, Any]) -> Any:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "supergroup"},
+            "from": BOT_USER,
+            "text": data.get("text", ""),
+        }
+
+    api_sendMessage = _message
+    api_editMessageText = _message
+    api_sendDocument = _message
+
+    def api_getChat(self, data: Dict[str, Any]) -> Any:
+        chat_id = int(data["chat_id"])
+        if chat_id > 0:
+            return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+        return {"id": chat_id, "type": "supergroup", "title": "Benchmark"}
+
+    def api_getChatMember(self, data: Dict[str, Any]) -> Any:
+        user_id = int(data["user_id"])
+        status = "administrator" if user_id in self.admins else "member"
+        return {"user": user(user_id), "status": status}
+
+    def api_getChatAdministrators(self, data: Dict[str, Any]) -> Any:
+        return [
+            {"user": user(user_id), "status": "administrator"}
+            for user_id in self.admins
+        ]
+
+
+class WebhookPoster:
+    """Keeps a connection open to a webhook listener and POSTs updates to it"""
+
+    def __init__(self, host: str, port: int, path: str, secret: Optional[str] = None):
+        self.path = path
+        self.headers = {"Content-Type": "application/json"}
+        if secret:
+            self.headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+        self.connection = http.client.HTTPConnection(host, port)
+
+    def post(self, update: Dict[str, Any]) -> int:
+        self.connection.request(
+            "POST", self.path, body=json.dumps(update), headers=self.headers
+        )
+        response = self.connection.getresponse()
+        response.read()
+        if response.getheader("Connection", "").lower() == "close":
+            self.connection.close()
+        return response.status
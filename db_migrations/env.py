@@ -11,13 +11,21 @@ import tgfloofbot
 # access to the values within the .ini file in use.
 config = context.config
 
+# The bot passes its own connection when it migrates the database at startup,
+# in which case its logging and loaded models are left as they are.
+bot_connection = config.attributes.get("connection")
+
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
-fileConfig(config.config_file_name)
+if config.config_file_name is not None and bot_connection is None:
+    fileConfig(config.config_file_name)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
-target_metadata = tgfloofbot.main.load_db_metadata()
+if bot_connection is None:
+    target_metadata = tgfloofbot.main.load_db_metadata()
+else:
+    target_metadata = tgfloofbot.models.ORMBase.metadata
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -56,6 +64,14 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
+    if bot_connection is not None:
+        context.configure(
+            connection=bot_connection, target_metadata=target_metadata
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix="sqlalchemy.",
@@ -0,0 +1,40 @@
+"""create warnings table
+
+Revision ID: 1a2d5f8c3e60
+Revises: 
+Create Date: 2026-10-18 13:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a2d5f8c3e60'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    ## Databases from before the migrations already have the table, created by the bot
+    if "tg_warnings" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        "tg_warnings",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("date_added", sa.DateTime(), nullable=False),
+        sa.Column("forgiven", sa.Boolean(), nullable=False),
+        sa.Column("forgiven_by", sa.String(), nullable=True),
+        sa.Column("forgiven_by_id", sa.Integer(), nullable=True),
+        sa.Column("warned_by", sa.String(), nullable=False),
+        sa.Column("warned_by_id", sa.Integer(), nullable=False),
+        sa.Column("reason", sa.String(), nullable=False),
+        sa.Column("is_usernote", sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("tg_warnings")
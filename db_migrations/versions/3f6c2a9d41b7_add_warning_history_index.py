@@ -0,0 +1,28 @@
+"""add warning history index
+
+Revision ID: 3f6c2a9d41b7
+Revises: 1a2d5f8c3e60
+Create Date: 2026-10-18 13:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6c2a9d41b7'
+down_revision = '1a2d5f8c3e60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_tg_warnings_user_history",
+        "tg_warnings",
+        ["user_id", "is_usernote", "date_added"],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_tg_warnings_user_history", table_name="tg_warnings")
@@ -0,0 +1,33 @@
+"""index warnings by update and user
+
+Revision ID: 5e7a3b9c0d12
+Revises: c4d9e2f7a1b3
+Create Date: 2026-10-18 23:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7a3b9c0d12'
+down_revision = 'c4d9e2f7a1b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index("ix_tg_warnings_update_id", table_name="tg_warnings")
+    op.create_index(
+        "ix_tg_warnings_update_user",
+        "tg_warnings",
+        ["update_id", "user_id"],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_tg_warnings_update_user", table_name="tg_warnings")
+    op.create_index(
+        "ix_tg_warnings_update_id", "tg_warnings", ["update_id"], unique=True
+    )
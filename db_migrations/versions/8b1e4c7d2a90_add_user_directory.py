@@ -0,0 +1,33 @@
+"""add user directory
+
+Revision ID: 8b1e4c7d2a90
+Revises: 3f6c2a9d41b7
+Create Date: 2026-10-18 18:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e4c7d2a90'
+down_revision = '3f6c2a9d41b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "tg_users",
+        sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("username", sa.String(collation="NOCASE"), nullable=True),
+        sa.Column("full_name", sa.String(), nullable=False),
+        sa.Column("last_seen", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    op.create_index("ix_tg_users_username", "tg_users", ["username", "last_seen"])
+
+
+def downgrade():
+    op.drop_index("ix_tg_users_username", table_name="tg_users")
+    op.drop_table("tg_users")
@@ -0,0 +1,37 @@
+"""add warning counters
+
+Revision ID: 8b1f6d2e4a70
+Revises: 5e7a3b9c0d12
+Create Date: 2026-10-19 10:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1f6d2e4a70'
+down_revision = '5e7a3b9c0d12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "tg_warning_counters",
+        sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("active", sa.Integer(), nullable=False),
+        sa.Column("window_start", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    ## Counts every unforgiven warning, the ones older than the escalation window are
+    ## subtracted when the user is next warned
+    op.execute(
+        "INSERT INTO tg_warning_counters (user_id, active, window_start) "
+        "SELECT user_id, COUNT(*), MIN(date_added) FROM tg_warnings "
+        "WHERE is_usernote = 0 AND forgiven = 0 GROUP BY user_id"
+    )
+
+
+def downgrade():
+    op.drop_table("tg_warning_counters")
@@ -0,0 +1,43 @@
+"""add update tracking
+
+Revision ID: c4d9e2f7a1b3
+Revises: 8b1e4c7d2a90
+Create Date: 2026-10-18 21:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d9e2f7a1b3'
+down_revision = '8b1e4c7d2a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "tg_update_offset",
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("last_processed", sa.Integer(), nullable=False),
+        sa.Column("last_received", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "tg_updates_in_flight",
+        sa.Column("update_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.PrimaryKeyConstraint("update_id"),
+    )
+    op.add_column("tg_warnings", sa.Column("update_id", sa.Integer(), nullable=True))
+    op.create_index(
+        "ix_tg_warnings_update_id", "tg_warnings", ["update_id"], unique=True
+    )
+
+
+def downgrade():
+    op.drop_index("ix_tg_warnings_update_id", table_name="tg_warnings")
+    with op.batch_alter_table("tg_warnings") as batch_op:
+        batch_op.drop_column("update_id")
+    op.drop_table("tg_updates_in_flight")
+    op.drop_table("tg_update_offset")
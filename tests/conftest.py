@@ -0,0 +1,89 @@
+import pathlib
+import tempfile
+import time
+
+import pytest
+import telegram
+
+from tgfloofbot import models
+from tgfloofbot.client import TGFloofbotClient
+
+
+MAIN_GROUP = -100
+ADMIN_GROUP = -200
+
+
+class FakeBotAPI:
+    """Answers the Bot API requests of a client, ``handlers`` override methods"""
+
+    def __init__(self):
+        self.calls = list()
+        self.handlers = dict()
+
+    def __call__(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        self.calls.append((endpoint, data))
+        handler = self.handlers.get(endpoint)
+        if handler is not None:
+            return handler(data)
+        if endpoint in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": len(self.calls),
+                "date": int(time.time()),
+                "chat": {"id": data["chat_id"], "type": "supergroup"},
+                "text": data.get("text"),
+            }
+        return True
+
+
+_client = None
+
+
+def pytest_sessionstart(session):
+    ## Before the tests are collected, since importing a plugin registers its commands
+    ## and the client would then find them registered twice
+    global _client
+    config = models.Config(
+        token="123:abc",
+        database=pathlib.Path(tempfile.mkdtemp()) / "bot.db",
+        main_group=MAIN_GROUP,
+        admin_groups=[ADMIN_GROUP],
+        outbound={
+            "per_chat_rate": 1000,
+            "per_chat_burst": 1000,
+            "global_rate": 1000,
+            "global_burst": 1000,
+            "max_retries": 0,
+        },
+    )
+    _client = TGFloofbotClient(config)
+    bot = _client.updater.bot
+    bot._bot = telegram.User(1, "bot", True, username="floofbot")
+    bot._post = FakeBotAPI()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if _client is not None:
+        _client.close()
+
+
+@pytest.fixture
+def bot_client():
+    """A client talking to a fake Bot API, shared since plugins register globally"""
+    return _client
+
+
+@pytest.fixture
+def bot_api(bot_client):
+    api = bot_client.updater.bot._post
+    api.calls.clear()
+    api.handlers.clear()
+    yield api
+    api.handlers.clear()
+
+
+def settle(client):
+    """Waits until the outbound queue sent everything and ran the callbacks"""
+    time.sleep(0.05)
+    while client.outbound.depth or client.outbound.in_flight:
+        time.sleep(0.01)
+    time.sleep(0.05)
@@ -0,0 +1,42 @@
+import pydantic
+import pytest
+
+from tgfloofbot.models import FloodRule
+from tgfloofbot.plugins.antiflood import detector, handlers
+
+from conftest import MAIN_GROUP, settle
+
+
+ADMIN_ID = 42
+
+
+def test_restrictions_shorter_than_30_seconds_are_rejected():
+    with pytest.raises(pydantic.ValidationError):
+        FloodRule(count=5, window=10, actions=["restrict"], duration=10)
+    FloodRule(count=5, window=10, actions=["restrict"], duration=None)
+
+
+def test_only_alerts_until_the_admin_lists_are_loaded(bot_client, bot_api):
+    rule = FloodRule(count=3, window=10, actions=["delete", "restrict", "alert"])
+    responder = handlers.FloodResponder(bot_client, {"flood": rule})
+    detection = detector.Detection(
+        "flood", [(ADMIN_ID, 1), (ADMIN_ID, 2), (ADMIN_ID, 3)], True
+    )
+    bot_client.group_admins.clear()
+    bot_client.admin_cache.clear()
+    responder.respond(detection)
+    settle(bot_client)
+    assert [endpoint for endpoint, _ in bot_api.calls] == ["sendMessage"]
+
+    bot_api.calls.clear()
+    bot_client.group_admins[MAIN_GROUP] = frozenset((ADMIN_ID,))
+    responder.respond(detection)
+    responder.respond(detector.Detection("flood", [(7, 4), (7, 5), (7, 6)], True))
+    settle(bot_client)
+    acted_on = sorted(
+        (endpoint, int(data.get("user_id", 0)))
+        for endpoint, data in bot_api.calls
+        if endpoint != "sendMessage"
+    )
+    assert acted_on == [("deleteMessage", 0)] * 3 + [("restrictChatMember", 7)]
+    bot_client.group_admins.clear()
@@ -0,0 +1,24 @@
+import telegram
+
+from conftest import settle
+
+
+def test_failed_sends_count_once_against_the_breaker(bot_client, bot_api):
+    def send_message(data):
+        if data["text"].startswith("hello"):
+            raise telegram.error.NetworkError("Bad Gateway")
+        ## Error replies are rejected, which the breaker does not count either way
+        raise telegram.error.BadRequest("Chat not found")
+
+    bot_api.handlers["sendMessage"] = send_message
+    threshold = bot_client.breaker.threshold
+    for it in range(threshold - 1):
+        bot_client.send_message(-300, f"hello {it}")
+        settle(bot_client)
+    assert bot_client.breaker.failures == threshold - 1
+    assert bot_client.breaker.state == "closed"
+
+    bot_client.send_message(-300, "hello again")
+    settle(bot_client)
+    assert bot_client.breaker.state == "open"
+    bot_client.breaker.record_success()
@@ -0,0 +1,43 @@
+import types
+
+import telegram
+
+from tgfloofbot import cache, helpers
+
+
+MAIN_GROUP = -100
+ADMIN_ID = 42
+
+
+def make_client():
+    return types.SimpleNamespace(
+        config=types.SimpleNamespace(main_group=MAIN_GROUP, admin_groups=[]),
+        admin_cache=cache.TTLCache(100, 300.0),
+        group_admins={MAIN_GROUP: frozenset((ADMIN_ID, 7))},
+    )
+
+
+def test_departed_admins_are_forgotten_before_the_next_refresh():
+    client = make_client()
+    client.admin_cache.set((MAIN_GROUP, ADMIN_ID), True)
+    assert helpers.known_admin(client, ADMIN_ID)
+
+    update = telegram.Update.de_json(
+        {
+            "update_id": 1,
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": MAIN_GROUP, "type": "supergroup"},
+                "left_chat_member": {
+                    "id": ADMIN_ID,
+                    "is_bot": False,
+                    "first_name": "mod",
+                },
+            },
+        },
+        None,
+    )
+    helpers.invalidate_admin_cache(client, update)
+    assert not helpers.known_admin(client, ADMIN_ID)
+    assert helpers.known_admin(client, 7)
@@ -0,0 +1,102 @@
+import datetime
+
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+
+from tgfloofbot.models import ORMBase
+from tgfloofbot.plugins.administration import history, models
+
+
+USER_ID = 1000
+RECORDS = 2000
+
+
+@pytest.fixture
+def db():
+    engine = sqlalchemy.create_engine("sqlite://")
+    ORMBase.metadata.create_all(engine, tables=[models.Warning.__table__])
+    started = datetime.datetime(2021, 1, 1)
+    engine.execute(
+        models.Warning.__table__.insert(),
+        [
+            dict(
+                user_id=USER_ID,
+                ## Pairs of records share a date, so ties are broken by ID
+                date_added=started + datetime.timedelta(minutes=it // 2),
+                warned_by="admin",
+                warned_by_id=1,
+                reason=f"reason {it}",
+                is_usernote=it % 3 == 0,
+            )
+            for it in range(RECORDS)
+        ],
+    )
+    session = sqlalchemy.orm.Session(bind=engine)
+    yield session
+    session.close()
+
+
+def all_pages(db, direction=history.OLDER, cursor_id=None):
+    records = list()
+    while True:
+        page, has_more, _ = history.fetch_page(
+            db, USER_ID, cursor_id=cursor_id, direction=direction, limit=7
+        )
+        records.extend(page if direction == history.OLDER else reversed(page))
+        if not has_more:
+            return records
+        cursor_id = page[-1].id if direction == history.OLDER else page[0].id
+
+
+def test_pages_cover_the_history_newest_first(db):
+    records = all_pages(db)
+    keys = [(record.date_added, record.id) for record in records]
+    assert len(keys) == RECORDS
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_newer_pages_retrace_older_ones(db):
+    oldest = all_pages(db)[-1]
+    records = all_pages(db, history.NEWER, oldest.id)
+    assert [record.id for record in records] == [
+        record.id for record in reversed(all_pages(db)[:-1])
+    ]
+
+
+def test_unknown_cursor_gives_the_first_page(db):
+    first, _, from_cursor = history.fetch_page(db, USER_ID, limit=5)
+    assert not from_cursor
+    page, _, from_cursor = history.fetch_page(
+        db, USER_ID, cursor_id=RECORDS * 10, direction=history.NEWER, limit=5
+    )
+    assert not from_cursor
+    assert [record.id for record in page] == [record.id for record in first]
+
+
+def test_deep_pages_seek_on_the_index(db):
+    cursor = all_pages(db)[RECORDS // 2]
+    statements = list()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    engine = db.get_bind()
+    sqlalchemy.event.listen(engine, "before_cursor_execute", capture)
+    try:
+        history.fetch_page(db, USER_ID, cursor_id=cursor.id, limit=5)
+    finally:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", capture)
+
+    seeks = [it for it in statements if "LIMIT" in it[0]]
+    assert seeks
+    for statement, parameters in seeks:
+        plan = " ".join(
+            row[-1]
+            for row in engine.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        )
+        ## With an OR of comparisons SQLite only seeks on (user_id, is_usernote)
+        assert "ix_tg_warnings_user_history" in plan
+        assert "date_added<" in plan or "date_added>" in plan
@@ -0,0 +1,88 @@
+import concurrent.futures
+import threading
+
+import pytest
+import telegram
+
+from tgfloofbot import outbound
+
+
+class FakeBot:
+    """Answers every call with the next of ``outcomes``, counting the attempts"""
+
+    def __init__(self, *outcomes, gate=None):
+        self.outcomes = list(outcomes)
+        self.attempts = 0
+        self.gate = gate
+
+    def __getattr__(self, method):
+        def call(**kwargs):
+            self.attempts += 1
+            if self.gate is not None:
+                self.gate.wait(5)
+            outcome = self.outcomes.pop(0) if self.outcomes else True
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        return call
+
+
+@pytest.fixture
+def make_queue():
+    queues = list()
+
+    def make(bot):
+        queue = outbound.OutboundQueue(
+            bot, per_chat_rate=1000, per_chat_burst=1000, global_rate=1000
+        )
+        queue.start()
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.stop(1)
+
+
+def test_timed_out_messages_are_not_sent_twice(make_queue):
+    bot = FakeBot(telegram.error.TimedOut())
+    future = make_queue(bot).send_message(1, "hello")
+    with pytest.raises(telegram.error.TimedOut):
+        future.result(5)
+    assert bot.attempts == 1
+
+
+def test_timed_out_restrictions_are_retried(make_queue):
+    bot = FakeBot(telegram.error.TimedOut(), True)
+    queue = make_queue(bot)
+    future = queue.submit("restrict_chat_member", 1, user_id=2)
+    ## The first retry waits two seconds
+    assert future.result(5) is True
+    assert bot.attempts == 2
+
+
+def test_calls_waiting_for_a_retry_can_be_cancelled(make_queue):
+    bot = FakeBot(telegram.error.RetryAfter(1))
+    queue = make_queue(bot)
+    future = queue.send_message(1, "hello")
+    with pytest.raises(concurrent.futures.TimeoutError):
+        future.result(0.3)
+    assert future.cancel()
+    queue.stop(2)
+    assert bot.attempts == 1
+    assert queue.counters["cancelled"] == 1
+
+
+def test_cancelling_during_an_attempt_stops_retries(make_queue):
+    gate = threading.Event()
+    bot = FakeBot(telegram.error.RetryAfter(0), gate=gate)
+    queue = make_queue(bot)
+    future = queue.send_message(1, "hello")
+    with pytest.raises(concurrent.futures.TimeoutError):
+        future.result(0.2)
+    assert not future.cancel()
+    gate.set()
+    with pytest.raises(concurrent.futures.CancelledError):
+        future.result(5)
+    assert bot.attempts == 1
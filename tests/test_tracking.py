@@ -0,0 +1,72 @@
+import contextlib
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+from tgfloofbot import models, tracking
+
+
+@pytest.fixture
+def session_factory():
+    engine = sqlalchemy.create_engine("sqlite://")
+    models.ORMBase.metadata.create_all(
+        engine,
+        tables=[models.UpdateOffset.__table__, models.UpdateInFlight.__table__],
+    )
+    Session = sqlalchemy.orm.sessionmaker(bind=engine, expire_on_commit=False)
+
+    @contextlib.contextmanager
+    def session():
+        db = Session()
+        try:
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    return session
+
+
+def handle(tracker, update_id):
+    received = tracker.receive(update_id)
+    if received:
+        tracker.release(update_id)
+    return received
+
+
+def restarted(session_factory):
+    tracker = tracking.UpdateTracker(session_factory)
+    tracker.load()
+    return tracker
+
+
+def test_handled_updates_are_skipped_after_a_restart(session_factory):
+    tracker = restarted(session_factory)
+    for update_id in range(500_000, 500_010):
+        assert handle(tracker, update_id)
+    tracker.flush()
+
+    tracker = restarted(session_factory)
+    assert not handle(tracker, 500_005)
+    assert handle(tracker, 500_010)
+    assert tracker.offset() == 500_010
+
+
+def test_restarted_update_ids_are_handled(session_factory):
+    tracker = restarted(session_factory)
+    for update_id in range(500_000, 500_010):
+        assert handle(tracker, update_id)
+    tracker.flush()
+
+    ## Telegram picked a new random ID after a week without updates
+    tracker = restarted(session_factory)
+    assert handle(tracker, 1234)
+    assert handle(tracker, 1235)
+    assert not handle(tracker, 1235)
+    tracker.flush()
+    assert tracker.offset() == 1236
+
+    tracker = restarted(session_factory)
+    assert not handle(tracker, 1235)
+    assert handle(tracker, 1236)
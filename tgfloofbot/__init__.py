@@ -1 +1,6 @@
+import time
+
+## Taken before the bot's dependencies are imported, for the startup profile
+IMPORT_STARTED = time.perf_counter()
+
 from .main import cli_start
@@ -0,0 +1,102 @@
+import re
+import shlex
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Type
+
+import pydantic
+
+
+## Characters that need a full shlex pass; anything else is split on whitespace
+QUOTING_CHARACTERS = re.compile(r"[\"'\\]")
+WHITESPACE = re.compile(r"[ \t\r\n]+")
+
+## Schema keys that do not constrain a value beyond its type
+PLAIN_SCHEMA_KEYS = {"title", "description", "type", "default"}
+
+
+class ArgumentSyntaxError(ValueError):
+    pass
+
+
+class PositionalArgument(NamedTuple):
+    name: str
+    description: Optional[str]
+    coerce: Callable[[str], Any]
+    type_name: str
+    optional: bool
+    default: Any
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits command arguments like shlex.split, skipping shlex for unquoted text"""
+    if QUOTING_CHARACTERS.search(text):
+        try:
+            return shlex.split(text)
+        except ValueError as err:
+            raise ArgumentSyntaxError(str(err))
+    return [token for token in WHITESPACE.split(text) if token]
+
+
+class CompiledArgumentParser:
+    """Positional argument parser built once from a command's pydantic model
+
+    Arguments are matched left to right, with optional arguments only taking a token
+    when enough remain for every required argument after them. Error messages follow
+    the wording of argparse, which was previously used to parse commands.
+    """
+
+    def __init__(
+        self, model: Type[pydantic.BaseModel], arguments: List[PositionalArgument]
+    ):
+        self.model = model
+        self.arguments = arguments
+        self.required_count = sum(1 for argument in arguments if not argument.optional)
+        ## Models with validators or field constraints still go through full validation
+        self.validate = bool(
+            model.__validators__
+            or model.__pre_root_validators__
+            or model.__post_root_validators__
+            or any(
+                set(properties) - PLAIN_SCHEMA_KEYS
+                for properties in model.schema()["properties"].values()
+            )
+        )
+
+    def parse(self, text: str) -> pydantic.BaseModel:
+        tokens = tokenize(text)
+        spare_tokens = len(tokens) - self.required_count
+        values: Dict[str, Any] = dict()
+        missing: List[str] = list()
+        position = 0
+
+        for argument in self.arguments:
+            if argument.optional:
+                if spare_tokens <= 0:
+                    values[argument.name] = argument.default
+                    continue
+                spare_tokens -= 1
+            elif position >= len(tokens):
+                missing.append(argument.name)
+                continue
+
+            token = tokens[position]
+            position += 1
+            try:
+                values[argument.name] = argument.coerce(token)
+            except (TypeError, ValueError):
+                raise ArgumentSyntaxError(
+                    f"argument {argument.name}: invalid {argument.type_name} value: {token!r}"
+                )
+
+        if missing:
+            raise ArgumentSyntaxError(
+                f"the following arguments are required: {', '.join(missing)}"
+            )
+        if position < len(tokens):
+            raise ArgumentSyntaxError(
+                f"unrecognized arguments: {' '.join(tokens[position:])}"
+            )
+
+        if self.validate:
+            return self.model(**values)
+        return self.model.construct(**values)
@@ -0,0 +1,135 @@
+import json
+
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+import pydantic
+import telegram
+import telegram.ext
+import yaml
+
+from telegram import Update
+
+from . import exceptions
+from . import models
+
+
+## Telegram rejects buttons whose callback_data is longer than this
+MAX_CALLBACK_DATA_BYTES = 64
+KEY_SEPARATOR = ";"
+
+
+class CallbackCodec:
+    """Converts callback query arguments to and from the payload after the key"""
+
+    def encode(self, args: Any) -> str:
+        raise NotImplementedError()
+
+    def decode(self, payload: str, parse: Any) -> Any:
+        raise NotImplementedError()
+
+
+class RawCallbackCodec(CallbackCodec):
+    """Passes the payload through unchanged, for handlers that take a str"""
+
+    def encode(self, args: Any) -> str:
+        return str(args)
+
+    def decode(self, payload: str, parse: Any) -> Any:
+        return payload
+
+
+class YAMLCallbackCodec(CallbackCodec):
+    """Legacy YAML mapping payloads, such as ``a: p``"""
+
+    def encode(self, args: pydantic.BaseModel) -> str:
+        return yaml.safe_dump(args.dict(), default_flow_style=True, width=2**16)[:-1]
+
+    def decode(self, payload: str, parse: Type[pydantic.BaseModel]) -> Any:
+        return parse(**yaml.safe_load(payload))
+
+
+class PositionalCallbackCodec(CallbackCodec):
+    """Compact payloads holding the model's field values in declaration order
+
+    The values are encoded as the items of a JSON array without its brackets, so
+    ``HelpMenuButtonArgs(a="n")`` becomes ``"n"``. Payloads that are not valid JSON are
+    decoded as legacy YAML, so buttons sent by older versions of the bot keep working.
+    """
+
+    def __init__(self) -> None:
+        self.field_names: Dict[Type[pydantic.BaseModel], List[str]] = dict()
+        self.legacy_codec = YAMLCallbackCodec()
+
+    def fields(self, model: Type[pydantic.BaseModel]) -> List[str]:
+        field_names = self.field_names.get(model)
+        if field_names is None:
+            field_names = self.field_names[model] = list(model.__fields__)
+        return field_names
+
+    def encode(self, args: pydantic.BaseModel) -> str:
+        values = [getattr(args, name) for name in self.fields(type(args))]
+        return json.dumps(values, separators=(",", ":"), ensure_ascii=False)[1:-1]
+
+    def decode(self, payload: str, parse: Type[pydantic.BaseModel]) -> Any:
+        try:
+            values = json.loads(f"[{payload}]")
+        except ValueError:
+            return self.legacy_codec.decode(payload, parse)
+        return parse(**dict(zip(self.fields(parse), values)))
+
+
+DEFAULT_CODEC = PositionalCallbackCodec()
+
+
+def encode(
+    key: str, args: Union[str, pydantic.BaseModel, None], codec: CallbackCodec
+) -> str:
+    """Builds the callback_data of a button for the handler registered under a key"""
+    payload = "" if args is None else codec.encode(args)
+    callback_data = f"{key}{KEY_SEPARATOR}{payload}"
+    if len(callback_data.encode("utf-8")) > MAX_CALLBACK_DATA_BYTES:
+        raise exceptions.FloofbotException(
+            f"Callback data for '{key}' exceeds {MAX_CALLBACK_DATA_BYTES} bytes: "
+            f"{callback_data}"
+        )
+    return callback_data
+
+
+class CallbackQueryRouter(telegram.ext.Handler):
+    """Single dispatcher handler that routes callback queries by their key"""
+
+    def __init__(self, routes: Dict[str, models.CallbackQueryData]):
+        ## handle_update is overridden and calls the routed handler itself, so the
+        ## callback Handler requires is never used
+        super().__init__(self._routed_per_update)
+        self.routes = routes
+
+    @staticmethod
+    def _routed_per_update(
+        update: Update, context: telegram.ext.CallbackContext
+    ) -> None:
+        """Placeholder callback, handlers are looked up in check_update"""
+
+    def check_update(
+        self, update: object
+    ) -> Optional[Tuple[models.CallbackQueryData, str]]:
+        if not isinstance(update, Update) or not update.callback_query:
+            return None
+        data = update.callback_query.data
+        if not data:
+            return None
+        key, separator, payload = data.partition(KEY_SEPARATOR)
+        query_data = self.routes.get(key)
+        if not separator or query_data is None or query_data.callback is None:
+            return None
+        return query_data, payload
+
+    def handle_update(
+        self,
+        update: Update,
+        dispatcher: telegram.ext.Dispatcher,
+        check_result: Tuple[models.CallbackQueryData, str],
+        context: telegram.ext.CallbackContext = None,
+    ) -> object:
+        query_data, payload = check_result
+        return query_data.callback(update, context, payload)
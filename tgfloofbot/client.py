@@ -1,16 +1,39 @@
+import concurrent.futures
+import contextlib
+import queue
+import resource
 import sys
 import threading
+import time
 
-from typing import Any, Callable, List, Optional
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Sequence
 
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.orm
+import sqlalchemy.pool
 import telegram
 import telegram.ext
 
+from . import cache
+from . import callbacks
+from . import constants
+from . import directory
+from . import errors
 from . import models
 from . import exceptions
+from . import helpers
 from . import loader
+from . import metrics
+from . import outbound
+from . import profiling
+from . import router
+from . import schema
+from . import sharding
+from . import tracking
+from . import webhook
+from . import workers
+from . import writer
 
 from .helpers import em
 
@@ -18,12 +41,108 @@ from .logger import LOG
 
 
 class TGFloofbotClient:
-    def __init__(self, config: models.Config):
+    def __init__(
+        self,
+        config: models.Config,
+        startup: Optional[profiling.StartupProfile] = None,
+    ):
         self.config = config
-        self.updater = telegram.ext.Updater(token=config.token)
+        self.startup = startup or profiling.StartupProfile()
+        self.updater = telegram.ext.Updater(
+            token=config.token, base_url=config.base_url
+        )
         self.dispatcher = self.updater.dispatcher
+        self.metrics = metrics.Metrics()
+        self.metrics.instrument_bot(self.updater.bot)
+        self.metrics_server: Optional[metrics.MetricsServer] = None
         self.dispatcher.add_error_handler(self._handle_error)  # type: ignore
+        self.webhook: Optional[webhook.WebhookServer] = None
+        self.shards: Optional[sharding.ShardPool] = None
+        ## Queue of the updates routed to this process, when it runs as a shard
+        self.shard_updates: Any = None
+        outbound_config = config.outbound
+        self.outbound = outbound.OutboundQueue(
+            self.updater.bot,
+            per_chat_rate=outbound_config.per_chat_rate,
+            per_chat_burst=outbound_config.per_chat_burst,
+            global_rate=outbound_config.global_rate,
+            global_burst=outbound_config.global_burst,
+            senders=outbound_config.senders,
+            max_retries=outbound_config.max_retries,
+        )
+        self.outbound.start()
+        error_config = config.error_reporting
+        self.errors = errors.ErrorAggregator(
+            window=error_config.window,
+            ring_size=error_config.recent_errors,
+            on_summary=self._report_suppressed_errors,
+        )
+        self.errors.start()
+        ## Pauses error replies while the Bot API is failing, they would only add load
+        self.breaker = errors.CircuitBreaker(
+            threshold=error_config.breaker_threshold,
+            cooldown=error_config.breaker_cooldown,
+        )
+        self.admin_cache: cache.TTLCache = cache.TTLCache(
+            maxsize=config.admin_cache.max_size, ttl=config.admin_cache.ttl
+        )
+        ## Administrators of each admin group, replaced whole on every refresh
+        self.group_admins: Dict[int, FrozenSet[int]] = dict()
+        self.dispatcher.add_handler(
+            telegram.ext.TypeHandler(
+                telegram.Update,
+                lambda update, context: helpers.invalidate_admin_cache(self, update),
+            ),
+            group=constants.ADMIN_CACHE_HANDLER_GROUP,
+        )
+        self.dispatcher.add_handler(
+            telegram.ext.TypeHandler(
+                telegram.Update, lambda update, context: self._observe(update)
+            ),
+            group=constants.USER_DIRECTORY_HANDLER_GROUP,
+        )
+        self._main_group_chat: Optional[telegram.Chat] = None
+        self.workers: Optional[workers.ChatOrderedExecutor] = None
+        if config.worker_pool.workers > 0:
+            self.workers = workers.ChatOrderedExecutor(
+                workers=config.worker_pool.workers,
+                batch_size=config.worker_pool.batch_size,
+            )
+        self.dispatcher.add_handler(
+            router.CommandRouter(loader.command_routes, self.workers)
+        )
+        self.metrics.add_collector("outbound", self.outbound.stats)
+        self.metrics.add_collector("errors", self.errors.stats)
+        self.metrics.add_collector("error_replies", self.breaker.stats)
+        self.metrics.add_collector(
+            "admin_cache",
+            lambda: {
+                "size": len(self.admin_cache),
+                "hits": self.admin_cache.hits,
+                "misses": self.admin_cache.misses,
+            },
+        )
+        if self.workers:
+            self.metrics.add_collector("workers", self.workers.stats)
+        self.dispatcher.add_handler(callbacks.CallbackQueryRouter(loader.query_routes))
+        self.startup.mark("client setup")
         self.connect_database()
+        self.prepare_database()
+        directory_config = config.user_directory
+        self.users = directory.UserDirectory(
+            self.session,
+            cache_size=directory_config.cache_size,
+            flush_interval=directory_config.flush_interval,
+            touch_interval=directory_config.touch_interval,
+        )
+        self.users.start()
+        self.metrics.add_collector("user_directory", self.users.stats)
+        self.messages = directory.MessageIndex(
+            size=directory_config.message_index_size,
+            ttl=directory_config.message_index_ttl,
+        )
+        self.metrics.add_collector("message_index", self.messages.stats)
+        self.startup.mark("database connect")
 
         global global_client
         if global_client:
@@ -32,78 +151,561 @@ class TGFloofbotClient:
         LOG.debug("Client has assigned the global bot client")
 
         self.load_plugins()
+        self.startup.mark("plugin load")
+
+        ## Loaded once the plugins created the tables of an empty database
+        self.tracker: Optional[tracking.UpdateTracker] = None
+        if config.update_tracking.enabled:
+            self.tracker = tracking.UpdateTracker(
+                self.session,
+                flush_interval=config.update_tracking.flush_interval,
+                before_flush=self.writer.flush if self.writer else None,
+            )
+            self.tracker.load()
+            self.tracker.start()
+            self.track_updates()
 
     def _handle_error(
         self,
         update: telegram.update.Update,
         context: telegram.ext.callbackcontext.CallbackContext,
     ) -> None:
+        chat = update.effective_chat if isinstance(update, telegram.Update) else None
+        self.report_error(context.error, chat.id if chat else None)
+
+    def report_error(
+        self, error: BaseException, chat_id: Optional[int], observed: bool = False
+    ) -> None:
+        """Logs an error and replies to the chat it happened in, if any
+
+        Used by the dispatcher's error handler and for failed sends, which happen on
+        the outbound queue's threads. ``observed`` means the circuit breaker already
+        recorded the error, as it does for every queued send.
+        """
+        self.metrics.inc(metrics.ERRORS, (type(error).__name__,))
         try:
-            if isinstance(context.error, exceptions.FloofbotSyntaxError):
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=str(context.error),
-                    parse_mode=telegram.ParseMode.MARKDOWN_V2,
+            if isinstance(error, exceptions.FloofbotException) and error.critical:
+                LOG.error(
+                    f"The bot is shutting down due to a critical exception: {error}",
+                    exc_info=error,
                 )
-            elif isinstance(context.error, exceptions.FloofbotException):
-                if context.error.critical:
-                    LOG.exception(
-                        f"The bot is shutting down due to a critical exception: {context.error}"
-                    )
-                    self.stop()
+                self.stop()
+                return
+            if str(error).startswith("Message is not modified:"):
+                return
+            if not observed and errors.is_api_failure(error):
+                self.breaker.record_failure()
+
+            decision = self.errors.record(error, chat_id)
+            if decision.log:
+                repeated = (
+                    f" ({decision.unlogged} similar errors since the last report)"
+                    if decision.unlogged
+                    else ""
+                )
+                if isinstance(error, exceptions.FloofbotException):
+                    LOG.error(f"{error}{repeated}")
                 else:
-                    LOG.error(context.error)
-                if not context.error.silent:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"*{em(context.error.title)}:*\n{context.error}",
-                        parse_mode=telegram.ParseMode.MARKDOWN_V2,
+                    LOG.error(
+                        f"An unhandled exception was caught{repeated}:", exc_info=error
                     )
             else:
-                if not str(context.error).startswith("Message is not modified:"):
-                    LOG.exception("An unhandled exception was caught:")
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"*An unhandled exception occurred:*\n{em(context.error)}",
-                        parse_mode=telegram.ParseMode.MARKDOWN_V2,
-                    )
+                LOG.debug("Similar error at %s: %s", decision.fingerprint[1], error)
+
+            if isinstance(error, exceptions.FloofbotSyntaxError):
+                text = str(error)
+            elif isinstance(error, exceptions.FloofbotException):
+                if error.silent:
+                    return
+                text = f"*{em(error.title)}:*\n{error}"
+            else:
+                text = f"*An unhandled exception occurred:*\n{em(error)}"
+            if not decision.reply:
+                return
+            if decision.suppressed:
+                text += em(
+                    f"\n\n({decision.suppressed} similar errors were not reported)"
+                )
+            self._send_error_reply(chat_id, text)  # type: ignore
         except:
             LOG.exception("Error handler error:")
 
+    def _send_error_reply(self, chat_id: int, text: str) -> None:
+        if not self.breaker.allow():
+            LOG.debug("Not replying to an error in %s, the Bot API is failing", chat_id)
+            return
+        ## Failed error replies are only logged, reporting them could loop
+        future = self.outbound.send_message(
+            chat_id, text, parse_mode=telegram.ParseMode.MARKDOWN_V2
+        )
+        future.add_done_callback(_log_send_failure)
+        future.add_done_callback(self.breaker.observe)
+
+    def _report_suppressed_errors(
+        self, chat_id: int, fingerprint: errors.Fingerprint, count: int
+    ) -> None:
+        error_type, _ = fingerprint
+        self._send_error_reply(
+            chat_id,
+            em(f"{count} more {error_type} errors occurred and were not reported."),
+        )
+
+    def _observe(self, update: telegram.Update) -> None:
+        self.users.observe(update)
+        self.messages.observe(update)
+        chat = update.effective_chat
+        cached = self._main_group_chat
+        if cached is not None and chat and chat.id == cached.id:
+            if chat.title != cached.title:
+                LOG.debug("The main group was renamed, dropping its cached chat")
+                self._main_group_chat = None
+
+    def track_updates(self) -> None:
+        """Skips duplicate updates and marks each update done once it is handled"""
+        tracker = self.tracker
+        process_update = self.dispatcher.process_update
+        self.metrics.add_collector("updates", tracker.stats)  # type: ignore
+
+        def tracked_process_update(update: object) -> None:
+            if not isinstance(update, telegram.Update):
+                process_update(update)
+            elif tracker.claim(update.update_id):  # type: ignore
+                with tracker.handling(update.update_id):  # type: ignore
+                    process_update(update)
+
+        self.dispatcher.process_update = tracked_process_update  # type: ignore
+
+    def main_group_chat(self) -> telegram.Chat:
+        """The main group's Chat, fetched once and refetched after it is renamed"""
+        chat = self._main_group_chat
+        if chat is None:
+            chat = self.updater.bot.get_chat(chat_id=self.config.main_group)
+            self._main_group_chat = chat
+        return chat
+
+    def send_message(
+        self,
+        chat_id: Any,
+        text: str,
+        priority: int = outbound.PRIORITY_DEFAULT,
+        report: bool = True,
+        **kwargs: Any,
+    ) -> concurrent.futures.Future:
+        """Queues a message through the rate limited outbound queue
+
+        Returns a future resolving to the sent message. Failures go through
+        ``report_error`` like errors raised by handlers, callers that handle them
+        themselves by waiting on the future should pass ``report=False``.
+        """
+        future = self.outbound.send_message(chat_id, text, priority=priority, **kwargs)
+        ## First, so an error reply for the failure sees the breaker's new state
+        future.add_done_callback(self.breaker.observe)
+        if report:
+            future.add_done_callback(
+                lambda done: self._report_send_failure(chat_id, done)
+            )
+        else:
+            future.add_done_callback(_log_send_failure)
+        return future
+
+    def _report_send_failure(
+        self, chat_id: Any, future: concurrent.futures.Future
+    ) -> None:
+        if future.cancelled() or future.exception() is None:
+            return
+        self.report_error(future.exception(), chat_id, observed=True)  # type: ignore
+
+    def wait(
+        self, future: concurrent.futures.Future, action: str = "A Bot API call"
+    ) -> Any:
+        """Waits for a queued Bot API call for at most ``outbound.wait_timeout`` seconds
+
+        The call is cancelled unless an attempt to send it is under way, so a queue
+        held up by Telegram's rate limits does not keep a worker and the chat's later
+        commands waiting.
+        """
+        timeout = self.config.outbound.wait_timeout
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise exceptions.OutboundTimeoutException(action, timeout)
+
+    def wait_errors(
+        self, futures: Sequence[concurrent.futures.Future], action: str
+    ) -> List[Optional[BaseException]]:
+        """Waits for several queued Bot API calls, returns the error of each
+
+        Calls get ``outbound.wait_timeout`` seconds in total. Those that did not
+        finish by then are cancelled unless an attempt is under way, and their error
+        is an OutboundTimeoutException.
+        """
+        timeout = self.config.outbound.wait_timeout
+        concurrent.futures.wait(futures, timeout)
+        results: List[Optional[BaseException]] = list()
+        for future in futures:
+            if future.done() and not future.cancelled():
+                results.append(future.exception())
+            else:
+                future.cancel()
+                results.append(exceptions.OutboundTimeoutException(action, timeout))
+        return results
+
     def connect_database(self) -> None:
         LOG.debug("Connecting to database")
+        options = self.config.database_options
         self.engine = sqlalchemy.create_engine(
-            f"sqlite:///{self.config.database.resolve()}", echo=True
+            f"sqlite:///{self.config.database.resolve()}",
+            echo=options.echo,
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=options.pool_size,
+            connect_args={"check_same_thread": False},
         )
 
-    def load_plugins(self) -> None:
-        ## TODO: Make this load custom plugins from external directories
-        from . import plugins
+        def _set_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+            cursor = dbapi_connection.cursor()
+            if options.wal:
+                cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={options.synchronous}")
+            cursor.execute(f"PRAGMA busy_timeout={int(options.busy_timeout)}")
+            cursor.execute(f"PRAGMA mmap_size={int(options.mmap_size)}")
+            cursor.close()
 
-        LOG.debug("Bootstrapping database")
+        sqlalchemy.event.listen(self.engine, "connect", _set_pragmas)
+        self.Session = sqlalchemy.orm.sessionmaker(
+            bind=self.engine, expire_on_commit=False
+        )
+
+        self.writer: Optional[writer.WriteBehindQueue] = None
+        if self.config.write_behind.enabled:
+            self.writer = writer.WriteBehindQueue(
+                self.session,
+                batch_size=self.config.write_behind.batch_size,
+                flush_interval=self.config.write_behind.flush_interval,
+            )
+            self.writer.start()
+
+    def prepare_database(self) -> None:
+        """Checks that the database schema matches the migrations
+
+        Pending migrations are applied if ``auto_migrate`` is enabled, otherwise the
+        bot refuses to start. An empty database gets its tables created and stamped
+        with the latest revision once the built-in plugins are discovered.
+        """
+        self.schema_managed = schema.migrations_available()
+        self.bootstrap_database = False
+        if not self.schema_managed:
+            LOG.warning(
+                f"Migrations not found in {constants.MIGRATIONS_DIRECTORY}, "
+                "tables will be created as plugins are imported"
+            )
+            models.ORMBase.metadata.create_all(
+                self.engine,
+                tables=[
+                    models.User.__table__,
+                    models.UpdateOffset.__table__,
+                    models.UpdateInFlight.__table__,
+                ],
+            )
+            return
+
+        state = schema.check(self.engine)
+        if state.up_to_date:
+            LOG.debug(f"Database schema is up to date ({state.describe()})")
+        elif state.empty:
+            self.bootstrap_database = True
+        elif state.unknown:
+            raise exceptions.FloofbotLoaderException(
+                f"The database has revisions the migrations do not know about "
+                f"({state.describe()}), is the bot out of date?"
+            )
+        elif self.config.database_options.auto_migrate:
+            LOG.info(f"Migrating the database ({state.describe()})")
+            schema.upgrade(self.engine)
+        else:
+            raise exceptions.FloofbotLoaderException(
+                f"The database needs migrations ({state.describe()}). Run "
+                "`alembic upgrade head`, or start the bot with --migrate"
+            )
+
+    def create_database(self) -> None:
+        """Creates every built-in table in an empty database and stamps it"""
+        LOG.info("Creating the database schema")
+        for plugin in loader.plugins.values():
+            if plugin.builtin:
+                loader.import_plugin(plugin.name)
         models.ORMBase.metadata.create_all(self.engine)
-        self.db = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+        schema.stamp(self.engine)
+
+    @contextlib.contextmanager
+    def session(self) -> Iterator[sqlalchemy.orm.Session]:
+        """Provides a database session scoped to one unit of work, such as an update
 
-        for custom_loader in loader.custom_loaders:
+        The session is committed when the block exits normally and rolled back if it
+        raises. Sessions must not be shared between threads.
+        """
+        db = self.Session()
+        try:
+            yield db
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def store(self, *objects: Any, durable: bool = False) -> None:
+        """Inserts ORM objects, through the write-behind queue if it is enabled
+
+        Callers that need to read their own write immediately afterwards should pass
+        ``durable=True``, which commits the objects before returning.
+        """
+        if self.writer is None or durable:
+            with self.session() as db:
+                db.add_all(objects)
+        else:
+            self.writer.add(*objects)
+
+    def load_plugins(self) -> None:
+        """Discovers the built-in and configured plugins and imports the eager ones
+
+        Plugins with a manifest are only imported when one of their commands or
+        callback queries is first used, unless lazy loading is turned off.
+        """
+        plugin_config = self.config.plugins
+        started = time.perf_counter()
+        loader.discover_plugins(
+            [constants.PLUGINS_DIRECTORY] + list(plugin_config.directories)
+        )
+        if self.bootstrap_database:
+            self.create_database()
+        for plugin in list(loader.plugins.values()):
+            if plugin_config.lazy and plugin.manifest and not plugin.manifest.eager:
+                continue
+            loader.import_plugin(plugin.name)
+
+        LOG.info(
+            f"Loaded plugins in {(time.perf_counter() - started) * 1000:.1f} ms, "
+            f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MiB"
+        )
+        for line in loader.plugin_report():
+            LOG.info(f"Plugin {line}")
+
+    def setup_plugin(
+        self,
+        plugin: models.PluginData,
+        tables: List[sqlalchemy.Table],
+        plugin_custom_loaders: List[Callable],
+    ) -> None:
+        """Creates the tables of a newly imported plugin and runs its custom loaders
+
+        Tables of built-in plugins are left to the migrations.
+        """
+        if tables and (not plugin.builtin or not self.schema_managed):
+            LOG.debug(f"Creating the tables of plugin {plugin.name}")
+            models.ORMBase.metadata.create_all(self.engine, tables=tables)
+
+        for custom_loader in plugin_custom_loaders:
             LOG.debug(f"Running custom loader: {custom_loader.__name__}")
             custom_loader(self)
 
     def run(self) -> None:
-        LOG.debug("Starting the polling loop")
-        self.updater.start_polling()
+        if self.config.sharding.shards:
+            self.start_shards()
+            self.startup.mark("shard startup")
+        else:
+            LOG.debug("Warming the admin cache")
+            helpers.warm_admin_cache(self)
+            self.schedule_admin_refresh()
+            self.startup.mark("admin cache warmup")
+        if self.config.metrics.port is not None:
+            self.metrics_server = metrics.MetricsServer(
+                self.metrics, self.config.metrics.listen, self.config.metrics.port
+            )
+            self.metrics_server.start()
+        if self.config.ingest == "webhook":
+            self.start_webhook()
+            self.startup.mark("webhook registration")
+            self.startup.finish()
+        else:
+            LOG.debug("Starting the polling loop")
+            if self.tracker:
+                self._track_polling()
+            if self.startup.enabled:
+                self._profile_first_poll()
+            self.updater.start_polling()
         self.updater.idle()
-        LOG.debug("start_polling ended")
+        LOG.debug("Update ingestion ended")
+        self.close()
+
+    def schedule_admin_refresh(self) -> None:
+        """Refetches the administrator lists periodically on the job queue
+
+        Promotions and demotions do not reach the bot as updates, so this is what
+        keeps the lists current.
+        """
+        interval = self.config.admin_cache.refresh_interval
+        if interval > 0:
+            self.updater.job_queue.run_repeating(
+                lambda context: helpers.warm_admin_cache(self), interval, first=interval
+            )
+
+    def start_shards(self) -> None:
+        """Routes every update to shard processes instead of handling it here"""
+        self.shards = sharding.ShardPool(
+            self.config,
+            self.config.sharding.shards,
+            on_exit=lambda shard: self.stop(),
+            on_done=self.tracker.release if self.tracker else None,
+        )
+        self.shards.start()
+        self.metrics.add_collector("shards", self.shards.stats)
+        self.dispatcher.add_handler(
+            telegram.ext.TypeHandler(telegram.Update, self._route_to_shard),
+            group=constants.SHARD_HANDLER_GROUP,
+        )
+
+    def _route_to_shard(
+        self,
+        update: telegram.Update,
+        context: telegram.ext.callbackcontext.CallbackContext,
+    ) -> None:
+        ## The update stays in flight until the shard reports it done
+        if self.tracker:
+            self.tracker.hold(update.update_id)
+        self.shards.route(update)  # type: ignore
+        raise telegram.ext.DispatcherHandlerStop()
+
+    def run_shard(self, updates: Any, done: Any) -> None:
+        """Handles the updates an ingest process routes here, until it sends None
+
+        Updates are dispatched on this thread in the order they arrive, commands then
+        run on the worker pool as usual. The ID of every finished update is put into
+        ``done``.
+        """
+        helpers.warm_admin_cache(self)
+        self.schedule_admin_refresh()
+        self.updater.job_queue.start()
+        self.tracker = tracking.UpdateTracker(None, on_done=done.put)
+        self.track_updates()
+        self.shard_updates = updates
+        bot = self.updater.bot
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            self.dispatcher.process_update(telegram.Update.de_json(data, bot))
+        LOG.debug("The shard's update queue was closed")
+        self.updater.job_queue.stop()
+        self.close()
+
+    def _track_polling(self) -> None:
+        """Acknowledges to Telegram only the updates that are persisted as handled
+
+        Updates that Telegram sends again because they were not acknowledged yet are
+        dropped here, before they reach the dispatcher.
+        """
+        bot = self.updater.bot
+        get_updates = bot.get_updates
+        tracker: tracking.UpdateTracker = self.tracker  # type: ignore
+
+        def tracked_get_updates(
+            offset: Optional[int] = None, *args: Any, **kwargs: Any
+        ) -> Any:
+            while self.updater.running:
+                ## Telegram keeps the updates that are not fetched yet, which is safer
+                ## than piling them up in memory
+                if tracker.backlogged():
+                    tracker.wait_for_room(tracker.flush_interval)
+                    continue
+                if tracker.pending():
+                    tracker.flush()
+                updates = get_updates(tracker.offset() or offset, *args, **kwargs)
+                fresh = [it for it in updates if tracker.receive(it.update_id)]
+                if fresh or not updates:
+                    return fresh
+                ## Only updates still being handled came back, so wait for one to finish
+                tracker.wait_for_progress(tracker.flush_interval)
+            return []
+
+        bot.get_updates = tracked_get_updates  # type: ignore
+        self.updater.last_update_id = tracker.offset() or 0
+
+    def _profile_first_poll(self) -> None:
+        """Ends the startup profile when the first getUpdates call is made
+
+        The call itself is a long poll, so its duration is not part of startup.
+        """
+        bot = self.updater.bot
+        get_updates = bot.get_updates
+
+        def first_get_updates(*args: Any, **kwargs: Any) -> Any:
+            bot.get_updates = get_updates  # type: ignore
+            self.startup.mark("first getUpdates")
+            self.startup.finish()
+            return get_updates(*args, **kwargs)
+
+        bot.get_updates = first_get_updates  # type: ignore
+
+    def start_webhook(self) -> None:
+        """Starts the dispatcher and a local listener for updates pushed by Telegram"""
+        webhook_config = self.config.webhook
+        LOG.debug("Starting the webhook listener")
+        ## A bounded queue makes the listener shed load once the dispatcher falls behind
+        update_queue: queue.Queue = queue.Queue(maxsize=webhook_config.queue_size)
+        self.updater.update_queue = self.dispatcher.update_queue = update_queue
+        self.webhook = webhook.WebhookServer(
+            webhook_config, self.updater.bot, update_queue
+        )
+        threading.Thread(
+            target=self.dispatcher.start, name="tgfb-dispatcher", daemon=True
+        ).start()
+        self.updater.job_queue.start()
+        self.webhook.start()
+        self.webhook.register()
+        ## Lets Updater.stop() and its signal handler shut the dispatcher down
+        self.updater.running = True
+
+    def close(self) -> None:
+        """Flushes and releases the client's background services"""
+        if self.shards:
+            self.shards.stop()
+        if self.webhook:
+            self.webhook.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.workers:
+            self.workers.stop()
+        self.errors.stop()
+        self.outbound.stop()
+        self.users.stop()
+        if self.tracker:
+            self.tracker.stop()
+        if self.writer:
+            LOG.debug(f"Flushing {self.writer.pending} pending writes")
+            self.writer.stop()
 
     def stop(self) -> None:
         LOG.info("The bot is now stopping")
 
         def _shutdown():
+            if self.shard_updates is not None:
+                self.shard_updates.put(None)
             self.updater.stop()
+            self.close()
             self.updater.is_idle = False
             LOG.debug("Bot stopped")
 
         threading.Thread(target=_shutdown).start()
 
 
+def _log_send_failure(future: concurrent.futures.Future) -> None:
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        LOG.warning("Failed to send a message: %s", error)
+
+
 ## Global variable for the client that will be used when registering commands and other handlers
 global_client: Optional[TGFloofbotClient] = None
@@ -3,3 +3,15 @@ import pathlib
 
 
 MODULE_DIRECTORY = pathlib.Path(os.path.realpath(__file__)).parent.resolve()
+PLUGINS_DIRECTORY = MODULE_DIRECTORY / "plugins"
+MIGRATIONS_DIRECTORY = MODULE_DIRECTORY.parent / "db_migrations"
+
+## Manifest file that lets a plugin directory be imported on first use
+PLUGIN_MANIFEST_FILENAME = "plugin.yaml"
+## Package that plugins from external directories are imported under
+EXTERNAL_PLUGIN_PACKAGE = "tgfloofbot_plugins"
+
+## Dispatcher handler groups for internal bookkeeping, which run before plugin handlers
+SHARD_HANDLER_GROUP = -1000
+ADMIN_CACHE_HANDLER_GROUP = -100
+USER_DIRECTORY_HANDLER_GROUP = -99
@@ -0,0 +1,277 @@
+import datetime
+import math
+import threading
+import time
+
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+)
+
+import sqlalchemy.orm
+import telegram
+
+from . import cache
+from . import models
+
+from .logger import LOG
+
+
+class UserDirectory:
+    """Users seen in updates, so IDs and @usernames resolve without Bot API calls
+
+    Every observed user passes through an in-memory LRU in front of the tg_users table.
+    A row is only written when the username or name of a user changes, or when their
+    last_seen is older than ``touch_interval``, and the writes are batched on a
+    background thread every ``flush_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], ContextManager[sqlalchemy.orm.Session]],
+        cache_size: int = 10_000,
+        flush_interval: float = 5.0,
+        touch_interval: float = 3600.0,
+        timer: Callable[[], float] = time.time,
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.touch_interval = touch_interval
+        self.timer = timer
+        self.by_id: cache.TTLCache = cache.TTLCache(cache_size, math.inf)
+        ## Casefolded usernames to user IDs
+        self.by_username: cache.TTLCache = cache.TTLCache(cache_size, math.inf)
+        self._dirty: Dict[int, models.UserRecord] = dict()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.written = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self.by_id),
+            "hits": self.by_id.hits + self.by_username.hits,
+            "misses": self.by_id.misses + self.by_username.misses,
+            "pending": len(self._dirty),
+            "written": self.written,
+        }
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="tgfb-user-directory", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Writes the pending changes and stops the writer thread"""
+        if self._thread is None:
+            return
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes every changed user to the database"""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, dict()
+        rows = [
+            {
+                "user_id": record.id,
+                "username": record.username,
+                "full_name": record.full_name,
+                "last_seen": datetime.datetime.fromtimestamp(
+                    record.last_seen, datetime.timezone.utc
+                ),
+            }
+            for record in dirty.values()
+        ]
+        try:
+            with self.session_factory() as db:
+                db.execute(
+                    models.User.__table__.insert().prefix_with("OR REPLACE"), rows
+                )
+        except Exception:
+            LOG.exception(f"Failed to write {len(rows)} users to the user directory")
+            return
+        self.written += len(rows)
+        LOG.debug("User directory wrote %s users", len(rows))
+
+    def observe(self, update: telegram.Update) -> None:
+        """Records every user an update reveals"""
+        for user in _update_users(update):
+            self.record(user)
+
+    def record(self, user: telegram.User) -> None:
+        now = self.timer()
+        cached = self.by_id.get(user.id)
+        full_name = user.full_name
+        if (
+            cached is not None
+            and cached.username == user.username
+            and cached.full_name == full_name
+            and now - cached.last_seen < self.touch_interval
+        ):
+            return
+
+        record = models.UserRecord(user.id, user.username, full_name, now)
+        self.by_id.set(user.id, record)
+        if cached is not None and cached.username and cached.username != user.username:
+            self.by_username.pop(cached.username.casefold())
+        if user.username:
+            self.by_username.set(user.username.casefold(), user.id)
+        with self._lock:
+            self._dirty[user.id] = record
+
+    def get(self, user_id: int) -> Optional[models.UserRecord]:
+        record = self.by_id.get(user_id)
+        if record is not None:
+            return record
+        with self._lock:
+            record = self._dirty.get(user_id)
+        if record is not None:
+            return record
+        with self.session_factory() as db:
+            row = db.query(models.User).get(user_id)
+        return self._cache_row(row)
+
+    def find(self, username: str) -> Optional[models.UserRecord]:
+        """Looks up the user who most recently had ``username``"""
+        username = username.lstrip("@")
+        user_id = self.by_username.get(username.casefold())
+        if user_id is not None:
+            return self.get(user_id)
+        with self.session_factory() as db:
+            row = (
+                db.query(models.User)
+                .filter(models.User.username == username)
+                .order_by(models.User.last_seen.desc())
+                .first()
+            )
+        return self._cache_row(row)
+
+    def resolve(self, identifier: str) -> Optional[models.UserRecord]:
+        """Looks up a user by a raw user ID or @username"""
+        identifier = identifier.strip()
+        try:
+            return self.get(int(identifier))
+        except ValueError:
+            return self.find(identifier)
+
+    def _cache_row(self, row: Optional[models.User]) -> Optional[models.UserRecord]:
+        if row is None:
+            return None
+        record = models.UserRecord(
+            row.user_id,
+            row.username,
+            row.full_name,
+            row.last_seen.replace(tzinfo=datetime.timezone.utc).timestamp(),
+        )
+        self.by_id.set(record.id, record)
+        if record.username:
+            self.by_username.set(record.username.casefold(), record.id)
+        return record
+
+
+class MessageIndex:
+    """Who recently replied to or forwarded which message in a group
+
+    The Bot API cannot list the replies to a message, so moderators acting on everyone
+    who answered or spread a spam message rely on what the bot has seen. Entries are
+    kept in an LRU that expires them after ``ttl`` seconds, with at most
+    ``max_users`` users per message.
+    """
+
+    def __init__(self, size: int = 10_000, ttl: float = 86400.0, max_users: int = 500):
+        self.max_users = max_users
+        self.users: cache.TTLCache = cache.TTLCache(size, ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self.users)}
+
+    def observe(self, update: telegram.Update) -> None:
+        message = update.message
+        if message is None or message.from_user is None:
+            return
+        if message.chat.type not in (telegram.Chat.GROUP, telegram.Chat.SUPERGROUP):
+            return
+        if message.reply_to_message:
+            self._add(
+                ("reply", message.chat.id, message.reply_to_message.message_id),
+                message.from_user.id,
+            )
+        origin = forward_origin(message)
+        if origin is not None:
+            self._add(origin, message.from_user.id)
+
+    def _add(self, key: Hashable, user_id: int) -> None:
+        users: Optional[Set[int]] = self.users.get(key)
+        if users is None:
+            self.users.set(key, {user_id})
+        elif len(users) < self.max_users:
+            users.add(user_id)
+
+    def repliers(self, message: telegram.Message) -> List[int]:
+        """Users seen replying to ``message``"""
+        return list(self.users.get(("reply", message.chat.id, message.message_id), ()))
+
+    def forwarders(self, message: telegram.Message) -> List[int]:
+        """Users seen forwarding the same message as the forwarded ``message``"""
+        origin = forward_origin(message)
+        if origin is None:
+            return list()
+        return list(self.users.get(origin, ()))
+
+
+def forward_origin(message: telegram.Message) -> Optional[Hashable]:
+    """A key identifying the original of a forwarded message, the same for every copy"""
+    if message.forward_from_chat and message.forward_from_message_id:
+        return (
+            "forward",
+            message.forward_from_chat.id,
+            message.forward_from_message_id,
+        )
+    if message.forward_date is None:
+        return None
+    ## Messages forwarded from users only carry the sender and the original date
+    sender = (
+        message.forward_from.id if message.forward_from else message.forward_sender_name
+    )
+    return ("forward", sender, message.forward_date.timestamp())
+
+
+def _update_users(update: telegram.Update) -> Iterator[telegram.User]:
+    if update.effective_user:
+        yield update.effective_user
+    message = update.effective_message
+    if message is None:
+        return
+    if message.reply_to_message and message.reply_to_message.from_user:
+        yield message.reply_to_message.from_user
+    if message.forward_from:
+        yield message.forward_from
+    yield from message.new_chat_members
+    if message.left_chat_member:
+        yield message.left_chat_member
+    for entity in message.entities:
+        if entity.user:
+            yield entity.user
@@ -0,0 +1,298 @@
+import collections
+import concurrent.futures
+import dataclasses
+import os
+import re
+import sysconfig
+import threading
+import time
+import traceback
+
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import telegram
+
+from . import exceptions
+
+from .logger import LOG
+
+
+_PACKAGE_PATH = os.path.normcase(os.path.dirname(os.path.abspath(__file__)))
+## Frames in these directories are library code, unless they belong to the bot itself
+_LIBRARY_PATHS = tuple(
+    os.path.normcase(os.path.abspath(sysconfig.get_paths()[name]))
+    for name in ("stdlib", "purelib", "platlib")
+)
+
+Fingerprint = Tuple[str, str]
+
+_MARKDOWN_ESCAPE = re.compile(r"\\(.)")
+
+
+def _is_bot_code(filename: str) -> bool:
+    path = os.path.normcase(os.path.abspath(filename))
+    return path.startswith(_PACKAGE_PATH) or not path.startswith(_LIBRARY_PATHS)
+
+
+def fingerprint(error: BaseException) -> Fingerprint:
+    """Identifies similar errors by exception class and the bot code that raised it
+
+    The call site is the innermost frame of the traceback outside of libraries.
+    """
+    frames = traceback.extract_tb(error.__traceback__)
+    bot_frames = [frame for frame in frames if _is_bot_code(frame.filename)]
+    frame = (bot_frames or frames or [None])[-1]
+    if frame is None:
+        return (type(error).__name__, "unknown")
+    return (
+        type(error).__name__,
+        f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}",
+    )
+
+
+def plain_message(error: BaseException) -> str:
+    """The error message, without the Markdown escapes of the bot's own exceptions"""
+    if isinstance(error, exceptions.FloofbotException):
+        return _MARKDOWN_ESCAPE.sub(r"\1", str(error))
+    return str(error)
+
+
+def is_api_failure(error: Optional[BaseException]) -> bool:
+    """Whether an error means the Bot API itself is unavailable or refusing requests
+
+    Requests the Bot API rejects, such as a DM to a user who blocked the bot, do not
+    count.
+    """
+    if isinstance(error, telegram.error.RetryAfter):
+        return True
+    return isinstance(error, telegram.error.NetworkError) and not isinstance(
+        error, telegram.error.BadRequest
+    )
+
+
+@dataclasses.dataclass
+class ErrorRecord:
+    time: float
+    fingerprint: Fingerprint
+    message: str
+    chat_id: Optional[int]
+
+
+@dataclasses.dataclass
+class ErrorDecision:
+    fingerprint: Fingerprint
+    ## Whether the chat should get a reply, at most once per window and fingerprint
+    reply: bool
+    ## Similar errors in the chat whose replies were suppressed since the last one
+    suppressed: int
+    ## Whether the error should be logged with its traceback
+    log: bool
+    ## Similar errors logged without a traceback since the last full log entry
+    unlogged: int
+
+
+class ErrorAggregator:
+    """Deduplicates error replies and log entries during error storms
+
+    Errors are grouped by ``fingerprint()``. Each chat gets at most one reply per
+    fingerprint and ``window`` seconds, and the log gets at most one traceback per
+    fingerprint and window. The next reply or log entry, or the summary sent once the
+    window ends, says how many similar errors were suppressed in between. The last
+    ``ring_size`` errors are kept for ``/errors``.
+    """
+
+    def __init__(
+        self,
+        window: float = 60.0,
+        ring_size: int = 200,
+        on_summary: Optional[Callable[[int, Fingerprint, int], Any]] = None,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.window = window
+        self.on_summary = on_summary
+        self.timer = timer
+        self.recent: Deque[ErrorRecord] = collections.deque(maxlen=ring_size)
+        ## Entries are [window start, suppressed count]
+        self._chats: Dict[Tuple[int, Fingerprint], List] = dict()
+        self._logged: Dict[Fingerprint, List] = dict()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.counters = {
+            "errors": 0,
+            "suppressed_replies": 0,
+            "suppressed_logs": 0,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"windows": len(self._chats), **self.counters}
+
+    def snapshot(self) -> List[ErrorRecord]:
+        """The recent errors, oldest first"""
+        with self._lock:
+            return list(self.recent)
+
+    def record(self, error: BaseException, chat_id: Optional[int]) -> ErrorDecision:
+        key = fingerprint(error)
+        now = self.timer()
+        with self._lock:
+            self.counters["errors"] += 1
+            self.recent.append(
+                ErrorRecord(time.time(), key, plain_message(error), chat_id)
+            )
+            log, unlogged = self._open(self._logged, key, now)
+            if not log:
+                self.counters["suppressed_logs"] += 1
+            reply, suppressed = False, 0
+            if chat_id is not None:
+                reply, suppressed = self._open(self._chats, (chat_id, key), now)
+                if not reply:
+                    self.counters["suppressed_replies"] += 1
+        return ErrorDecision(key, reply, suppressed, log, unlogged)
+
+    def _open(self, windows: Dict, key: Any, now: float) -> Tuple[bool, int]:
+        """Starts a new window for ``key`` unless one is open, which counts the error
+
+        Returns whether a window was started, and the count of the one it replaced.
+        """
+        window = windows.get(key)
+        if window is not None and now - window[0] < self.window:
+            window[1] += 1
+            return False, 0
+        windows[key] = [now, 0]
+        return True, window[1] if window is not None else 0
+
+    def sweep(self) -> None:
+        """Ends the windows that passed and reports their suppressed errors"""
+        now = self.timer()
+        with self._lock:
+            chats = self._expire(self._chats, now)
+            logged = self._expire(self._logged, now)
+        for (error_type, site), count in logged:
+            LOG.warning(
+                f"{count} more {error_type} errors at {site} in the last "
+                f"{self.window:g}s"
+            )
+        if self.on_summary is None:
+            return
+        for (chat_id, key), count in chats:
+            try:
+                self.on_summary(chat_id, key, count)
+            except Exception:
+                LOG.exception("Failed to report suppressed errors")
+
+    def _expire(self, windows: Dict, now: float) -> List[Tuple[Any, int]]:
+        expired = list()
+        for key, (started, count) in list(windows.items()):
+            if now - started < self.window:
+                continue
+            del windows[key]
+            if count:
+                expired.append((key, count))
+        return expired
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="tgfb-error-sweeper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while self._running:
+            self._wake.wait(self.window)
+            self.sweep()
+
+
+class CircuitBreaker:
+    """Stops an action for ``cooldown`` seconds after ``threshold`` failures in a row
+
+    Once the cooldown passed, a single attempt is let through, and its outcome closes
+    the breaker again or restarts the cooldown.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 5,
+        cooldown: float = 30.0,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.timer = timer
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.counters = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if self._probing or self.timer() - self.opened_at >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "open": self.state != "closed",
+            "failures": self.failures,
+            **self.counters,
+        }
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._probing and self.timer() - self.opened_at >= self.cooldown:
+                self._probing = True
+                return True
+            self.counters["rejected"] += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                LOG.info("Bot API sends succeed again, error replies resumed")
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or (
+                self.opened_at is None and self.failures >= self.threshold
+            ):
+                if not self._probing:
+                    self.counters["opened"] += 1
+                    LOG.warning(
+                        f"{self.failures} Bot API sends failed in a row, pausing "
+                        f"error replies for {self.cooldown:g}s"
+                    )
+                self.opened_at = self.timer()
+                self._probing = False
+
+    def observe(self, future: concurrent.futures.Future) -> None:
+        """Records the outcome of a Bot API call, as a future done callback"""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self.record_success()
+        elif is_api_failure(error):
+            self.record_failure()
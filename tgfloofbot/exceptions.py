@@ -1,3 +1,6 @@
+from telegram.utils.helpers import escape_markdown
+
+
 class FloofbotException(Exception):
     ## If True, reports the error to the bot administrators
     notify = False
@@ -17,9 +20,26 @@ class FloofbotLoaderException(FloofbotException):
     critical = True
 
 
+class FloofbotPluginException(FloofbotException):
+    title = "Plugin error"
+
+
 class FloofbotSyntaxError(FloofbotException):
     pass
 
 
 class FloofbotPermissionsError(FloofbotException):
     title = "Permissions error"
+
+
+class OutboundTimeoutException(FloofbotException):
+    title = "Telegram did not respond in time"
+
+    def __init__(self, action: str, timeout: float):
+        super().__init__(
+            escape_markdown(
+                f"{action} did not complete within {timeout:g}s, Telegram may be "
+                "rate limiting the bot",
+                version=2,
+            )
+        )
@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Dict, FrozenSet, List
 
 import telegram
 
@@ -21,17 +21,119 @@ def check_valid_client() -> None:
         raise exceptions.FloofbotLoaderException("No bot client has been created yet")
 
 
+ADMIN_STATUSES = (
+    telegram.constants.CHATMEMBER_ADMINISTRATOR,
+    telegram.constants.CHATMEMBER_CREATOR,
+)
+
+
+## Permissions of a muted member
+MUTED = telegram.ChatPermissions(
+    can_send_messages=False,
+    can_send_media_messages=False,
+    can_send_polls=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False,
+)
+
+
+def format_duration(seconds: float) -> str:
+    """Helper to write a duration in the largest unit that divides it"""
+    for unit, unit_seconds in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= unit_seconds and seconds % unit_seconds == 0:
+            count = int(seconds // unit_seconds)
+            return f"{count} {unit}{'s' if count != 1 else ''}"
+    return f"{seconds:g} seconds"
+
+
+def admin_group_ids(client: "client.TGFloofbotClient") -> List[int]:
+    """Helper to list the groups in which admin status is checked"""
+    return [client.config.main_group] + client.config.admin_groups
+
+
 def is_admin(client: "client.TGFloofbotClient", user_id: int) -> bool:
     """Helper to check if the given user is an admin"""
+    if known_admin(client, user_id):
+        return True
+    bot = client.updater.bot
+    for group_id in admin_group_ids(client):
+        cache_key = (group_id, user_id)
+        group_admin = client.admin_cache.get(cache_key)
+        if group_admin is None:
+            try:
+                member = bot.get_chat_member(group_id, user_id)
+            except telegram.error.TelegramError as err:
+                LOG.exception(f"Failed to get chat member: {err}")
+                continue
+            group_admin = member.status in ADMIN_STATUSES
+            client.admin_cache.set(cache_key, group_admin)
+        if group_admin:
+            return True
+    return False
+
+
+def known_admin(client: "client.TGFloofbotClient", user_id: int) -> bool:
+    """Helper to check if the given user is an admin, without Bot API calls
+
+    Uses the administrator lists refreshed by ``warm_admin_cache`` and the admin
+    cache, so it is cheap enough for every message.
+    """
+    group_admins: Dict[int, FrozenSet[int]] = client.group_admins
+    for group_id in admin_group_ids(client):
+        if user_id in group_admins.get(group_id, ()):
+            return True
+        if client.admin_cache.get((group_id, user_id)):
+            return True
+    return False
+
+
+def warm_admin_cache(client: "client.TGFloofbotClient") -> None:
+    """Helper to fetch the administrators of every admin group
+
+    Replaces the administrator lists and prefills the admin cache. A group whose
+    list cannot be fetched keeps its previous one.
+    """
     bot = client.updater.bot
-    for group_id in [client.config.main_group] + client.config.admin_groups:
+    for group_id in admin_group_ids(client):
         try:
-            member = bot.get_chat_member(group_id, user_id)
-            if member.status in (
-                telegram.constants.CHATMEMBER_ADMINISTRATOR,
-                telegram.constants.CHATMEMBER_CREATOR,
-            ):
-                return True
+            administrators = bot.get_chat_administrators(group_id)
         except telegram.error.TelegramError as err:
-            LOG.exception(f"Failed to get chat member: {err}")
-    return False
+            LOG.exception(f"Failed to get chat administrators of {group_id}: {err}")
+            continue
+        client.group_admins[group_id] = frozenset(
+            member.user.id for member in administrators
+        )
+        for member in administrators:
+            client.admin_cache.set((group_id, member.user.id), True)
+        LOG.debug(f"Cached {len(administrators)} administrators of {group_id}")
+
+
+def invalidate_admin_cache(
+    client: "client.TGFloofbotClient", update: telegram.Update
+) -> None:
+    """Helper to drop cached admin statuses affected by membership changes"""
+    chat = update.effective_chat
+    if not chat or chat.id not in admin_group_ids(client):
+        return
+
+    user_ids: List[int] = list()
+    ## ChatMemberUpdated updates are only exposed by newer python-telegram-bot versions
+    for member_update in (
+        getattr(update, "chat_member", None),
+        getattr(update, "my_chat_member", None),
+    ):
+        if member_update:
+            user_ids.append(member_update.new_chat_member.user.id)
+    message = update.message
+    if message:
+        user_ids.extend(user.id for user in message.new_chat_members)
+        if message.left_chat_member:
+            user_ids.append(message.left_chat_member.id)
+
+    ## The refreshed list may be stale too, the next lookup asks Telegram instead
+    group_admins = client.group_admins.get(chat.id)
+    if group_admins is not None and group_admins.intersection(user_ids):
+        client.group_admins[chat.id] = group_admins.difference(user_ids)
+    for user_id in user_ids:
+        if client.admin_cache.pop((chat.id, user_id)) is not None:
+            LOG.debug("Invalidated cached admin status of %s in %s", user_id, chat.id)
@@ -1,9 +1,15 @@
-import argparse
 import functools
-import shlex
+import importlib
+import importlib.util
+import logging
+import pathlib
+import sys
+import threading
+import time
+import types
 import typing
 
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
 
 import pydantic
 import telegram
@@ -11,11 +17,15 @@ import telegram.ext
 import yaml
 
 from telegram import Update
-from telegram.ext import CallbackContext, CallbackQueryHandler
+from telegram.ext import CallbackContext
 
+from . import arguments
+from . import callbacks
 from . import client
+from . import constants
 from . import exceptions
 from . import helpers
+from . import metrics
 from . import models
 
 from .helpers import em
@@ -24,8 +34,24 @@ from .logger import LOG
 
 
 commands: Dict[str, models.CommandData] = dict()
+## Case-folded command names and aliases, used by the command router
+command_routes: Dict[str, models.CommandData] = dict()
 query_handlers: List[Callable] = list()
+## Callback query handlers, keyed by the callback_data key, used by the query router
+query_routes: Dict[str, models.CallbackQueryData] = dict()
 custom_loaders: List[Callable] = list()
+## Discovered plugins, keyed by plugin name
+plugins: Dict[str, models.PluginData] = dict()
+## Held while a plugin is imported and set up, so it happens exactly once
+plugin_lock = threading.RLock()
+
+## Rendered help texts, keyed by command name, and help pages, keyed by page size
+help_texts: Dict[str, str] = dict()
+help_pages: Dict[int, List[str]] = dict()
+
+
+## Plugin manifests are read at startup, so prefer libyaml's loader when available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 ARGUMENT_TYPES = {
@@ -42,7 +68,50 @@ ARGUMENT_TYPE_NAMES = {
 }
 
 
+def invalidate_help_cache() -> None:
+    """Drops the rendered help texts so they are rebuilt on next use"""
+    help_texts.clear()
+    help_pages.clear()
+
+
 def get_command_help_text(command_data: models.CommandData) -> str:
+    help_text = help_texts.get(command_data.name)
+    if help_text is None:
+        help_text = help_texts[command_data.name] = render_command_help_text(
+            command_data
+        )
+    return help_text
+
+
+def get_help_pages(commands_per_page: int) -> List[str]:
+    """Returns the pages listing every command, rendering them if necessary"""
+    pages = help_pages.get(commands_per_page)
+    if pages is None:
+        pages = help_pages[commands_per_page] = render_help_pages(commands_per_page)
+    return pages
+
+
+def render_help_pages(commands_per_page: int) -> List[str]:
+    all_commands: List[str] = list()
+    ## Plugins loaded in the background may register commands meanwhile
+    for command_data in list(commands.values()):
+        if command_data.help_data.description:
+            description = f": {command_data.help_data.description}"
+        else:
+            description = ""
+        all_commands.append(f"/{command_data.name}{description}")
+    all_commands.sort()
+    segments = list(
+        all_commands[it : it + commands_per_page]
+        for it in range(0, len(all_commands), commands_per_page)
+    ) or [[]]
+    return [
+        f"Commands list: page {index + 1}/{len(segments)}\n" + "\n".join(segment)
+        for index, segment in enumerate(segments)
+    ]
+
+
+def render_command_help_text(command_data: models.CommandData) -> str:
     help_data = command_data.help_data
     arguments_text_name: List[str] = list()
     arguments_text_help: List[str] = list()
@@ -76,9 +145,36 @@ def get_command_help_text(command_data: models.CommandData) -> str:
     return "\n".join(help_text_lines)
 
 
-class CommandArgParser(argparse.ArgumentParser):
-    def error(self, message):
-        raise SyntaxError(message)
+def build_argument_parser(
+    parse: typing.Type[pydantic.BaseModel],
+) -> arguments.CompiledArgumentParser:
+    """Compiles a command's argument model into a positional argument parser"""
+    model_schema = parse.schema()
+    type_hints = typing.get_type_hints(parse)
+    positional_arguments: List[arguments.PositionalArgument] = list()
+    for argument_name, argument_data in model_schema["properties"].items():
+        argument_type = ARGUMENT_TYPES.get(argument_data.get("type"))
+        if argument_type is None:
+            raise exceptions.FloofbotLoaderException(
+                f"Argument '{argument_name}' has unsupported data type: {argument_data.get('type')}"
+            )
+
+        argument_hint = type_hints[argument_name]
+        is_optional = "default" in argument_data or (
+            typing.get_origin(argument_hint) is Union
+            and type(None) in typing.get_args(argument_hint)
+        )
+        positional_arguments.append(
+            arguments.PositionalArgument(
+                name=argument_name,
+                description=argument_data.get("description"),
+                coerce=argument_type,
+                type_name=argument_type.__name__,
+                optional=is_optional,
+                default=argument_data.get("default"),
+            )
+        )
+    return arguments.CompiledArgumentParser(parse, positional_arguments)
 
 
 def command(
@@ -89,8 +185,14 @@ def command(
     requires_chat: bool = True,
     requires_user: bool = True,
     admin: bool = False,
+    aliases: Optional[List[str]] = None,
+    pooled: bool = True,
 ) -> Callable:
-    """Decorator for tagging functions as commands"""
+    """Decorator for tagging functions as commands
+
+    Commands run on the worker pool unless ``pooled`` is False, in which case they run
+    on the dispatcher thread and hold up every other update until they return.
+    """
     if not function:
         return functools.partial(
             command,
@@ -99,13 +201,19 @@ def command(
             requires_chat=requires_chat,
             requires_user=requires_user,
             admin=admin,
+            aliases=aliases,
+            pooled=pooled,
         )
 
     name = name or function.__name__
-    if name in commands:
-        raise exceptions.FloofbotLoaderException(
-            "Duplicate command found: {name} ({function})"
-        )
+    aliases = aliases or list()
+    placeholders = _command_placeholders([name] + aliases)
+    for route in [name] + aliases:
+        existing = commands.get(name) or command_routes.get(route.casefold())
+        if existing is not None and not any(existing is it for it in placeholders):
+            raise exceptions.FloofbotLoaderException(
+                f"Duplicate command found: {route} ({function})"
+            )
     LOG.debug(f"Registering command handler: {name}")
 
     ## Set up argument parsing
@@ -116,87 +224,95 @@ def command(
     )
 
     if parse:
-        model_schema = parse.schema()
-        parser = CommandArgParser()
-        for argument_name, argument_data in model_schema["properties"].items():
-            argument_type = ARGUMENT_TYPES.get(argument_data.get("type"))
-            if argument_type is None:
-                raise exceptions.FloofbotLoaderException(
-                    f"Argument '{argument_name}' has unsupported data type: {argument_data.get('type')}"
-                )
-
-            argument_hint = typing.get_type_hints(parse)[argument_name]
-            is_optional = "default" in argument_data or (
-                typing.get_origin(argument_hint) is Union
-                and type(None) in typing.get_args(argument_hint)
+        parser = build_argument_parser(parse)
+        for argument in parser.arguments:
+            command_help_data.arguments[argument.name] = models.CommandArgumentHelpData(
+                name=argument.name,
+                description=argument.description,
+                optional=argument.optional,
+                default=argument.default,
+                data_type=ARGUMENT_TYPE_NAMES[argument.coerce],
             )
 
-            command_help_data.arguments[argument_name] = models.CommandArgumentHelpData(
-                name=argument_name,
-                description=argument_data.get("description"),
-                optional=is_optional,
-                default=argument_data.get("default"),
-                data_type=ARGUMENT_TYPE_NAMES[argument_type],
-            )
-            parser.add_argument(
-                argument_name,
-                type=argument_type,
-                default=argument_data.get("default"),
-                nargs="?" if is_optional else None,
-            )
-
-    commands[name] = command_data = models.CommandData(
+    command_data = models.CommandData(
         function=function,
         name=name,
         parse=parse,
         help_data=command_help_data,
+        aliases=aliases,
+        pooled=pooled,
     )
 
-    def wrapped_callback(update: Update, context: CallbackContext) -> Any:
-        LOG.debug(f"Command invoked: {name}")
+    def run_command(
+        update: Update, context: CallbackContext, timer: metrics.HandlerTimer
+    ) -> Any:
+        ## Debug messages are formatted lazily and only built when debug is enabled
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if debug:
+            LOG.debug("Command invoked: %s", name)
         kwargs = dict()
 
         if requires_chat or admin:
             if not update.effective_chat:
-                LOG.debug("Command requires a chat, but update did not include it")
+                if debug:
+                    LOG.debug("Command requires a chat, but update did not include it")
                 return
 
         if requires_user or admin:
             if not update.effective_user:
-                LOG.debug("Command requires a user, but update did not include it")
+                if debug:
+                    LOG.debug("Command requires a user, but update did not include it")
                 return
 
         if admin:
             if not helpers.is_admin(client.global_client, update.effective_user.id):
-                LOG.debug(
-                    "Command requires admin, but user "
-                    f"{update.effective_user} is not an admin"
-                )
+                if debug:
+                    LOG.debug(
+                        "Command requires admin, but user %s is not an admin",
+                        update.effective_user,
+                    )
                 raise exceptions.FloofbotPermissionsError(
                     "This command can only be used by administrators"
                 )
 
         if parser:
             message_entities = update.effective_message.entities
-            shlex_split = shlex.split(
-                update.effective_message.text[message_entities[0].length :]
-            )
             try:
-                parsed_args = parser.parse_args(shlex_split)
-                kwargs["args"] = parse(**vars(parsed_args))
+                with timer.phase("parse"):
+                    kwargs["args"] = parser.parse(
+                        update.effective_message.text[message_entities[0].length :]
+                    )
             except Exception as err:
-                LOG.exception(f"Parsing exception: {err}")
+                LOG.exception("Parsing exception: %s", err)
                 parsing_error_text = em(f"Invalid command syntax: {err}")
                 usage_text = get_command_help_text(command_data)
                 raise exceptions.FloofbotSyntaxError(
                     f"{parsing_error_text}\n\n{usage_text}"
                 )
 
-        return function(client.global_client, update, context, **kwargs)
+        with timer.phase("handler"):
+            return function(client.global_client, update, context, **kwargs)
 
-    if client.global_client:
-        handler = telegram.ext.CommandHandler(name, wrapped_callback)
-        client.global_client.dispatcher.add_handler(handler)
+    def wrapped_callback(update: Update, context: CallbackContext) -> Any:
+        bot_metrics = client.global_client.metrics
+        with metrics.command_scope(name), bot_metrics.timer("command", name) as timer:
+            return run_command(update, context, timer)
+
+    command_data.callback = wrapped_callback
+    ## The placeholders are only replaced once the command is complete, so commands
+    ## that arrive while its plugin is being imported wait for the import to finish.
+    ## Routes are overwritten in place so none of them is ever missing, then the
+    ## ones the command no longer uses are dropped.
+    commands[name] = command_data
+    for route in [name] + aliases:
+        command_routes[route.casefold()] = command_data
+    for placeholder in placeholders:
+        for route in [placeholder.name] + placeholder.aliases:
+            if command_routes.get(route.casefold()) is placeholder:
+                del command_routes[route.casefold()]
+        if commands.get(placeholder.name) is placeholder:
+            del commands[placeholder.name]
+    invalidate_help_cache()
 
     return function
 
@@ -205,39 +321,276 @@ def callback_query_handler(
     function: Optional[Callable] = None,
     *,
     key: str,
+    codec: Optional[callbacks.CallbackCodec] = None,
 ) -> Callable:
     """Decorator for registering custom callback query handlers"""
     if not function:
-        return functools.partial(callback_query_handler, key=key)
+        return functools.partial(callback_query_handler, key=key, codec=codec)
+    placeholder = query_routes.get(key)
+    if placeholder is not None and placeholder.placeholder_for:
+        placeholder = None
+    if placeholder is not None or callbacks.KEY_SEPARATOR in key:
+        raise exceptions.FloofbotLoaderException(
+            f"Invalid or duplicate callback query key: {key} ({function})"
+        )
     query_handlers.append(function)
 
     helpers.check_valid_client()
     parse = typing.get_type_hints(function).get("args")
-
-    def wrapped_callback(update: Update, context: CallbackContext) -> Callable:
-        LOG.debug(f"Wrapped callback called: {function.__name__}")
-        query = update.callback_query
-        query.answer()
-        cleaned_data = context.matches[0].groups()[0]
-        function_kwargs: Dict[str, Union[str, pydantic.BaseModel]] = dict()
-        if parse is str:
-            function_kwargs["args"] = cleaned_data
-        elif issubclass(parse, pydantic.BaseModel):
-            LOG.debug(yaml.safe_load(cleaned_data))
-            function_kwargs["args"] = parse(**yaml.safe_load(cleaned_data))
-        return function(client.global_client, update, context, **function_kwargs)
-
-    query_handler = CallbackQueryHandler(
-        wrapped_callback, pattern=f"^{key};([\\s\\S]+)$"
+    if codec is None:
+        codec = (
+            callbacks.RawCallbackCodec() if parse is str else callbacks.DEFAULT_CODEC
+        )
+    query_data = models.CallbackQueryData(
+        function=function, key=key, parse=parse, codec=codec
     )
-    client.global_client.dispatcher.add_handler(query_handler)
+
+    def wrapped_callback(update: Update, context: CallbackContext, payload: str) -> Any:
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("Wrapped callback called: %s", function.__name__)
+        bot_metrics = client.global_client.metrics
+        with metrics.command_scope(key), bot_metrics.timer("callback", key) as timer:
+            query = update.callback_query
+            query.answer()
+            function_kwargs: Dict[str, Union[str, pydantic.BaseModel]] = dict()
+            if parse is not None:
+                with timer.phase("parse"):
+                    function_kwargs["args"] = codec.decode(
+                        payload, parse  # type: ignore
+                    )
+            with timer.phase("handler"):
+                return function(
+                    client.global_client, update, context, **function_kwargs
+                )
+
+    query_data.callback = wrapped_callback
+    ## Replaces the placeholder only now, like commands do
+    query_routes[key] = query_data
 
     return function
 
 
+def callback_data(key: str, args: Union[str, pydantic.BaseModel, None] = None) -> str:
+    """Helper for building the callback_data of a button handled under the given key"""
+    query_data = query_routes.get(key)
+    codec = query_data.codec if query_data and query_data.codec else None
+    codec = codec or callbacks.DEFAULT_CODEC
+    return callbacks.encode(key, args, codec)
+
+
 def custom(function: Optional[Callable] = None) -> Callable:
     """Decorator for collecting custom loaders"""
     if not function:
         return functools.partial(custom)
     custom_loaders.append(function)
     return function
+
+
+def discover_plugins(directories: Iterable[pathlib.Path]) -> None:
+    """Registers the plugin packages found in the given directories
+
+    Plugins with a manifest get placeholder routes for their commands and callback
+    keys, which import the plugin the first time they are used.
+    """
+    for directory in directories:
+        directory = pathlib.Path(directory).resolve()
+        if not directory.is_dir():
+            raise exceptions.FloofbotLoaderException(
+                f"Plugin directory not found: {directory}"
+            )
+        for path in sorted(directory.iterdir()):
+            if not (path / "__init__.py").is_file():
+                continue
+            manifest = None
+            manifest_path = path / constants.PLUGIN_MANIFEST_FILENAME
+            if manifest_path.is_file():
+                raw_manifest = (
+                    yaml.load(manifest_path.read_text(), Loader=YAML_LOADER) or dict()
+                )
+                manifest = models.PluginManifest(**{"name": path.name, **raw_manifest})
+            name = manifest.name if manifest else path.name
+            if name in plugins:
+                raise exceptions.FloofbotLoaderException(
+                    f"Duplicate plugin found: {name} ({path})"
+                )
+            builtin = directory == constants.PLUGINS_DIRECTORY
+            if builtin:
+                module = f"{__package__}.plugins.{path.name}"
+            else:
+                module = f"{constants.EXTERNAL_PLUGIN_PACKAGE}.{path.name}"
+            LOG.debug(f"Discovered plugin {name} in {path}")
+            plugins[name] = plugin = models.PluginData(
+                name=name, module=module, path=path, manifest=manifest, builtin=builtin
+            )
+            if manifest:
+                register_plugin_placeholders(plugin)
+
+
+def register_plugin_placeholders(plugin: models.PluginData) -> None:
+    for command_manifest in plugin.manifest.commands:
+        routes = [command_manifest.name] + command_manifest.aliases
+        for route in routes:
+            if command_manifest.name in commands or route.casefold() in command_routes:
+                raise exceptions.FloofbotLoaderException(
+                    f"Duplicate command found: {route} (plugin {plugin.name})"
+                )
+        commands[command_manifest.name] = command_data = models.CommandData(
+            function=_call_placeholder_command,
+            name=command_manifest.name,
+            parse=None,
+            help_data=models.CommandHelpData(
+                name=command_manifest.name,
+                description=command_manifest.help,
+                arguments=dict(),
+            ),
+            aliases=command_manifest.aliases,
+            placeholder_for=plugin.name,
+        )
+        command_data.callback = functools.partial(
+            _call_placeholder_command, plugin.name, command_manifest.name
+        )
+        for route in routes:
+            command_routes[route.casefold()] = command_data
+
+    for key in plugin.manifest.callbacks:
+        if key in query_routes:
+            raise exceptions.FloofbotLoaderException(
+                f"Duplicate callback query key: {key} (plugin {plugin.name})"
+            )
+        query_routes[key] = models.CallbackQueryData(
+            function=_call_placeholder_callback,
+            key=key,
+            parse=None,
+            codec=None,
+            callback=functools.partial(_call_placeholder_callback, plugin.name, key),
+            placeholder_for=plugin.name,
+        )
+    invalidate_help_cache()
+
+
+def _command_placeholders(routes: List[str]) -> List[models.CommandData]:
+    """The placeholders a command registered by a plugin takes over"""
+    placeholders = list()
+    for route in routes:
+        command_data = command_routes.get(route.casefold())
+        if command_data is not None and command_data.placeholder_for:
+            if not any(command_data is it for it in placeholders):
+                placeholders.append(command_data)
+    return placeholders
+
+
+def _call_placeholder_command(
+    plugin_name: str, name: str, update: Update, context: CallbackContext
+) -> Any:
+    import_plugin(plugin_name)
+    command_data = commands.get(name)
+    if command_data is None or command_data.placeholder_for:
+        raise exceptions.FloofbotPluginException(
+            f"Plugin {plugin_name} did not register its command {name}"
+        )
+    return command_data.callback(update, context)
+
+
+def _call_placeholder_callback(
+    plugin_name: str, key: str, update: Update, context: CallbackContext, payload: str
+) -> Any:
+    import_plugin(plugin_name)
+    query_data = query_routes.get(key)
+    if query_data is None or query_data.placeholder_for:
+        raise exceptions.FloofbotPluginException(
+            f"Plugin {plugin_name} did not register its callback query key {key}"
+        )
+    return query_data.callback(update, context, payload)
+
+
+def resolve_command(name: str) -> Optional[models.CommandData]:
+    """Looks up a command by name, importing its plugin if it is not loaded yet"""
+    command_data = commands.get(name)
+    if command_data and command_data.placeholder_for:
+        import_plugin(command_data.placeholder_for)
+        command_data = commands.get(name)
+    return command_data
+
+
+def import_plugin(name: str) -> models.PluginData:
+    """Imports a discovered plugin and sets it up on the bot client, once"""
+    plugin = plugins[name]
+    if plugin.loaded:
+        return plugin
+    with plugin_lock:
+        if plugin.loaded:
+            return plugin
+        started = time.perf_counter()
+        first_custom_loader = len(custom_loaders)
+        known_tables = set(models.ORMBase.metadata.tables)
+        _import_plugin_module(plugin)
+        if client.global_client:
+            client.global_client.setup_plugin(
+                plugin,
+                [
+                    table
+                    for table_name, table in models.ORMBase.metadata.tables.items()
+                    if table_name not in known_tables
+                ],
+                custom_loaders[first_custom_loader:],
+            )
+        plugin.import_time = time.perf_counter() - started
+        plugin.loaded = True
+        LOG.info(f"Imported plugin {name} in {plugin.import_time * 1000:.1f} ms")
+
+    if plugin.manifest and client.global_client:
+        ## Placeholders left behind mean the manifest promises more than the plugin has
+        for command_manifest in plugin.manifest.commands:
+            command_data = commands.get(command_manifest.name)
+            if command_data and command_data.placeholder_for == name:
+                LOG.error(
+                    f"Plugin {name} does not register its command {command_manifest.name}"
+                )
+        for key in plugin.manifest.callbacks:
+            query_data = query_routes.get(key)
+            if query_data and query_data.placeholder_for == name:
+                LOG.error(f"Plugin {name} does not handle its callback query key {key}")
+    return plugin
+
+
+def _import_plugin_module(plugin: models.PluginData) -> None:
+    if plugin.module in sys.modules:
+        return
+    if not plugin.module.startswith(f"{constants.EXTERNAL_PLUGIN_PACKAGE}."):
+        importlib.import_module(plugin.module)
+        return
+
+    ## External plugins are imported as packages, so their relative imports work
+    if constants.EXTERNAL_PLUGIN_PACKAGE not in sys.modules:
+        package = types.ModuleType(constants.EXTERNAL_PLUGIN_PACKAGE)
+        package.__path__ = list()
+        sys.modules[constants.EXTERNAL_PLUGIN_PACKAGE] = package
+    spec = importlib.util.spec_from_file_location(
+        plugin.module,
+        plugin.path / "__init__.py",
+        submodule_search_locations=[str(plugin.path)],
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[plugin.module] = module
+    try:
+        spec.loader.exec_module(module)  # type: ignore
+    except:
+        del sys.modules[plugin.module]
+        raise
+
+
+def plugin_report() -> List[str]:
+    """Describes how long each plugin took to import, for the startup report"""
+    lines = list()
+    for plugin in plugins.values():
+        if plugin.loaded:
+            lines.append(
+                f"{plugin.name}: imported in {plugin.import_time * 1000:.1f} ms"
+            )
+        else:
+            manifest = plugin.manifest
+            lines.append(
+                f"{plugin.name}: deferred until first use ({len(manifest.commands)} "
+                f"commands, {len(manifest.callbacks)} callback keys)"
+            )
+    return lines
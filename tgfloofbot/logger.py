@@ -1,5 +1,13 @@
+import atexit
 import logging
 import logging.config
+import logging.handlers
+import queue
+
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from . import models
 
 
 logging.config.dictConfig(
@@ -30,3 +38,44 @@ logging.config.dictConfig(
     }
 )
 LOG = logging.getLogger("tgfb")
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler for a listener in the same process
+
+    Records are queued as they are, so their messages are formatted by the listener
+    thread instead of the thread that logged them.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(config: "models.Config") -> Optional[logging.handlers.QueueListener]:
+    """Attaches the log file and applies the configured levels
+
+    With ``log_queue`` enabled, the stream and file handlers are moved behind a queue
+    and written by a background listener, which is returned and stopped at exit.
+    """
+    stream_handler = LOG.handlers[0]
+    level = logging.DEBUG if config.debug else logging.INFO
+    ## The logger's level decides whether debug records are created at all
+    LOG.setLevel(level)
+    stream_handler.setLevel(level)
+    file_handler = logging.handlers.RotatingFileHandler(
+        **dict(config.log), encoding="utf-8"
+    )
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(stream_handler.formatter)
+
+    if not config.log_queue:
+        LOG.addHandler(file_handler)
+        return None
+
+    listener = logging.handlers.QueueListener(
+        queue.SimpleQueue(), stream_handler, file_handler, respect_handler_level=True
+    )
+    LOG.handlers = [LocalQueueHandler(listener.queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
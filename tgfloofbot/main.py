@@ -1,38 +1,77 @@
 import argparse
-import logging
 import pathlib
 import sys
 
+from typing import Optional
+
+import sqlalchemy
+import sqlalchemy.orm
 import yaml
 
 from sqlalchemy.sql.schema import MetaData
 
+from . import IMPORT_STARTED
 from . import client
 from . import constants
+from . import exceptions
 from . import models
+from . import profiling
 
-from .logger import LOG
+from .logger import LOG, setup_logging
 
 
-def start(config: models.Config) -> int:
+def start(
+    config: models.Config, startup: Optional[profiling.StartupProfile] = None
+) -> int:
+    startup = startup or profiling.StartupProfile()
 
     ## Setup logging
-    stream_log_handler = LOG.handlers[0]
-    if config.debug:
-        stream_log_handler.setLevel(logging.DEBUG)
-    rotating_log_handler = logging.handlers.RotatingFileHandler(
-        **dict(config.log), encoding="utf-8"
-    )
-    rotating_log_handler.setLevel(logging.DEBUG)
-    rotating_log_handler.setFormatter(stream_log_handler.formatter)
-    LOG.addHandler(rotating_log_handler)
+    setup_logging(config)
+    startup.mark("logging setup")
 
     ## Create bot client instance
-    bot_client = client.TGFloofbotClient(config)
+    try:
+        bot_client = client.TGFloofbotClient(config, startup)
+    except exceptions.FloofbotLoaderException as err:
+        LOG.error(f"The bot cannot start: {err}")
+        return 1
     bot_client.run()
     return 0
 
 
+def export(config: models.Config, parsed: argparse.Namespace) -> int:
+    """Streams the moderation records to a file or stdout, without the Telegram client"""
+    from .plugins.administration import export as records
+
+    try:
+        filters = records.ExportFilter(
+            user_id=parsed.user,
+            since=records.parse_date(parsed.since) if parsed.since else None,
+            until=records.parse_date(parsed.until) if parsed.until else None,
+            forgiven=parsed.forgiven,
+            kind=parsed.kind,
+        )
+    except ValueError as err:
+        print(f"Invalid date: {err}", file=sys.stderr)
+        return 2
+    compress = parsed.gzip or (parsed.output and parsed.output.suffix == ".gz")
+    engine = sqlalchemy.create_engine(f"sqlite:///{config.database.resolve()}")
+    db = sqlalchemy.orm.Session(bind=engine)
+    output = parsed.output.open("wb") if parsed.output else sys.stdout.buffer
+    try:
+        count = records.write_records(
+            records.iter_records(db, filters), output, parsed.format, compress
+        )
+    finally:
+        db.close()
+        if parsed.output:
+            output.close()
+        else:
+            output.flush()
+    print(f"Exported {count} records", file=sys.stderr)
+    return 0
+
+
 def cli_start() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -41,18 +80,64 @@ def cli_start() -> None:
         default="config.yaml",
         help="Path of the config file",
     )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Apply pending database migrations before starting",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Print how long each startup phase took",
+    )
+    subcommands = parser.add_subparsers(dest="command")
+    export_parser = subcommands.add_parser(
+        "export", help="Export the warnings and notes as CSV or JSON lines"
+    )
+    export_parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    export_parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Compress the output, the default if the output file ends with .gz",
+    )
+    export_parser.add_argument(
+        "--output", type=pathlib.Path, help="File to write, stdout if omitted"
+    )
+    export_parser.add_argument("--user", type=int, help="Only this user ID's records")
+    export_parser.add_argument(
+        "--since", help="Records added at or after this ISO date, in UTC if no zone"
+    )
+    export_parser.add_argument(
+        "--until", help="Records added before this ISO date, in UTC if no zone"
+    )
+    export_parser.add_argument(
+        "--forgiven", choices=("include", "only", "exclude"), default="include"
+    )
+    export_parser.add_argument(
+        "--kind", choices=("all", "warnings", "notes"), default="all"
+    )
     parsed = parser.parse_args()
+    startup = profiling.StartupProfile(IMPORT_STARTED, enabled=parsed.profile_startup)
+    startup.mark("imports")
     try:
         raw_config = yaml.safe_load(parsed.config.read_text())
         config = models.Config(**raw_config)
     except Exception as err:
         LOG.exception("Config file cannot loaded:")
         sys.exit(1)
-    sys.exit(start(config))
+    if parsed.command == "export":
+        sys.exit(export(config, parsed))
+    if parsed.migrate:
+        config.database_options.auto_migrate = True
+    startup.mark("config parse")
+    sys.exit(start(config, startup))
 
 
 def load_db_metadata() -> MetaData:
-    """Helper function for loading DB models and returning the """
-    from . import plugins
+    """Helper function for loading DB models and returning the"""
+    from . import loader
 
+    loader.discover_plugins([constants.PLUGINS_DIRECTORY])
+    for plugin_name in loader.plugins:
+        loader.import_plugin(plugin_name)
     return models.ORMBase.metadata
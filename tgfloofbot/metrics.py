@@ -0,0 +1,359 @@
+import bisect
+import collections
+import http.server
+import threading
+import time
+
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import telegram
+
+from .logger import LOG
+
+
+## Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+HANDLER_SECONDS = "tgfb_handler_seconds"
+API_CALL_SECONDS = "tgfb_api_call_seconds"
+API_CALLS = "tgfb_api_calls_total"
+API_ERRORS = "tgfb_api_errors_total"
+ERRORS = "tgfb_errors_total"
+
+## Help text and label names of each metric, in the order of their label values
+METRICS = {
+    HANDLER_SECONDS: (
+        "Time spent handling commands and callback queries",
+        ("kind", "name", "phase"),
+    ),
+    API_CALL_SECONDS: ("Duration of Bot API calls", ("method",)),
+    API_CALLS: ("Bot API calls, by the command that made them", ("command", "method")),
+    API_ERRORS: ("Failed Bot API calls", ("method", "error")),
+    ERRORS: ("Errors caught by the error handler", ("exception",)),
+}
+
+Labels = Tuple[str, ...]
+
+_context = threading.local()
+
+
+def current_command() -> Optional[str]:
+    """Name of the command being handled on this thread, if any"""
+    return getattr(_context, "command", None)
+
+
+class command_scope:
+    """Attributes the Bot API calls made on this thread to ``command``"""
+
+    __slots__ = ("command", "previous")
+
+    def __init__(self, command: Optional[str]):
+        self.command = command
+
+    def __enter__(self) -> None:
+        self.previous = getattr(_context, "command", None)
+        _context.command = self.command
+
+    def __exit__(self, *exc_info: Any) -> None:
+        _context.command = self.previous
+
+
+class Histogram:
+    """Cumulative bucket histogram in the style of Prometheus"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        ## The last slot counts values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by interpolating within its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (
+                    (rank - seen) / bucket_count
+                )
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class LatencyWindow:
+    """The last ``size`` observed durations, for exact quantiles of recent activity"""
+
+    def __init__(self, size: int = 1024):
+        self.values: Deque[float] = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.values.append(value)
+
+    def quantiles(self, *qs: float) -> List[float]:
+        with self._lock:
+            values = sorted(self.values)
+        if not values:
+            return [0.0 for _ in qs]
+        return [values[min(len(values) - 1, int(q * len(values)))] for q in qs]
+
+
+class HandlerTimer:
+    """Times one command or callback query, along with the phases inside it"""
+
+    __slots__ = ("metrics", "kind", "name", "started")
+
+    def __init__(self, metrics: "Metrics", kind: str, name: str):
+        self.metrics = metrics
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self) -> "HandlerTimer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.metrics.observe(
+            HANDLER_SECONDS,
+            (self.kind, self.name, "total"),
+            time.perf_counter() - self.started,
+        )
+
+    def phase(self, phase: str) -> "PhaseTimer":
+        return PhaseTimer(self.metrics, (self.kind, self.name, phase))
+
+
+class PhaseTimer:
+    __slots__ = ("metrics", "labels", "started")
+
+    def __init__(self, metrics: "Metrics", labels: Labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.metrics.observe(
+            HANDLER_SECONDS, self.labels, time.perf_counter() - self.started
+        )
+
+
+class Metrics:
+    """In-process latency histograms and counters, with Prometheus text output
+
+    Gauges are not stored, they are read from collectors, such as the outbound queue's
+    stats(), whenever the metrics are rendered.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = dict()
+        self.counters: Dict[Tuple[str, Labels], float] = dict()
+        self.collectors: Dict[str, Callable[[], Dict[str, Any]]] = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, metric: str, labels: Labels, value: float) -> None:
+        key = (metric, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, metric: str, labels: Labels, amount: float = 1) -> None:
+        key = (metric, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def timer(self, kind: str, name: str) -> HandlerTimer:
+        return HandlerTimer(self, kind, name)
+
+    def add_collector(self, prefix: str, collect: Callable[[], Dict[str, Any]]) -> None:
+        """Exposes the numeric values of ``collect()`` as gauges named after prefix"""
+        self.collectors[prefix] = collect
+
+    def instrument_bot(self, bot: telegram.Bot) -> None:
+        """Counts and times every Bot API call made through ``bot``"""
+        post = bot._post
+
+        def instrumented_post(endpoint: str, *args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return post(endpoint, *args, **kwargs)
+            except Exception as err:
+                self.inc(API_ERRORS, (endpoint, type(err).__name__))
+                raise
+            finally:
+                self.observe(
+                    API_CALL_SECONDS, (endpoint,), time.perf_counter() - started
+                )
+                self.inc(API_CALLS, (current_command() or "", endpoint))
+
+        bot._post = instrumented_post  # type: ignore
+
+    def snapshot(
+        self,
+    ) -> Tuple[Dict[Tuple[str, Labels], Histogram], Dict[Tuple[str, Labels], float]]:
+        """Copies of the histograms and counters, taken under the lock"""
+        with self._lock:
+            histograms = dict()
+            for key, histogram in self.histograms.items():
+                copy = histograms[key] = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.sum, copy.count = histogram.sum, histogram.count
+            return histograms, dict(self.counters)
+
+    def collect(self) -> Dict[str, Dict[str, float]]:
+        """Reads the numeric values of every collector, keyed by collector prefix"""
+        collected = dict()
+        for prefix, collect in self.collectors.items():
+            try:
+                values = collect()
+            except Exception:
+                LOG.exception(f"Metrics collector {prefix} failed:")
+                continue
+            collected[prefix] = {
+                name: value
+                for name, value in values.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            }
+        return collected
+
+    def gauges(self) -> Dict[str, float]:
+        return {
+            f"tgfb_{prefix}_{name}": value
+            for prefix, values in self.collect().items()
+            for name, value in values.items()
+        }
+
+    def render_prometheus(self) -> str:
+        """Renders every metric in the Prometheus text exposition format"""
+        histograms, counters = self.snapshot()
+        lines: List[str] = list()
+        for metric, (help_text, label_names) in METRICS.items():
+            metric_histograms = [
+                (labels, histogram)
+                for (name, labels), histogram in sorted(histograms.items())
+                if name == metric
+            ]
+            metric_counters = [
+                (labels, value)
+                for (name, labels), value in sorted(counters.items())
+                if name == metric
+            ]
+            if not metric_histograms and not metric_counters:
+                continue
+            metric_type = "histogram" if metric_histograms else "counter"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for labels, histogram in metric_histograms:
+                label_text = _labels(label_names, labels)
+                cumulative = 0
+                for bucket, count in zip(
+                    histogram.buckets + (float("inf"),), histogram.counts
+                ):
+                    cumulative += count
+                    bound = "+Inf" if bucket == float("inf") else repr(bucket)
+                    bucket_labels = _labels(label_names + ("le",), labels + (bound,))
+                    lines.append(f"{metric}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{metric}_sum{label_text} {histogram.sum}")
+                lines.append(f"{metric}_count{label_text} {histogram.count}")
+            for labels, value in metric_counters:
+                lines.append(f"{metric}{_labels(label_names, labels)} {value}")
+
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names: Tuple[str, ...], values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    server: "MetricsServer"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Serves the metrics at /metrics for Prometheus to scrape"""
+
+    daemon_threads = True
+
+    def __init__(self, metrics: Metrics, listen: str, port: int):
+        super().__init__((listen, port), MetricsRequestHandler)
+        self.metrics = metrics
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="tgfb-metrics", daemon=True
+        )
+        self._thread.start()
+        LOG.info(
+            f"Serving metrics on {self.server_address[0]}:{self.server_address[1]}"
+        )
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        self._thread = None
@@ -6,6 +6,7 @@ from typing import Any, Callable, Dict, List, Optional
 
 import pydantic
 
+from sqlalchemy import Column, DateTime, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 
 
@@ -13,6 +14,36 @@ from sqlalchemy.ext.declarative import declarative_base
 ORMBase = declarative_base()
 
 
+class User(ORMBase):
+    """Users the bot has seen, so IDs and usernames resolve without Bot API calls"""
+
+    __tablename__ = "tg_users"
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    ## Telegram usernames are case insensitive
+    username = Column(String(collation="NOCASE"), nullable=True)
+    full_name = Column(String(), nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+
+    __table_args__ = (Index("ix_tg_users_username", "username", "last_seen"),)
+
+
+class UpdateOffset(ORMBase):
+    """How far update handling got, kept in a single row"""
+
+    __tablename__ = "tg_update_offset"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    ## Every update up to this ID has been handled
+    last_processed = Column(Integer, nullable=False)
+    last_received = Column(Integer, nullable=False)
+
+
+class UpdateInFlight(ORMBase):
+    """Updates that were received but not fully handled at the last flush"""
+
+    __tablename__ = "tg_updates_in_flight"
+    update_id = Column(Integer, primary_key=True, autoincrement=False)
+
+
 class LogFileConfig(pydantic.BaseModel):
     filename: pathlib.Path = pydantic.Field(
         pathlib.Path("bot.log"), description="Location of the log file"
@@ -21,15 +52,328 @@ class LogFileConfig(pydantic.BaseModel):
     backupCount: int = pydantic.Field(5, description="Number of log rotations")
 
 
+class DatabaseConfig(pydantic.BaseModel):
+    echo: bool = pydantic.Field(False, description="Log every SQL statement")
+    pool_size: int = pydantic.Field(
+        8, description="Number of pooled database connections"
+    )
+    wal: bool = pydantic.Field(True, description="Use SQLite's write-ahead log")
+    synchronous: str = pydantic.Field(
+        "NORMAL", description="SQLite synchronous pragma (OFF, NORMAL, FULL)"
+    )
+    busy_timeout: int = pydantic.Field(
+        5000, description="Milliseconds to wait for a locked database"
+    )
+    mmap_size: int = pydantic.Field(
+        64 * 1024 * 1024, description="Bytes of the database file to memory map"
+    )
+    auto_migrate: bool = pydantic.Field(
+        False, description="Apply pending migrations at startup instead of exiting"
+    )
+
+    @pydantic.validator("synchronous")
+    def check_synchronous(cls, value: str) -> str:
+        value = value.upper()
+        if value not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Unsupported synchronous mode: {value}")
+        return value
+
+
+class MetricsConfig(pydantic.BaseModel):
+    listen: str = pydantic.Field(
+        "127.0.0.1", description="Address the metrics endpoint listens on"
+    )
+    port: Optional[int] = pydantic.Field(
+        None, description="Port of the Prometheus metrics endpoint, off if unset"
+    )
+
+
+class PluginConfig(pydantic.BaseModel):
+    directories: List[pathlib.Path] = pydantic.Field(
+        list(), description="Extra directories to load plugins from"
+    )
+    lazy: bool = pydantic.Field(
+        True, description="Import plugins with a manifest when they are first used"
+    )
+
+
+class WriteBehindConfig(pydantic.BaseModel):
+    enabled: bool = pydantic.Field(
+        False, description="Batch moderation record inserts on a background thread"
+    )
+    batch_size: int = pydantic.Field(
+        100, description="Number of pending inserts that triggers a flush"
+    )
+    flush_interval: float = pydantic.Field(
+        1.0, description="Max seconds an insert waits before being flushed"
+    )
+
+
+class WebhookConfig(pydantic.BaseModel):
+    url: Optional[str] = pydantic.Field(
+        None, description="Public HTTPS URL that Telegram delivers updates to"
+    )
+    listen: str = pydantic.Field("127.0.0.1", description="Address to listen on")
+    port: int = pydantic.Field(8443, description="Port to listen on")
+    path: str = pydantic.Field("/telegram", description="URL path to accept updates on")
+    secret_token: Optional[str] = pydantic.Field(
+        None, description="Secret Telegram must send with every update"
+    )
+    max_connections: int = pydantic.Field(
+        40, description="Max simultaneous update deliveries"
+    )
+    queue_size: int = pydantic.Field(
+        1000, description="Max number of received updates waiting to be dispatched"
+    )
+    queue_timeout: float = pydantic.Field(
+        1.0, description="Seconds to wait for room in a full update queue"
+    )
+    max_body_size: int = pydantic.Field(
+        1_000_000, description="Max size of one update request in bytes"
+    )
+
+
+class OutboundConfig(pydantic.BaseModel):
+    per_chat_rate: float = pydantic.Field(
+        1.0, description="Messages per second sent to a single chat"
+    )
+    per_chat_burst: float = pydantic.Field(
+        3.0, description="Messages that may be sent to one chat in a burst"
+    )
+    global_rate: float = pydantic.Field(
+        30.0, description="Messages per second sent across all chats"
+    )
+    global_burst: float = pydantic.Field(
+        1.0, description="Messages that may be sent across all chats in a burst"
+    )
+    senders: int = pydantic.Field(4, description="Number of sender threads")
+    max_retries: int = pydantic.Field(
+        3, description="Retries of a message after rate limit or network errors"
+    )
+    wait_timeout: float = pydantic.Field(
+        30.0, description="Seconds a command waits for a queued Bot API call"
+    )
+
+
+class WorkerPoolConfig(pydantic.BaseModel):
+    workers: int = pydantic.Field(
+        8, description="Command worker threads, 0 runs commands on the dispatcher"
+    )
+    batch_size: int = pydantic.Field(
+        16, description="Commands a worker runs for one chat before serving others"
+    )
+
+
+class UserDirectoryConfig(pydantic.BaseModel):
+    cache_size: int = pydantic.Field(
+        10_000, description="Max number of users kept in memory"
+    )
+    flush_interval: float = pydantic.Field(
+        5.0, description="Max seconds a changed user waits before being written"
+    )
+    touch_interval: float = pydantic.Field(
+        3600.0, description="Min seconds between last_seen updates of an unchanged user"
+    )
+    message_index_size: int = pydantic.Field(
+        10_000, description="Max number of group messages whose replies are remembered"
+    )
+    message_index_ttl: float = pydantic.Field(
+        86400.0, description="Seconds the replies and forwards of a message are kept"
+    )
+
+
+class UpdateTrackingConfig(pydantic.BaseModel):
+    enabled: bool = pydantic.Field(
+        True, description="Persist the update offset and skip already handled updates"
+    )
+    flush_interval: float = pydantic.Field(
+        0.5, description="Max seconds between writes of the update offset"
+    )
+
+
+class ShardingConfig(pydantic.BaseModel):
+    shards: int = pydantic.Field(
+        0, description="Processes that updates are partitioned across by chat, 0 is off"
+    )
+
+
+class AdminCacheConfig(pydantic.BaseModel):
+    ttl: float = pydantic.Field(
+        300.0, description="Seconds an admin status lookup stays cached"
+    )
+    max_size: int = pydantic.Field(
+        10_000, description="Max number of cached (group, user) admin statuses"
+    )
+    refresh_interval: float = pydantic.Field(
+        60.0,
+        description="Seconds between refreshes of the administrator lists, 0 disables",
+    )
+
+
+class ErrorReportingConfig(pydantic.BaseModel):
+    window: float = pydantic.Field(
+        60.0, description="Seconds a chat gets at most one reply per kind of error"
+    )
+    recent_errors: int = pydantic.Field(
+        200, description="Max number of recent errors kept for /errors"
+    )
+    breaker_threshold: int = pydantic.Field(
+        5, description="Failed Bot API sends in a row that pause error replies"
+    )
+    breaker_cooldown: float = pydantic.Field(
+        30.0, description="Seconds error replies stay paused before a retry"
+    )
+
+
+class EscalationStep(pydantic.BaseModel):
+    warnings: int = pydantic.Field(
+        ..., description="Unforgiven warnings within the window that trigger the step"
+    )
+    action: str = pydantic.Field(..., description="What happens: mute or ban")
+    duration: Optional[float] = pydantic.Field(
+        None, description="Seconds the mute or ban lasts, forever if omitted"
+    )
+
+    @pydantic.validator("action")
+    def check_action(cls, value: str) -> str:
+        if value not in ("mute", "ban"):
+            raise ValueError(f"Unsupported escalation action: {value}")
+        return value
+
+
+class EscalationConfig(pydantic.BaseModel):
+    window: float = pydantic.Field(
+        30 * 86400.0, description="Seconds a warning counts towards escalation"
+    )
+    steps: List[EscalationStep] = pydantic.Field(
+        list(), description="Actions taken in the main group as warnings add up"
+    )
+
+
+class FloodRule(pydantic.BaseModel):
+    count: int = pydantic.Field(
+        ..., description="Events within the window that trigger the rule"
+    )
+    window: float = pydantic.Field(..., description="Seconds the events are counted in")
+    actions: List[str] = pydantic.Field(
+        list(), description="What happens: any of restrict, delete and alert"
+    )
+    duration: Optional[float] = pydantic.Field(
+        600.0, description="Seconds a restriction lasts, forever if null"
+    )
+
+    @pydantic.validator("count")
+    def check_count(cls, value: int) -> int:
+        if value < 1:
+            raise ValueError("A flood rule needs a count of at least 1")
+        return value
+
+    @pydantic.validator("duration")
+    def check_duration(cls, value: Optional[float]) -> Optional[float]:
+        ## Telegram makes shorter restrictions permanent
+        if value is not None and value < 30:
+            raise ValueError("Restrictions must last at least 30 seconds, or be null")
+        return value
+
+    @pydantic.validator("actions", each_item=True)
+    def check_action(cls, value: str) -> str:
+        if value not in ("restrict", "delete", "alert"):
+            raise ValueError(f"Unsupported anti-flood action: {value}")
+        return value
+
+
+class AntiFloodConfig(pydantic.BaseModel):
+    enabled: bool = pydantic.Field(
+        True, description="Watch the main group for floods and raids"
+    )
+    flood: Optional[FloodRule] = pydantic.Field(
+        FloodRule(count=10, window=10.0, actions=["alert"]),
+        description="Messages from a single user, disabled if null",
+    )
+    repeats: Optional[FloodRule] = pydantic.Field(
+        FloodRule(count=5, window=60.0, actions=["alert"]),
+        description="Copies of the same text from anyone, disabled if null",
+    )
+    joins: Optional[FloodRule] = pydantic.Field(
+        FloodRule(count=10, window=60.0, actions=["alert"]),
+        description="Users joining the group, disabled if null",
+    )
+    repeat_min_length: int = pydantic.Field(
+        30, description="Shorter texts are not checked for repeats"
+    )
+    max_tracked: int = pydantic.Field(
+        10_000, description="Max number of users or texts tracked per rule"
+    )
+
+
 class Config(pydantic.BaseSettings):
     token: str = pydantic.Field(..., description="Telegram bot API token")
     debug: bool = pydantic.Field(False, description="Show debug output")
     log: LogFileConfig = pydantic.Field(LogFileConfig(), description="Log config")
+    log_queue: bool = pydantic.Field(
+        True, description="Write log output from a background thread"
+    )
+    base_url: str = pydantic.Field(
+        "https://api.telegram.org/bot", description="Bot API server base URL"
+    )
+    ingest: str = pydantic.Field(
+        "polling", description="How updates are received: polling or webhook"
+    )
+    webhook: WebhookConfig = pydantic.Field(
+        WebhookConfig(), description="Webhook listener config"
+    )
     database: pathlib.Path = pydantic.Field(..., description="Database file path")
+    database_options: DatabaseConfig = pydantic.Field(
+        DatabaseConfig(), description="Database engine config"
+    )
     main_group: int = pydantic.Field(..., description="The main group ID")
     admin_groups: List[int] = pydantic.Field(
         list(), description="Admin group IDs for the main group"
     )
+    write_behind: WriteBehindConfig = pydantic.Field(
+        WriteBehindConfig(), description="Write-behind queue config"
+    )
+    admin_cache: AdminCacheConfig = pydantic.Field(
+        AdminCacheConfig(), description="Admin status cache config"
+    )
+    error_reporting: ErrorReportingConfig = pydantic.Field(
+        ErrorReportingConfig(), description="Error reply deduplication config"
+    )
+    escalation: EscalationConfig = pydantic.Field(
+        EscalationConfig(), description="Automatic escalation of repeated warnings"
+    )
+    antiflood: AntiFloodConfig = pydantic.Field(
+        AntiFloodConfig(), description="Flood and raid detection in the main group"
+    )
+    user_directory: UserDirectoryConfig = pydantic.Field(
+        UserDirectoryConfig(), description="User directory config"
+    )
+    update_tracking: UpdateTrackingConfig = pydantic.Field(
+        UpdateTrackingConfig(), description="Update offset persistence config"
+    )
+    outbound: OutboundConfig = pydantic.Field(
+        OutboundConfig(), description="Outgoing message rate limit config"
+    )
+    worker_pool: WorkerPoolConfig = pydantic.Field(
+        WorkerPoolConfig(), description="Command worker pool config"
+    )
+    plugins: PluginConfig = pydantic.Field(
+        PluginConfig(), description="Plugin loading config"
+    )
+    sharding: ShardingConfig = pydantic.Field(
+        ShardingConfig(), description="Multi-process sharding config"
+    )
+    metrics: MetricsConfig = pydantic.Field(
+        MetricsConfig(), description="Metrics endpoint config"
+    )
+
+    @pydantic.root_validator(skip_on_failure=True)
+    def check_ingest(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values["ingest"] not in ("polling", "webhook"):
+            raise ValueError(f"Unsupported ingest mode: {values['ingest']}")
+        if values["ingest"] == "webhook" and not values["webhook"].url:
+            raise ValueError("Webhook ingest requires webhook.url")
+        return values
 
 
 @dataclasses.dataclass
@@ -54,6 +398,70 @@ class CommandData:
     name: str
     parse: Optional[pydantic.BaseModel]
     help_data: Optional[CommandHelpData]
+    aliases: List[str] = dataclasses.field(default_factory=list)
+    callback: Optional[Callable] = None
+    pooled: bool = True
+    ## Name of the plugin whose manifest declared the command, if it is not loaded yet
+    placeholder_for: Optional[str] = None
+
+
+@dataclasses.dataclass
+class CallbackQueryData:
+    function: Callable
+    key: str
+    parse: Any
+    codec: Any
+    callback: Optional[Callable] = None
+    ## Name of the plugin whose manifest declared the key, if it is not loaded yet
+    placeholder_for: Optional[str] = None
+
+
+class PluginCommandManifest(pydantic.BaseModel):
+    name: str = pydantic.Field(..., description="Command name")
+    help: Optional[str] = pydantic.Field(None, description="Short help text")
+    aliases: List[str] = pydantic.Field(list(), description="Command aliases")
+
+
+class PluginManifest(pydantic.BaseModel):
+    """Contents of a plugin's plugin.yaml, which lets the plugin be imported lazily"""
+
+    name: str = pydantic.Field(..., description="Plugin name")
+    description: Optional[str] = pydantic.Field(None, description="Plugin description")
+    commands: List[PluginCommandManifest] = pydantic.Field(
+        list(), description="Commands registered by the plugin"
+    )
+    callbacks: List[str] = pydantic.Field(
+        list(), description="Callback query keys handled by the plugin"
+    )
+    eager: bool = pydantic.Field(
+        False, description="Import the plugin at startup even when loading is lazy"
+    )
+
+
+@dataclasses.dataclass
+class PluginData:
+    name: str
+    module: str
+    path: pathlib.Path
+    manifest: Optional[PluginManifest]
+    ## Built-in plugins have their tables managed by the migrations
+    builtin: bool = False
+    loaded: bool = False
+    import_time: Optional[float] = None
+
+
+@dataclasses.dataclass
+class UserRecord:
+    id: int
+    username: Optional[str]
+    full_name: str
+    ## Unix timestamp of when the user was last seen
+    last_seen: float
+
+    @property
+    def name(self) -> str:
+        """The @username if the user has one, otherwise the full name"""
+        return f"@{self.username}" if self.username else self.full_name
 
 
 @dataclasses.dataclass
@@ -0,0 +1,416 @@
+import concurrent.futures
+import dataclasses
+import heapq
+import itertools
+import threading
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import telegram
+
+from . import metrics
+
+from .logger import LOG
+
+
+## Message priorities, lower values are sent first
+PRIORITY_MODERATION = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_COSMETIC = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_MODERATION: "moderation",
+    PRIORITY_DEFAULT: "default",
+    PRIORITY_COSMETIC: "cosmetic",
+}
+
+## Calls retried after a timeout. Telegram may have carried out the timed out attempt,
+## so only calls whose repetition changes nothing are safe to send again
+RETRY_ON_TIMEOUT = frozenset(
+    (
+        "restrict_chat_member",
+        "kick_chat_member",
+        "unban_chat_member",
+        "get_chat",
+        "get_chat_member",
+        "get_chat_administrators",
+    )
+)
+
+
+class TokenBucket:
+    """Token bucket that allows ``rate`` events per second with bursts of ``capacity``"""
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundFuture(concurrent.futures.Future):
+    """Future of a queued Bot API call, which can be cancelled until an attempt starts
+
+    A plain future cannot be cancelled once it runs, this one can also be cancelled
+    while its call waits to be retried. Cancelling it during an attempt stops the
+    call from being retried if that attempt fails. The future stays pending until
+    the last attempt finished.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._attempt_lock = threading.Lock()
+        self._attempting = False
+        self._cancel_requested = False
+
+    def cancel(self) -> bool:
+        with self._attempt_lock:
+            if self._attempting:
+                self._cancel_requested = True
+                return False
+            return super().cancel()
+
+    def begin_attempt(self) -> bool:
+        """Marks an attempt as under way, returns False if the call was cancelled"""
+        with self._attempt_lock:
+            if self.cancelled():
+                return False
+            self._attempting = True
+            return True
+
+    def end_attempt(self) -> bool:
+        """Ends a failed attempt before a retry, returns False if the call was cancelled
+
+        A cancellation requested during the attempt takes effect now.
+        """
+        with self._attempt_lock:
+            self._attempting = False
+            if self._cancel_requested:
+                super().cancel()
+                return False
+            return True
+
+
+@dataclasses.dataclass(order=True)
+class OutboundJob:
+    priority: int
+    seq: int
+    chat_id: Any = dataclasses.field(compare=False)
+    method: str = dataclasses.field(compare=False)
+    kwargs: Dict[str, Any] = dataclasses.field(compare=False)
+    future: OutboundFuture = dataclasses.field(compare=False)
+    submitted: float = dataclasses.field(compare=False)
+    attempts: int = dataclasses.field(default=0, compare=False)
+    ## Command that queued the message, so its API calls are attributed to it
+    source: Optional[str] = dataclasses.field(default=None, compare=False)
+
+
+@dataclasses.dataclass
+class ChatState:
+    bucket: TokenBucket
+    pending: List[OutboundJob] = dataclasses.field(default_factory=list)
+    in_flight: bool = False
+    not_before: float = 0.0
+    idle_since: Optional[float] = None
+
+
+class OutboundQueue:
+    """Central pipeline for outgoing messages that stays within Telegram's rate limits
+
+    Each chat gets its own token bucket and the bot as a whole a global one. Messages to
+    the same chat are sent one at a time in priority order, a ``RetryAfter`` answer
+    pauses the affected chat for the requested time before the message is retried, and
+    different chats are served concurrently by a small pool of sender threads.
+    """
+
+    def __init__(
+        self,
+        bot: telegram.Bot,
+        per_chat_rate: float = 1.0,
+        per_chat_burst: float = 3.0,
+        global_rate: float = 30.0,
+        global_burst: float = 1.0,
+        senders: int = 4,
+        max_retries: int = 3,
+        idle_chat_timeout: float = 60.0,
+    ):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.idle_chat_timeout = idle_chat_timeout
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        self.chats: Dict[Any, ChatState] = dict()
+        ## Entries are (priority, seq, chat_id) for chats whose next message can be sent
+        self._ready: List[Tuple[int, int, Any]] = list()
+        ## Entries are (not_before, priority, seq, chat_id) for paused chats
+        self._waiting: List[Tuple[float, int, int, Any]] = list()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=senders, thread_name_prefix="tgfb-sender"
+        )
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.counters = {
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "rate_limited": 0,
+            "cancelled": 0,
+        }
+        self.pending_by_priority = {priority: 0 for priority in PRIORITY_NAMES}
+        self.in_flight = 0
+        self.max_queue_delay = 0.0
+
+    @property
+    def depth(self) -> int:
+        return sum(self.pending_by_priority.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of the queue depth and delivery counters"""
+        with self._condition:
+            return {
+                "pending": self.depth,
+                "pending_by_priority": {
+                    PRIORITY_NAMES[priority]: count
+                    for priority, count in self.pending_by_priority.items()
+                },
+                "in_flight": self.in_flight,
+                "chats": len(self.chats),
+                "max_queue_delay": self.max_queue_delay,
+                **self.counters,
+            }
+
+    def start(self) -> None:
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="tgfb-outbound", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Sends what is still queued, waiting at most ``timeout`` seconds, then stops"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while (self.depth or self.in_flight) and time.monotonic() < deadline:
+                self._condition.wait(min(0.1, max(0, deadline - time.monotonic())))
+            self._running = False
+            self._condition.notify_all()
+            dropped = [job for chat in self.chats.values() for job in chat.pending]
+            for chat in self.chats.values():
+                chat.pending.clear()
+            for priority in self.pending_by_priority:
+                self.pending_by_priority[priority] = 0
+        for job in dropped:
+            if not job.future.begin_attempt():
+                continue
+            job.future.set_exception(
+                RuntimeError("The outbound queue stopped before the message was sent")
+            )
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+    def submit(
+        self,
+        method: str,
+        chat_id: Any,
+        priority: int = PRIORITY_DEFAULT,
+        **kwargs: Any,
+    ) -> OutboundFuture:
+        """Queues a Bot API call on a chat, returning a future for its result"""
+        now = time.monotonic()
+        future = OutboundFuture()
+        job = OutboundJob(
+            priority=priority,
+            seq=next(self._sequence),
+            chat_id=chat_id,
+            method=method,
+            kwargs=dict(kwargs, chat_id=chat_id),
+            future=future,
+            submitted=now,
+            source=metrics.current_command(),
+        )
+        with self._condition:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = ChatState(
+                    TokenBucket(self.per_chat_rate, self.per_chat_burst, now)
+                )
+            chat.idle_since = None
+            heapq.heappush(chat.pending, job)
+            self.pending_by_priority[priority] += 1
+            if not chat.in_flight and chat.pending[0] is job:
+                self._schedule(chat_id, chat, now)
+            self._condition.notify()
+        return future
+
+    def send_message(
+        self, chat_id: Any, text: str, priority: int = PRIORITY_DEFAULT, **kwargs: Any
+    ) -> OutboundFuture:
+        return self.submit("send_message", chat_id, priority, text=text, **kwargs)
+
+    def _schedule(self, chat_id: Any, chat: ChatState, now: float) -> None:
+        head = chat.pending[0]
+        if chat.not_before > now:
+            heapq.heappush(
+                self._waiting, (chat.not_before, head.priority, head.seq, chat_id)
+            )
+        else:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+    def _run(self) -> None:
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                while self._waiting and self._waiting[0][0] <= now:
+                    _, priority, seq, chat_id = heapq.heappop(self._waiting)
+                    heapq.heappush(self._ready, (priority, seq, chat_id))
+
+                timeout = self._dispatch_ready(now)
+                if self._waiting:
+                    next_wake = self._waiting[0][0] - now
+                    timeout = next_wake if timeout is None else min(timeout, next_wake)
+                if timeout is None or timeout > 0:
+                    self._condition.wait(timeout)
+
+    def _dispatch_ready(self, now: float) -> Optional[float]:
+        """Hands eligible messages to the senders, returns how long to wait otherwise"""
+        while self._ready:
+            priority, seq, chat_id = self._ready[0]
+            chat = self.chats.get(chat_id)
+            if (
+                chat is None
+                or chat.in_flight
+                or not chat.pending
+                or chat.pending[0].seq != seq
+            ):
+                ## Stale entry, the chat was rescheduled after this entry was queued
+                heapq.heappop(self._ready)
+                continue
+
+            chat_delay = chat.bucket.delay(now)
+            if chat_delay > 0:
+                heapq.heappop(self._ready)
+                chat.not_before = now + chat_delay
+                heapq.heappush(self._waiting, (chat.not_before, priority, seq, chat_id))
+                continue
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                return global_delay
+
+            heapq.heappop(self._ready)
+            job = heapq.heappop(chat.pending)
+            self.pending_by_priority[job.priority] -= 1
+            if not job.future.begin_attempt():
+                ## The caller stopped waiting for the call before it was sent
+                self.counters["cancelled"] += 1
+                if chat.pending:
+                    self._schedule(chat_id, chat, now)
+                else:
+                    chat.idle_since = now
+                continue
+            chat.bucket.take(now)
+            self.global_bucket.take(now)
+            chat.in_flight = True
+            self.in_flight += 1
+            self.max_queue_delay = max(self.max_queue_delay, now - job.submitted)
+            self._executor.submit(self._send, job)
+
+        self._purge_idle_chats(now)
+        return None
+
+    def _purge_idle_chats(self, now: float) -> None:
+        if len(self.chats) < 1024:
+            return
+        for chat_id in [
+            chat_id
+            for chat_id, chat in self.chats.items()
+            if chat.idle_since is not None
+            and now - chat.idle_since > self.idle_chat_timeout
+            and chat.bucket.full(now)
+        ]:
+            del self.chats[chat_id]
+
+    def _send(self, job: OutboundJob) -> None:
+        job.attempts += 1
+        result = error = retry_after = None
+        try:
+            with metrics.command_scope(job.source):
+                result = getattr(self.bot, job.method)(**job.kwargs)
+        except telegram.error.RetryAfter as err:
+            error, retry_after = err, float(err.retry_after)
+        except telegram.error.BadRequest as err:
+            ## Rejected requests fail the same way when retried
+            error = err
+        except telegram.error.TimedOut as err:
+            error = err
+            if job.method in RETRY_ON_TIMEOUT:
+                retry_after = min(2.0**job.attempts, 30.0)
+        except telegram.error.NetworkError as err:
+            error, retry_after = err, min(2.0**job.attempts, 30.0)
+        except Exception as err:
+            error = err
+
+        retrying = retry_after is not None and job.attempts <= self.max_retries
+        cancelled = retrying and not job.future.end_attempt()
+        retrying = retrying and not cancelled
+        with self._condition:
+            now = time.monotonic()
+            chat = self.chats[job.chat_id]
+            chat.in_flight = False
+            self.in_flight -= 1
+            if isinstance(error, telegram.error.RetryAfter):
+                self.counters["rate_limited"] += 1
+            if cancelled:
+                self.counters["cancelled"] += 1
+            elif retrying:
+                self.counters["retried"] += 1
+                chat.not_before = now + retry_after
+                heapq.heappush(chat.pending, job)
+                self.pending_by_priority[job.priority] += 1
+            elif error is not None:
+                self.counters["failed"] += 1
+            else:
+                self.counters["sent"] += 1
+
+            if chat.pending:
+                self._schedule(job.chat_id, chat, now)
+            else:
+                chat.idle_since = now
+            self._condition.notify_all()
+
+        if cancelled:
+            LOG.debug(f"Sending {job.method} to {job.chat_id} was cancelled ({error})")
+        elif retrying:
+            LOG.warning(
+                f"Sending {job.method} to {job.chat_id} failed ({error}), "
+                f"retrying in {retry_after}s"
+            )
+        elif error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
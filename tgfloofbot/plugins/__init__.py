@@ -1,2 +0,0 @@
-from . import administration
-from . import extra
@@ -1,6 +1,9 @@
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
+import concurrent.futures
 import pydantic
+import tempfile
+import threading
 import telegram
 import datetime
 import typing
@@ -9,26 +12,57 @@ from datetime import timezone
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode
 from telegram.ext import CallbackContext, CallbackQueryHandler
 
+from ... import helpers
 from ... import loader
+from ... import outbound
 
 from ...client import TGFloofbotClient
+from ...exceptions import OutboundTimeoutException
 from ...helpers import em
+from ...models import EscalationStep, UserRecord
 from ...logger import LOG
 
 from . import models
+from . import escalation
 from . import exceptions
+from . import export
+from . import history
 
 
 class WarnCommandArgs(pydantic.BaseModel):
-    bad_user: str = pydantic.Field(..., description="A raw user ID")
+    bad_user: str = pydantic.Field(..., description="A raw user ID or @username")
     warn_message: str = pydantic.Field(..., description="The warning reason")
 
 
 class UsernoteCommandArgs(pydantic.BaseModel):
-    bad_user: str = pydantic.Field(..., description="A raw user ID")
+    bad_user: str = pydantic.Field(..., description="A raw user ID or @username")
     warn_message: str = pydantic.Field(..., description="The note")
 
 
+BULK_USERS_DESCRIPTION = (
+    "Comma separated user IDs or @usernames, or replies or forwards "
+    "while replying to a message"
+)
+
+
+class BulkWarnCommandArgs(pydantic.BaseModel):
+    bad_users: str = pydantic.Field(..., description=BULK_USERS_DESCRIPTION)
+    warn_message: str = pydantic.Field(..., description="The warning reason")
+
+
+class BulkUsernoteCommandArgs(pydantic.BaseModel):
+    bad_users: str = pydantic.Field(..., description=BULK_USERS_DESCRIPTION)
+    warn_message: str = pydantic.Field(..., description="The note")
+
+
+## Max users a bulk command acts on
+MAX_BULK_USERS = 200
+## Bot API lookups and DMs a bulk command has in flight at once
+BULK_CONCURRENCY = 8
+## Users named in a bulk command's summary, the rest are only counted
+MAX_SUMMARY_USERS = 50
+
+
 @loader.command(name="warn", help="warn a user", admin=True)
 def warn_command(
     client: TGFloofbotClient,
@@ -49,6 +83,63 @@ def usernote_command(
     warn_helper(client, update, context, args, True)
 
 
+def resolve_user(
+    client: TGFloofbotClient, main_group: telegram.Chat, identifier: str
+) -> Union[telegram.User, UserRecord]:
+    """Finds a user by raw user ID or @username, raising UserNotFoundException"""
+    ## Users the bot has seen resolve locally, unknown user IDs are looked up in the main group
+    user = client.users.resolve(identifier)
+    if user is not None:
+        return user
+    if identifier.startswith("@"):
+        raise exceptions.UserNotFoundException(identifier)
+    try:
+        user = client.updater.bot.get_chat_member(chat_id=main_group.id, user_id=identifier).user  # type: ignore
+    except telegram.error.BadRequest:
+        raise exceptions.UserNotFoundException(identifier)
+    client.users.record(user)
+    return user
+
+
+def recorded_users(client: TGFloofbotClient, update: Update) -> typing.Set[int]:
+    """Users an update already recorded a warning or note for, before a restart"""
+    with client.session() as db:
+        return {
+            user_id
+            for (user_id,) in db.query(models.Warning.user_id).filter(
+                models.Warning.update_id == update.update_id
+            )
+        }
+
+
+def warning_entry(
+    update: Update, user_id: int, reason: str, is_note: bool
+) -> models.Warning:
+    user = update.effective_user
+    return models.Warning(
+        user_id=user_id,
+        date_added=datetime.datetime.now(timezone.utc),
+        warned_by=user.username,
+        warned_by_id=user.id,
+        reason=reason,
+        is_usernote=is_note,
+        update_id=update.update_id,
+    )
+
+
+def send_warning_reason(
+    client: TGFloofbotClient, main_group: telegram.Chat, user_id: int, reason: str
+) -> concurrent.futures.Future:
+    return client.send_message(
+        chat_id=user_id,
+        text=f"You have been warned in *{em(main_group.title)}*\. Reason: *{em(reason)}*",
+        parse_mode="MarkdownV2",
+        priority=outbound.PRIORITY_MODERATION,
+        ## Callers report undelivered reasons themselves
+        report=False,
+    )
+
+
 def warn_helper(
     client: TGFloofbotClient,
     update: Update,
@@ -58,39 +149,494 @@ def warn_helper(
 ) -> None:
     user = update.effective_user
     chat = update.effective_chat
-    main_group = client.updater.bot.get_chat(chat_id=client.config.main_group)
+    main_group = client.main_group_chat()
+    bad_user = resolve_user(client, main_group, args.bad_user)
+    reason = args.warn_message
 
+    ## An update interrupted by a restart is handled again, but is only recorded once
+    if recorded_users(client, update):
+        LOG.info(f"Update {update.update_id} already recorded its warning")
+        return
+
+    entry = warning_entry(update, bad_user.id, reason, is_note)
+    if is_note:
+        client.store(entry)
+        reached = None
+    else:
+        reached = escalation.record_warnings(client, [entry])[bad_user.id]
+
+    client.send_message(
+        chat_id=chat.id,
+        text=f"*⚠️ User {em(bad_user.name)} {'noted' if is_note else 'warned'} by {em(user.username)} with reason {em(reason)}\.*",
+        parse_mode="MarkdownV2",
+        priority=outbound.PRIORITY_MODERATION,
+    )
+
+    if is_note:
+        return
+    delivery = send_warning_reason(client, main_group, bad_user.id, reason)
+    if reached is not None:
+        try:
+            client.wait(
+                escalation.apply_step(client, bad_user.id, reached),
+                "Applying the escalation step",
+            )
+        except Exception as err:
+            raise exceptions.EscalationException(bad_user.name, err)
+        client.send_message(
+            chat_id=chat.id,
+            text=f"*{em(bad_user.name)} reached {reached.warnings} warnings and was {em(escalation.describe(reached))}\.*",
+            parse_mode="MarkdownV2",
+            priority=outbound.PRIORITY_MODERATION,
+        )
     try:
-        bad_user = client.updater.bot.get_chat_member(chat_id=main_group.id, user_id=args.bad_user).user  # type: ignore
-    except telegram.error.BadRequest:
-        raise exceptions.UserNotFoundException(args.bad_user)
+        client.wait(delivery, "Sending the warning reason")
+    except Exception as err:
+        raise exceptions.WarningReasonDeliveryException(err)
+
+
+@loader.command(name="warnmany", help="warns several users at once", admin=True)
+def bulk_warn_command(
+    client: TGFloofbotClient,
+    update: Update,
+    context: CallbackContext,
+    args: BulkWarnCommandArgs,
+) -> None:
+    bulk_warn_helper(client, update, context, args, False)
+
+
+@loader.command(
+    name="notemany", help="adds a moderation note for several users", admin=True
+)
+def bulk_usernote_command(
+    client: TGFloofbotClient,
+    update: Update,
+    context: CallbackContext,
+    args: BulkUsernoteCommandArgs,
+) -> None:
+    bulk_warn_helper(client, update, context, args, True)
+
+
+def bulk_targets(
+    client: TGFloofbotClient, message: telegram.Message, bad_users: str
+) -> List[str]:
+    """The identifiers of the users a bulk command acts on, without duplicates"""
+    keyword = bad_users.strip().casefold()
+    if keyword in ("replies", "forwards"):
+        replied = message.reply_to_message
+        if replied is None:
+            raise exceptions.BulkTargetException(
+                f"Reply to a message to act on its {keyword}"
+            )
+        if keyword == "replies":
+            user_ids = client.messages.repliers(replied)
+        else:
+            user_ids = client.messages.forwarders(replied)
+        ## Admins answering a spam message are not part of the wave
+        identifiers = [
+            str(user_id)
+            for user_id in user_ids
+            if not helpers.known_admin(client, user_id)
+        ]
+    else:
+        identifiers = [it.strip() for it in bad_users.split(",") if it.strip()]
 
+    identifiers = list(dict.fromkeys(identifiers))
+    if not identifiers:
+        raise exceptions.BulkTargetException("No users to act on")
+    if len(identifiers) > MAX_BULK_USERS:
+        raise exceptions.BulkTargetException(
+            f"{len(identifiers)} users given, at most {MAX_BULK_USERS} are allowed"
+        )
+    return identifiers
+
+
+def bulk_warn_helper(
+    client: TGFloofbotClient,
+    update: Update,
+    context: CallbackContext,
+    args: Union[BulkUsernoteCommandArgs, BulkWarnCommandArgs],
+    is_note: bool,
+) -> None:
+    """Warns or notes many users with one insert, one summary and concurrent DMs
+
+    A user that cannot be found or messaged is reported in the summary instead of
+    failing the whole command.
+    """
+    user = update.effective_user
+    chat = update.effective_chat
+    main_group = client.main_group_chat()
+    identifiers = bulk_targets(client, update.effective_message, args.bad_users)
     reason = args.warn_message
+    failures: Dict[str, str] = dict()
 
-    warning_entry = models.Warning(
-        user_id=bad_user.id,
-        date_added=datetime.datetime.now(timezone.utc),
-        warned_by=user.username,
-        warned_by_id=user.id,
-        reason=reason,
-        is_usernote=is_note,
-    )
+    ## Only users the bot has not seen need a Bot API lookup, and those run concurrently
+    resolved = {
+        identifier: client.users.resolve(identifier) for identifier in identifiers
+    }
+    unknown = [identifier for identifier, found in resolved.items() if found is None]
+    if unknown:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(BULK_CONCURRENCY, len(unknown)),
+            thread_name_prefix="tgfb-bulk-lookup",
+        ) as executor:
+            lookups = {
+                identifier: executor.submit(
+                    resolve_user, client, main_group, identifier
+                )
+                for identifier in unknown
+            }
+        for identifier, lookup in lookups.items():
+            try:
+                resolved[identifier] = lookup.result()
+            except exceptions.UserNotFoundException:
+                failures[identifier] = "not found"
+            except Exception as err:
+                failures[identifier] = str(err)
 
-    client.db.add(warning_entry)
-    client.db.commit()
+    targets = {found.id: found for found in resolved.values() if found is not None}
+    ## An update interrupted by a restart is handled again, but each user is recorded once
+    recorded = recorded_users(client, update)
+    if recorded:
+        for user_id in recorded:
+            targets.pop(user_id, None)
+        if not targets:
+            LOG.info(f"Update {update.update_id} already recorded every warning")
+            return
+    entries = [warning_entry(update, user_id, reason, is_note) for user_id in targets]
+    escalated: Dict[int, EscalationStep] = dict()
+    if entries and is_note:
+        client.store(*entries, durable=True)
+    elif entries:
+        reached = escalation.record_warnings(client, entries)
+        escalated, escalation_failures = escalation.escalate(client, reached)
+        for user_id, error in escalation_failures.items():
+            action = escalation.PAST_TENSE[reached[user_id].action]  # type: ignore
+            failures[targets[user_id].name] = f"not {action}: {error}"
 
-    context.bot.send_message(
+    if not is_note:
+        for user_id, error in deliver_warning_reasons(
+            client, main_group, list(targets), reason
+        ).items():
+            failures[targets[user_id].name] = f"DM not delivered: {error}"
+
+    client.send_message(
         chat_id=chat.id,
-        text=f"*⚠️ User {em(bad_user.name)} {'noted' if is_note else 'warned'} by {em(user.username)} with reason {em(reason)}\.*",
+        text=bulk_summary(
+            list(targets.values()),
+            failures,
+            user.username,
+            reason,
+            is_note,
+            [(targets[user_id], step) for user_id, step in escalated.items()],
+        ),
         parse_mode="MarkdownV2",
+        priority=outbound.PRIORITY_MODERATION,
     )
 
-    if not is_note:
+
+def deliver_warning_reasons(
+    client: TGFloofbotClient,
+    main_group: telegram.Chat,
+    user_ids: List[int],
+    reason: str,
+) -> Dict[int, BaseException]:
+    """DMs the warning reason to every user, BULK_CONCURRENCY at a time
+
+    Returns the error of every user the DM could not be delivered to. Once a slot is
+    not freed within ``outbound.wait_timeout`` seconds, the remaining users are not
+    sent to.
+    """
+    timeout = client.config.outbound.wait_timeout
+    slots = threading.BoundedSemaphore(BULK_CONCURRENCY)
+    deliveries: Dict[int, concurrent.futures.Future] = dict()
+    failures: Dict[int, BaseException] = dict()
+    stalled = False
+    for user_id in user_ids:
+        if stalled or not slots.acquire(timeout=timeout):
+            stalled = True
+            failures[user_id] = OutboundTimeoutException(
+                "Sending the warning reason", timeout
+            )
+            continue
+        delivery = send_warning_reason(client, main_group, user_id, reason)
+        delivery.add_done_callback(lambda _: slots.release())
+        deliveries[user_id] = delivery
+    outcomes = client.wait_errors(
+        list(deliveries.values()), "Sending the warning reason"
+    )
+    for user_id, error in zip(deliveries, outcomes):
+        if error is not None:
+            failures[user_id] = error
+    return failures
+
+
+def bulk_summary(
+    targets: List[Union[telegram.User, UserRecord]],
+    failures: Dict[str, str],
+    moderator: str,
+    reason: str,
+    is_note: bool,
+    escalated: List[typing.Tuple[Union[telegram.User, UserRecord], EscalationStep]],
+) -> str:
+    action = "noted" if is_note else "warned"
+    lines = [
+        f"*⚠️ {len(targets)} users {action} by {em(moderator)} with reason {em(reason)}\\.*"
+    ]
+    if targets:
+        names = ", ".join(em(target.name) for target in targets[:MAX_SUMMARY_USERS])
+        if len(targets) > MAX_SUMMARY_USERS:
+            names += em(f" and {len(targets) - MAX_SUMMARY_USERS} more")
+        lines.append(names)
+    if escalated:
+        lines.append(f"\n*{len(escalated)} users reached an escalation step:*")
+        for target, step in escalated[:MAX_SUMMARY_USERS]:
+            lines.append(f" \u2022 {em(target.name)}: {em(escalation.describe(step))}")
+        if len(escalated) > MAX_SUMMARY_USERS:
+            lines.append(em(f" and {len(escalated) - MAX_SUMMARY_USERS} more"))
+    if failures:
+        lines.append(f"\n*Failed for {len(failures)} users:*")
+        for identifier, error in list(failures.items())[:MAX_SUMMARY_USERS]:
+            lines.append(f" \u2022 {em(identifier)}: {em(error)}")
+        if len(failures) > MAX_SUMMARY_USERS:
+            lines.append(em(f" and {len(failures) - MAX_SUMMARY_USERS} more"))
+    return "\n".join(lines)
+
+
+class ForgiveCommandArgs(pydantic.BaseModel):
+    record: int = pydantic.Field(
+        ..., description="ID of the warning or note, as listed by /warnings"
+    )
+
+
+@loader.command(name="forgive", help="forgives a warning or note", admin=True)
+def forgive_command(
+    client: TGFloofbotClient,
+    update: Update,
+    context: CallbackContext,
+    args: ForgiveCommandArgs,
+) -> None:
+    user = update.effective_user
+    ## Notes may still be on the write-behind queue
+    if client.writer is not None:
+        client.writer.flush()
+    with client.session() as db:
+        warning = db.query(models.Warning).get(args.record)
+        if warning is None:
+            raise exceptions.RecordNotFoundException(args.record)
+        already_forgiven = not escalation.forgive(db, warning, user)
+        label = "note" if warning.is_usernote else "warning"
+        user_id = warning.user_id
+
+    if already_forgiven:
+        text = f"*The {label} `#{args.record}` was already forgiven\\.*"
+    else:
+        text = f"*✅ The {label} `#{args.record}` for `{user_id}` was forgiven by {em(user.username)}\\.*"
+    client.send_message(
+        chat_id=update.effective_chat.id,
+        text=text,
+        parse_mode="MarkdownV2",
+        priority=outbound.PRIORITY_MODERATION,
+    )
+
+
+class ExportWarningsCommandArgs(pydantic.BaseModel):
+    format: str = pydantic.Field(
+        "csv.gz", description="csv or jsonl, with .gz appended to compress the file"
+    )
+    user: int = pydantic.Field(0, description="A raw user ID, or 0 for every user")
+    since: str = pydantic.Field(
+        "-", description="First date to export as YYYY-MM-DD, or - for no limit"
+    )
+    until: str = pydantic.Field(
+        "-", description="Date to stop before as YYYY-MM-DD, or - for no limit"
+    )
+    forgiven: str = pydantic.Field(
+        "include", description="Forgiven records to export: include, only or exclude"
+    )
+
+
+## Exports larger than this stay in memory, larger ones are spooled to disk
+EXPORT_SPOOL_SIZE = 1024 * 1024
+## The Bot API refuses to upload larger documents
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+
+def export_filter(args: ExportWarningsCommandArgs) -> export.ExportFilter:
+    if args.forgiven not in export.FORGIVEN:
+        raise exceptions.ExportException(
+            f'Unknown forgiven filter "{args.forgiven}", expected include, only or exclude'
+        )
+    dates = dict()
+    for name in ("since", "until"):
+        value = getattr(args, name)
+        if value == "-":
+            continue
         try:
-            context.bot.send_message(
-                chat_id=bad_user.id,
-                text=f"You have been warned in *{em(main_group.title)}*\. Reason: *{em(reason)}*",
-                parse_mode="MarkdownV2",
+            dates[name] = export.parse_date(value)
+        except ValueError:
+            raise exceptions.ExportException(f'Invalid date "{value}"')
+    return export.ExportFilter(
+        user_id=args.user or None, forgiven=args.forgiven, **dates
+    )
+
+
+@loader.command(
+    name="exportwarnings",
+    help="exports warnings and notes as a CSV or JSON lines file",
+    admin=True,
+)
+def export_warnings_command(
+    client: TGFloofbotClient,
+    update: Update,
+    context: CallbackContext,
+    args: ExportWarningsCommandArgs,
+) -> None:
+    fmt, _, suffix = args.format.casefold().partition(".")
+    if fmt not in export.FORMATS or suffix not in ("", "gz"):
+        raise exceptions.ExportException(
+            f'Unknown format "{args.format}", expected csv, jsonl, csv.gz or jsonl.gz'
+        )
+    filters = export_filter(args)
+    ## Records still on the write-behind queue belong in the export too
+    if client.writer is not None:
+        client.writer.flush()
+
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as spooled:
+        with client.session() as db:
+            count = export.write_records(
+                export.iter_records(db, filters), spooled, fmt, compress=bool(suffix)
             )
-        except Exception as err:
-            raise exceptions.WarningReasonDeliveryException(err)
+        if spooled.tell() > MAX_DOCUMENT_SIZE:
+            raise exceptions.ExportException(
+                "The export is too large to send, narrow it down or use the "
+                "export subcommand of the bot"
+            )
+        spooled.seek(0)
+        ## Read once, so a retried upload sends the whole file again
+        document = telegram.InputFile(
+            spooled, filename=f"warnings.{args.format.casefold()}"
+        )
+    client.wait(
+        client.outbound.submit(
+            "send_document",
+            update.effective_chat.id,
+            document=document,
+            caption=f"{count} records",
+        ),
+        "Sending the export",
+    )
+
+
+@loader.custom
+def warnings_custom(client: TGFloofbotClient):
+
+    MAX_WARNINGS_PER_PAGE = 5
+
+    class WarningsCommandArgs(pydantic.BaseModel):
+        user: int = pydantic.Field(..., description="A raw user ID")
+        kind: str = pydantic.Field(
+            "all", description="Which records to list: all, warnings or notes"
+        )
+
+    class WarningsPageButtonArgs(pydantic.BaseModel):
+        u: int = pydantic.Field(..., description="User ID")
+        k: str = pydantic.Field(..., description="Record kind")
+        d: str = pydantic.Field(
+            ..., description="Page direction. Must be 'p' (newer) or 'n' (older)"
+        )
+        i: int = pydantic.Field(..., description="ID of the record to page from")
+
+    def page_button(
+        label: str, user_id: int, kind: str, direction: str, cursor_id: int
+    ) -> InlineKeyboardButton:
+        button_args = WarningsPageButtonArgs(
+            u=user_id, k=kind, d=direction, i=cursor_id
+        )
+        return InlineKeyboardButton(
+            label, callback_data=loader.callback_data("warnings_page", button_args)
+        )
+
+    def render_page(
+        user_id: int, kind: str, direction: str, cursor_id: Optional[int]
+    ) -> typing.Tuple[str, Optional[InlineKeyboardMarkup]]:
+        """Helper function for rendering a page of a user's moderation history"""
+        with client.session() as db:
+            page, has_more, from_cursor = history.fetch_page(
+                db,
+                user_id,
+                kind=kind,
+                cursor_id=cursor_id,
+                direction=direction,
+                limit=MAX_WARNINGS_PER_PAGE,
+            )
+
+        title = f"*Moderation history for* `{user_id}` \\({em(kind)}\\)"
+        if not page:
+            return f"{title}\nNo records found\\.", None
+
+        lines = [title]
+        for warning in page:
+            label = "note" if warning.is_usernote else "warning"
+            forgiven = " \\(forgiven\\)" if warning.forgiven else ""
+            lines.append(
+                f"`#{warning.id}` {em(warning.date_added.strftime('%Y-%m-%d %H:%M'))} "
+                f"{em(label)} by {em(warning.warned_by)}{forgiven}: {em(warning.reason)}"
+            )
+
+        has_newer = direction == history.OLDER and from_cursor
+        has_older = direction == history.NEWER
+        if direction == history.OLDER:
+            has_older = has_older or has_more
+        else:
+            has_newer = has_more
+
+        buttons = list()
+        if has_newer:
+            buttons.append(
+                page_button("Previous", user_id, kind, history.NEWER, page[0].id)
+            )
+        if has_older:
+            buttons.append(
+                page_button("Next", user_id, kind, history.OLDER, page[-1].id)
+            )
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+        return "\n".join(lines), reply_markup
+
+    @loader.command(
+        name="warnings", help="lists a user's warnings and notes", admin=True
+    )
+    def warnings_command(
+        client: TGFloofbotClient,
+        update: Update,
+        context: CallbackContext,
+        args: WarningsCommandArgs,
+    ) -> None:
+        kind = args.kind.casefold()
+        if kind not in history.KINDS:
+            raise exceptions.InvalidHistoryKindException(args.kind)
+        text, reply_markup = render_page(args.user, kind, history.OLDER, None)
+        client.send_message(
+            chat_id=update.effective_chat.id,
+            text=text,
+            parse_mode=ParseMode.MARKDOWN_V2,
+            reply_markup=reply_markup,
+        )
+
+    @loader.callback_query_handler(key="warnings_page")
+    def warnings_page_query_handler(
+        client: TGFloofbotClient,
+        update: Update,
+        context: CallbackContext,
+        args: WarningsPageButtonArgs,
+    ) -> None:
+        if not helpers.is_admin(client, update.effective_user.id):
+            return
+        if args.k not in history.KINDS or args.d not in (history.OLDER, history.NEWER):
+            return
+        text, reply_markup = render_page(args.u, args.k, args.d, args.i)
+        update.callback_query.edit_message_text(
+            text=text,
+            parse_mode=ParseMode.MARKDOWN_V2,
+            reply_markup=reply_markup,
+        )
@@ -0,0 +1,192 @@
+import concurrent.futures
+import datetime
+import time
+
+from typing import Dict, Optional, Sequence, Tuple
+
+import sqlalchemy
+import sqlalchemy.orm
+import telegram
+
+from ... import helpers
+from ... import outbound
+
+from ...client import TGFloofbotClient
+from ...models import EscalationStep
+
+from . import models
+
+
+PAST_TENSE = {"mute": "muted", "ban": "banned"}
+
+
+def _naive_utc(value: datetime.datetime) -> datetime.datetime:
+    """Dates are stored as naive UTC"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def expired_warnings(
+    db: sqlalchemy.orm.Session,
+    user_id: int,
+    since: datetime.datetime,
+    until: datetime.datetime,
+) -> int:
+    """Counts the user's unforgiven warnings added in [since, until)
+
+    The range is served by the ix_tg_warnings_user_history index, so this only reads
+    the warnings that left the window since the counter last moved.
+    """
+    Warning = models.Warning
+    return (
+        db.query(sqlalchemy.func.count(Warning.id))
+        .filter(
+            Warning.user_id == user_id,
+            Warning.is_usernote == False,
+            Warning.date_added >= since,
+            Warning.date_added < until,
+            Warning.forgiven == False,
+        )
+        .scalar()
+    )
+
+
+def count_warning(
+    db: sqlalchemy.orm.Session, warning: models.Warning, window: float
+) -> Tuple[int, int]:
+    """Adds a flushed warning to its user's counter, returns the count before and after
+
+    Warnings that left the window since the counter last moved are subtracted first,
+    so each warning is expired once and the cost does not grow with the history.
+    """
+    date_added = _naive_utc(warning.date_added)
+    window_start = date_added - datetime.timedelta(seconds=window)
+    counter = db.query(models.WarningCounter).get(warning.user_id)
+    if counter is None:
+        counter = models.WarningCounter(
+            user_id=warning.user_id, active=0, window_start=window_start
+        )
+        db.add(counter)
+    elif counter.window_start < window_start:
+        counter.active -= expired_warnings(
+            db, warning.user_id, counter.window_start, window_start
+        )
+        counter.window_start = window_start
+    before = counter.active
+    counter.active = before + 1
+    return before, counter.active
+
+
+def crossed_step(
+    steps: Sequence[EscalationStep], before: int, after: int
+) -> Optional[EscalationStep]:
+    """The strictest step whose threshold the count reached going from before to after"""
+    crossed = [step for step in steps if before < step.warnings <= after]
+    return max(crossed, key=lambda step: step.warnings, default=None)
+
+
+def record_warnings(
+    client: TGFloofbotClient, warnings: Sequence[models.Warning]
+) -> Dict[int, Optional[EscalationStep]]:
+    """Inserts warnings and updates their users' counters in one transaction
+
+    Returns the escalation step each warned user reached, if any.
+    """
+    policy = client.config.escalation
+    reached: Dict[int, Optional[EscalationStep]] = dict()
+    with client.session() as db:
+        db.add_all(warnings)
+        ## Inserting first takes SQLite's write lock, so no other connection can change
+        ## the counters read below until this transaction commits
+        db.flush()
+        for warning in warnings:
+            before, after = count_warning(db, warning, policy.window)
+            reached[warning.user_id] = crossed_step(policy.steps, before, after)
+    return reached
+
+
+def forgive(
+    db: sqlalchemy.orm.Session, warning: models.Warning, moderator: telegram.User
+) -> bool:
+    """Marks a record as forgiven, taking a warning off its user's counter
+
+    Returns False if the record was already forgiven.
+    """
+    Warning = models.Warning
+    ## Checked and set in one statement, so concurrent calls forgive a record once
+    forgiven = (
+        db.query(Warning)
+        .filter(Warning.id == warning.id, Warning.forgiven == False)
+        .update(
+            {
+                Warning.forgiven: True,
+                Warning.forgiven_by: moderator.username,
+                Warning.forgiven_by_id: moderator.id,
+            },
+            False,
+        )
+    )
+    if not forgiven:
+        return False
+    if warning.is_usernote:
+        return True
+    ## Warnings older than the window were already subtracted when they expired
+    WarningCounter = models.WarningCounter
+    db.query(WarningCounter).filter(
+        WarningCounter.user_id == warning.user_id,
+        WarningCounter.window_start <= _naive_utc(warning.date_added),
+    ).update({WarningCounter.active: WarningCounter.active - 1}, False)
+    return True
+
+
+def apply_step(
+    client: TGFloofbotClient, user_id: int, step: EscalationStep
+) -> concurrent.futures.Future:
+    """Mutes or bans the user in the main group"""
+    until_date = None if step.duration is None else int(time.time() + step.duration)
+    if step.action == "mute":
+        return client.outbound.submit(
+            "restrict_chat_member",
+            client.config.main_group,
+            priority=outbound.PRIORITY_MODERATION,
+            user_id=user_id,
+            permissions=helpers.MUTED,
+            until_date=until_date,
+        )
+    return client.outbound.submit(
+        "kick_chat_member",
+        client.config.main_group,
+        priority=outbound.PRIORITY_MODERATION,
+        user_id=user_id,
+        until_date=until_date,
+    )
+
+
+def describe(step: EscalationStep) -> str:
+    action = PAST_TENSE[step.action]
+    if step.duration is None:
+        return action
+    return f"{action} for {helpers.format_duration(step.duration)}"
+
+
+def escalate(
+    client: TGFloofbotClient, reached: Dict[int, Optional[EscalationStep]]
+) -> Tuple[Dict[int, EscalationStep], Dict[int, BaseException]]:
+    """Applies every reached step, returns the applied steps and failures by user"""
+    actions = {
+        user_id: (step, apply_step(client, user_id, step))
+        for user_id, step in reached.items()
+        if step is not None
+    }
+    applied: Dict[int, EscalationStep] = dict()
+    failures: Dict[int, BaseException] = dict()
+    outcomes = client.wait_errors(
+        [action for _, action in actions.values()], "Applying the escalation step"
+    )
+    for (user_id, (step, _)), error in zip(actions.items(), outcomes):
+        if error is None:
+            applied[user_id] = step
+        else:
+            failures[user_id] = error
+    return applied, failures
@@ -1,3 +1,4 @@
+from ... import errors
 from ... import exceptions as core_exceptions
 
 from ...helpers import em
@@ -14,4 +15,43 @@ class WarningReasonDeliveryException(core_exceptions.FloofbotException):
     title = "Warning reason could not be delivered to the user"
 
     def __init__(self, exception: Exception):
-        super().__init__(em(f"Exception: {exception}"))
\ No newline at end of file
+        super().__init__(em(f"Exception: {errors.plain_message(exception)}"))
+
+
+class EscalationException(core_exceptions.FloofbotException):
+    title = "Escalation step could not be applied"
+
+    def __init__(self, name: str, exception: Exception):
+        super().__init__(
+            em(f"User {name}, exception: {errors.plain_message(exception)}")
+        )
+
+
+class RecordNotFoundException(core_exceptions.FloofbotException):
+    title = "Record not found"
+
+    def __init__(self, record_id: int):
+        super().__init__(em(f"No warning or note with ID {record_id}"))
+
+
+class InvalidHistoryKindException(core_exceptions.FloofbotException):
+    title = "Invalid record kind"
+
+    def __init__(self, kind: str):
+        super().__init__(
+            em(f'Unknown record kind "{kind}", expected all, warnings or notes')
+        )
+
+
+class BulkTargetException(core_exceptions.FloofbotException):
+    title = "Invalid users"
+
+    def __init__(self, reason: str):
+        super().__init__(em(reason))
+
+
+class ExportException(core_exceptions.FloofbotException):
+    title = "Export failed"
+
+    def __init__(self, reason: str):
+        super().__init__(em(reason))
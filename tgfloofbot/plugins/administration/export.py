@@ -0,0 +1,153 @@
+import csv
+import dataclasses
+import datetime
+import gzip
+import io
+import json
+
+from typing import IO, Any, Iterable, Iterator, Optional, Tuple
+
+import sqlalchemy.orm
+
+from . import history
+from . import models
+
+
+FORMATS = ("csv", "jsonl")
+
+## Rows fetched from the database per round trip while streaming
+BATCH_SIZE = 1000
+
+COLUMNS = (
+    "id",
+    "user_id",
+    "date_added",
+    "kind",
+    "reason",
+    "warned_by",
+    "warned_by_id",
+    "forgiven",
+    "forgiven_by",
+    "forgiven_by_id",
+)
+
+## How records are selected by their forgiven state
+FORGIVEN = {
+    "include": None,
+    "only": True,
+    "exclude": False,
+}
+
+
+@dataclasses.dataclass
+class ExportFilter:
+    user_id: Optional[int] = None
+    ## Records added at or after ``since`` and before ``until``, in UTC
+    since: Optional[datetime.datetime] = None
+    until: Optional[datetime.datetime] = None
+    forgiven: str = "include"
+    kind: str = "all"
+
+
+def parse_date(text: str) -> datetime.datetime:
+    """Parses an ISO date or date and time, naive values are taken as UTC
+
+    Dates are stored as naive UTC, so the result is naive as well.
+    """
+    value = datetime.datetime.fromisoformat(text)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def iter_records(db: sqlalchemy.orm.Session, filters: ExportFilter) -> Iterator[Tuple]:
+    """Streams the matching records in ID order, one tuple per record
+
+    Only the exported columns are selected, and ``yield_per`` makes the query use a
+    server side cursor that fetches ``BATCH_SIZE`` rows at a time, so memory use does
+    not depend on how many records match. The session must stay open while iterating.
+    """
+    Warning = models.Warning
+    query = db.query(
+        Warning.id,
+        Warning.user_id,
+        Warning.date_added,
+        Warning.is_usernote,
+        Warning.reason,
+        Warning.warned_by,
+        Warning.warned_by_id,
+        Warning.forgiven,
+        Warning.forgiven_by,
+        Warning.forgiven_by_id,
+    )
+    if filters.user_id is not None:
+        query = query.filter(Warning.user_id == filters.user_id)
+    if filters.since is not None:
+        query = query.filter(Warning.date_added >= filters.since)
+    if filters.until is not None:
+        query = query.filter(Warning.date_added < filters.until)
+    forgiven = FORGIVEN[filters.forgiven]
+    if forgiven is not None:
+        query = query.filter(Warning.forgiven == forgiven)
+    if filters.kind != "all":
+        query = query.filter(Warning.is_usernote.in_(history.KINDS[filters.kind]))
+    for row in query.order_by(Warning.id).yield_per(BATCH_SIZE):
+        (
+            record_id,
+            user_id,
+            date_added,
+            is_usernote,
+            reason,
+            warned_by,
+            warned_by_id,
+            forgiven,
+            forgiven_by,
+            forgiven_by_id,
+        ) = row
+        yield (
+            record_id,
+            user_id,
+            date_added.isoformat(),
+            "note" if is_usernote else "warning",
+            reason,
+            warned_by,
+            warned_by_id,
+            forgiven,
+            forgiven_by,
+            forgiven_by_id,
+        )
+
+
+def write_records(
+    records: Iterable[Tuple], output: IO[bytes], fmt: str, compress: bool = False
+) -> int:
+    """Writes records to a binary stream as CSV or JSON lines, returns how many
+
+    Records are encoded one at a time through buffered writers, optionally gzipped,
+    and ``output`` is left open.
+    """
+    stream: Any = output
+    if compress:
+        stream = gzip.GzipFile(fileobj=output, mode="wb", compresslevel=6)
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    count = 0
+    try:
+        if fmt == "csv":
+            writer = csv.writer(text)
+            writer.writerow(COLUMNS)
+            for record in records:
+                writer.writerow(record)
+                count += 1
+        else:
+            encode = json.JSONEncoder(ensure_ascii=False).encode
+            for record in records:
+                text.write(encode(dict(zip(COLUMNS, record))))
+                text.write("\n")
+                count += 1
+    finally:
+        text.flush()
+        text.detach()
+        if compress:
+            ## Writes the gzip trailer, the underlying stream stays open
+            stream.close()
+    return count
@@ -0,0 +1,93 @@
+import heapq
+
+from typing import List, Optional, Sequence, Tuple
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from . import models
+
+
+## Direction of a page relative to its cursor
+OLDER = "n"
+NEWER = "p"
+
+## Kinds of moderation records that can be listed
+KINDS = {
+    "all": (False, True),
+    "warnings": (False,),
+    "notes": (True,),
+}
+
+
+def _sort_key(warning: models.Warning) -> Tuple:
+    return (warning.date_added, warning.id)
+
+
+def _seek(
+    db: sqlalchemy.orm.Session,
+    user_id: int,
+    is_usernote: bool,
+    cursor: Optional[models.Warning],
+    direction: str,
+    limit: int,
+) -> List[models.Warning]:
+    """Fetches one page of records of a single kind past the cursor
+
+    The equality on (user_id, is_usernote) and the range on (date_added, id) are all
+    served by the ix_tg_warnings_user_history index, so the cost does not depend on
+    how much history precedes the cursor.
+    """
+    Warning = models.Warning
+    query = db.query(Warning).filter(
+        Warning.user_id == user_id, Warning.is_usernote == is_usernote
+    )
+    ## Compared as a row value, since SQLite does not turn the equivalent OR of
+    ## comparisons into a range on the index
+    position = sqlalchemy.tuple_(Warning.date_added, Warning.id)
+    if direction == OLDER:
+        if cursor is not None:
+            query = query.filter(position < (cursor.date_added, cursor.id))
+        query = query.order_by(Warning.date_added.desc(), Warning.id.desc())
+    else:
+        query = query.filter(position > (cursor.date_added, cursor.id)).order_by(
+            Warning.date_added.asc(), Warning.id.asc()
+        )
+    return query.limit(limit).all()
+
+
+def fetch_page(
+    db: sqlalchemy.orm.Session,
+    user_id: int,
+    kind: str = "all",
+    cursor_id: Optional[int] = None,
+    direction: str = OLDER,
+    limit: int = 5,
+) -> Tuple[List[models.Warning], bool, bool]:
+    """Fetches a page of a user's moderation records, newest first, using keyset pagination
+
+    ``cursor_id`` is the ID of the record the page continues from: the last record of
+    the current page when paging to older records, or its first record when paging to
+    newer ones. Returns the page, whether more records exist past it, and whether
+    the page continues from the cursor. An unknown cursor gives the first page.
+    """
+    cursor = None
+    if cursor_id is not None:
+        cursor = db.query(models.Warning).get(cursor_id)
+        if cursor is None or cursor.user_id != user_id:
+            cursor, direction = None, OLDER
+    elif direction == NEWER:
+        direction = OLDER
+
+    ## One index seek per record kind, merged so that only limit + 1 rows are read per kind
+    newest_first = direction == OLDER
+    results: Sequence[List[models.Warning]] = [
+        _seek(db, user_id, is_usernote, cursor, direction, limit + 1)
+        for is_usernote in KINDS[kind]
+    ]
+    merged = list(heapq.merge(*results, key=_sort_key, reverse=newest_first))
+    page = merged[:limit]
+    has_more = len(merged) > limit
+    if not newest_first:
+        page.reverse()
+    return page, has_more, cursor is not None
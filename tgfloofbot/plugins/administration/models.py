@@ -1,11 +1,13 @@
-from sqlalchemy import Column, Integer, String, text, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, text, DateTime, Boolean, Index
 import datetime
 
 from ...models import ORMBase
 
+
 def tz_aware_now() -> datetime.datetime:
     return datetime.datetime.now(datetime.timezone.utc)
 
+
 class Warning(ORMBase):
     __tablename__ = "tg_warnings"
     id = Column(Integer, primary_key=True, nullable=False)
@@ -18,3 +20,24 @@ class Warning(ORMBase):
     warned_by_id = Column(Integer, nullable=False)
     reason = Column(String(), nullable=False)
     is_usernote = Column(Boolean, default=False, nullable=False)
+    ## The update that created the record, so a replayed update cannot record it twice
+    update_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index("ix_tg_warnings_user_history", "user_id", "is_usernote", "date_added"),
+        Index("ix_tg_warnings_update_user", "update_id", "user_id", unique=True),
+    )
+
+
+class WarningCounter(ORMBase):
+    """How many unforgiven warnings a user got since ``window_start``
+
+    Kept up to date in the transactions that add and forgive warnings, so escalation
+    checks read one row instead of counting the user's history.
+    """
+
+    __tablename__ = "tg_warning_counters"
+    user_id = Column(Integer, primary_key=True, nullable=False)
+    active = Column(Integer, default=0, nullable=False)
+    ## Warnings added before this were already subtracted from ``active``
+    window_start = Column(DateTime, nullable=False)
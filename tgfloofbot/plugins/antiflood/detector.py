@@ -0,0 +1,169 @@
+import array
+import collections
+import dataclasses
+import math
+
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from ...models import AntiFloodConfig, FloodRule
+
+
+@dataclasses.dataclass
+class Detection:
+    ## flood, repeat or join
+    kind: str
+    ## (user ID, message ID) of the events to act on: every event in the window when
+    ## the detection starts, then each further event while it lasts
+    events: List[Tuple[int, int]]
+    started: bool
+
+
+class EventWindow:
+    """The last ``size`` events of a user, text or chat, in ring buffers
+
+    Adding an event overwrites the oldest one, so checking whether ``size`` events
+    happened within a window costs the same however many came before.
+    """
+
+    __slots__ = ("times", "users", "messages", "position", "last_seen", "flagged_until")
+
+    def __init__(self, size: int):
+        self.times = array.array("d", [-math.inf]) * size
+        self.users = array.array("q", [0]) * size
+        self.messages = array.array("q", [0]) * size
+        self.position = 0
+        self.last_seen = -math.inf
+        self.flagged_until = -math.inf
+
+    def add(self, now: float, user_id: int, message_id: int) -> float:
+        """Records an event, returns the time of the oldest of the last ``size``"""
+        position = self.position
+        self.times[position] = now
+        self.users[position] = user_id
+        self.messages[position] = message_id
+        position += 1
+        if position == len(self.times):
+            position = 0
+        self.position = position
+        self.last_seen = now
+        return self.times[position]
+
+    def events(self) -> List[Tuple[int, int]]:
+        """The recorded events, oldest first"""
+        size = len(self.times)
+        order = [(self.position + it) % size for it in range(size)]
+        return [
+            (self.users[it], self.messages[it])
+            for it in order
+            if self.times[it] != -math.inf
+        ]
+
+
+class WindowTable:
+    """Event windows by key for one rule, from the least to the most recently active
+
+    A key is flagged once ``rule.count`` of its events happen within ``rule.window``
+    seconds, and stays flagged until a window passes without another event. Windows
+    idle for longer than that are dropped as events arrive, and so is the least
+    recently active one while there are more than ``max_size``.
+    """
+
+    def __init__(self, kind: str, rule: FloodRule, max_size: int):
+        self.kind = kind
+        self.count = rule.count
+        self.window = rule.window
+        self.max_size = max_size
+        self.windows: "collections.OrderedDict[Hashable, EventWindow]" = (
+            collections.OrderedDict()
+        )
+        self.detections = 0
+        self.evicted = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tracked": len(self.windows),
+            "detections": self.detections,
+            "evicted": self.evicted,
+        }
+
+    def add(
+        self, key: Hashable, now: float, user_id: int, message_id: int
+    ) -> Optional[Detection]:
+        windows = self.windows
+        window = windows.get(key)
+        if window is None:
+            window = windows[key] = EventWindow(self.count)
+        else:
+            windows.move_to_end(key)
+        oldest = window.add(now, user_id, message_id)
+        self._evict(now)
+        if now < window.flagged_until:
+            window.flagged_until = now + self.window
+            return Detection(self.kind, [(user_id, message_id)], False)
+        if now - oldest >= self.window:
+            return None
+        window.flagged_until = now + self.window
+        self.detections += 1
+        return Detection(self.kind, window.events(), True)
+
+    def _evict(self, now: float) -> None:
+        ## Each window is dropped at most once, so this is constant amortized per event
+        windows = self.windows
+        while windows:
+            key, window = next(iter(windows.items()))
+            if len(windows) <= self.max_size and now - window.last_seen < self.window:
+                return
+            del windows[key]
+            self.evicted += 1
+
+
+class FloodDetector:
+    """Sliding window counters over the messages and joins of a group
+
+    Floods are counted per user, repeats per text and joins for the whole group. Each
+    message costs a few dictionary operations whatever the traffic, and memory is
+    bounded by ``max_tracked`` windows per rule. Not thread safe, the dispatcher thread
+    is its only user.
+    """
+
+    def __init__(self, config: AntiFloodConfig):
+        self.repeat_min_length = config.repeat_min_length
+        self.flood = self._table("flood", config.flood, config.max_tracked)
+        self.repeats = self._table("repeat", config.repeats, config.max_tracked)
+        self.joins = self._table("join", config.joins, 1)
+
+    @staticmethod
+    def _table(
+        kind: str, rule: Optional[FloodRule], max_size: int
+    ) -> Optional[WindowTable]:
+        return WindowTable(kind, rule, max_size) if rule is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict()
+        for table in (self.flood, self.repeats, self.joins):
+            if table is not None:
+                for name, value in table.stats().items():
+                    stats[f"{table.kind}_{name}"] = value
+        return stats
+
+    def message(
+        self, now: float, user_id: int, message_id: int, text: Optional[str]
+    ) -> List[Detection]:
+        detections: List[Detection] = list()
+        if self.flood is not None:
+            detection = self.flood.add(user_id, now, user_id, message_id)
+            if detection is not None:
+                detections.append(detection)
+        if self.repeats is not None and text:
+            ## Only the hash is kept, texts differing in case or spacing are the same
+            normalized = " ".join(text.casefold().split())
+            if len(normalized) >= self.repeat_min_length:
+                detection = self.repeats.add(hash(normalized), now, user_id, message_id)
+                if detection is not None:
+                    detections.append(detection)
+        return detections
+
+    def join(self, now: float, user_id: int, message_id: int) -> Optional[Detection]:
+        if self.joins is None:
+            return None
+        return self.joins.add(None, now, user_id, message_id)
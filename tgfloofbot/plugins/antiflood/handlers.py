@@ -0,0 +1,225 @@
+import concurrent.futures
+import functools
+import math
+import time
+
+from typing import Dict, List, Optional
+
+import telegram
+import telegram.ext
+
+from ... import cache
+from ... import helpers
+from ... import loader
+from ... import outbound
+
+from ...client import TGFloofbotClient
+from ...logger import LOG
+from ...models import FloodRule
+
+from . import detector
+
+
+## Before the command router, so floods of commands are counted too
+HANDLER_GROUP = -10
+
+## Users named in an alert, the others are only counted
+MAX_ALERT_USERS = 10
+
+
+def _log_failure(action: str, target: int, future: concurrent.futures.Future) -> None:
+    error = future.exception()
+    if error is not None:
+        LOG.warning("Anti-flood failed to %s %s: %s", action, target, error)
+
+
+def _user_label(client: TGFloofbotClient, user_id: int) -> str:
+    record = client.users.by_id.get(user_id)
+    if record is None:
+        return str(user_id)
+    if record.username:
+        return f"@{record.username} ({user_id})"
+    return f"{record.full_name} ({user_id})"
+
+
+def alert_text(
+    client: TGFloofbotClient,
+    detection: detector.Detection,
+    rule: FloodRule,
+    actions: List[str],
+) -> str:
+    user_ids = list(dict.fromkeys(user_id for user_id, _ in detection.events))
+    users = ", ".join(_user_label(client, it) for it in user_ids[:MAX_ALERT_USERS])
+    if len(user_ids) > MAX_ALERT_USERS:
+        users += f" and {len(user_ids) - MAX_ALERT_USERS} more"
+    window = helpers.format_duration(rule.window)
+    if detection.kind == "flood":
+        text = f"Flood in the main group: {users} sent {rule.count} messages"
+    elif detection.kind == "repeat":
+        text = f"Repeated text in the main group: {users} sent {rule.count} copies"
+    else:
+        text = f"Join wave in the main group: {rule.count} users joined"
+    text += f" within {window}."
+    if detection.kind == "join":
+        text += f" Joined: {users}."
+    applied: List[str] = list()
+    if "delete" in actions:
+        applied.append("deleting their messages")
+    if "restrict" in actions:
+        duration = (
+            f" for {helpers.format_duration(rule.duration)}"
+            if rule.duration is not None
+            else ""
+        )
+        applied.append(f"restricting the users{duration}")
+    if applied:
+        text += f" Until it stops, {' and '.join(applied)}."
+    elif actions != rule.actions:
+        text += " The administrator lists are not loaded yet, so nothing was done."
+    return text
+
+
+class FloodResponder:
+    """Applies the configured actions of a rule to what the detector flagged
+
+    Every call goes through the outbound queue at moderation priority, so the
+    dispatcher thread never waits on the Bot API. Admins are left alone, and until
+    the administrator lists are loaded they cannot be told apart, so only alerts go
+    out.
+    """
+
+    def __init__(self, client: TGFloofbotClient, rules: Dict[str, Optional[FloodRule]]):
+        self.client = client
+        self.rules = rules
+        ## Users restricted by the current detection, kept until the restriction ends
+        ## so a long detection does not restrict them again
+        self.restricted: cache.TTLCache = cache.TTLCache(
+            client.config.antiflood.max_tracked, 0.0
+        )
+        self.counters = {"deleted": 0, "restricted": 0, "alerts": 0}
+
+    def respond(self, detection: detector.Detection) -> None:
+        rule = self.rules[detection.kind]
+        if rule is None:
+            return
+        events = [
+            (user_id, message_id)
+            for user_id, message_id in detection.events
+            if not helpers.known_admin(self.client, user_id)
+        ]
+        if not events:
+            return
+        if detection.started:
+            LOG.warning(
+                f"Anti-flood detected a {detection.kind} involving "
+                f"{len(set(user_id for user_id, _ in events))} users"
+            )
+        main_group = self.client.config.main_group
+        actions = rule.actions
+        if main_group not in self.client.group_admins:
+            actions = [it for it in actions if it == "alert"]
+            if detection.started and actions != rule.actions:
+                LOG.warning(
+                    "Anti-flood is not deleting or restricting, the administrator "
+                    "lists are not loaded yet"
+                )
+        if "delete" in actions:
+            for message_id in dict.fromkeys(message_id for _, message_id in events):
+                self._submit(
+                    "delete",
+                    message_id,
+                    "delete_message",
+                    main_group,
+                    message_id=message_id,
+                )
+                self.counters["deleted"] += 1
+        if "restrict" in actions:
+            until_date = (
+                int(time.time() + rule.duration) if rule.duration is not None else None
+            )
+            restricted_for = rule.duration if rule.duration is not None else math.inf
+            for user_id in dict.fromkeys(user_id for user_id, _ in events):
+                key = (detection.kind, user_id)
+                ## A new detection restricts again, admins may have lifted the last one
+                if not detection.started and key in self.restricted:
+                    continue
+                self.restricted.set(key, True, restricted_for)
+                self._submit(
+                    "restrict",
+                    user_id,
+                    "restrict_chat_member",
+                    main_group,
+                    user_id=user_id,
+                    permissions=helpers.MUTED,
+                    until_date=until_date,
+                )
+                self.counters["restricted"] += 1
+        if "alert" in actions and detection.started:
+            self.alert(alert_text(self.client, detection, rule, actions))
+
+    def alert(self, text: str) -> None:
+        admin_groups = self.client.config.admin_groups
+        if not admin_groups:
+            LOG.warning(f"No admin groups to alert: {text}")
+            return
+        for group_id in admin_groups:
+            self.client.send_message(
+                group_id, text, priority=outbound.PRIORITY_MODERATION
+            )
+        self.counters["alerts"] += 1
+
+    def _submit(
+        self, action: str, target: int, method: str, chat_id: int, **kwargs
+    ) -> None:
+        future = self.client.outbound.submit(
+            method, chat_id, priority=outbound.PRIORITY_MODERATION, **kwargs
+        )
+        future.add_done_callback(functools.partial(_log_failure, action, target))
+
+
+@loader.custom
+def antiflood_custom(client: TGFloofbotClient):
+    config = client.config.antiflood
+    if not config.enabled:
+        LOG.debug("Anti-flood is disabled")
+        return
+
+    flood_detector = detector.FloodDetector(config)
+    responder = FloodResponder(
+        client,
+        {"flood": config.flood, "repeat": config.repeats, "join": config.joins},
+    )
+    client.metrics.add_collector(
+        "antiflood", lambda: {**flood_detector.stats(), **responder.counters}
+    )
+
+    def watch_main_group(
+        update: telegram.Update, context: telegram.ext.CallbackContext
+    ) -> None:
+        message = update.message
+        ## Messages sent on behalf of a chat come from anonymous admins or its channel
+        if getattr(message, "sender_chat", None) is not None:
+            return
+        now = time.monotonic()
+        if message.new_chat_members:
+            for member in message.new_chat_members:
+                detection = flood_detector.join(now, member.id, message.message_id)
+                if detection is not None:
+                    responder.respond(detection)
+        elif message.from_user is not None:
+            for detection in flood_detector.message(
+                now,
+                message.from_user.id,
+                message.message_id,
+                message.text or message.caption,
+            ):
+                responder.respond(detection)
+
+    client.dispatcher.add_handler(
+        telegram.ext.MessageHandler(
+            telegram.ext.Filters.chat(client.config.main_group)
+            & telegram.ext.Filters.update.message,
+            watch_main_group,
+        ),
+        group=HANDLER_GROUP,
+    )
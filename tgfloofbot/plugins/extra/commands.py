@@ -1,12 +1,19 @@
+import collections
+import time
+
 from typing import List, Optional
 
 import pydantic
+import sqlalchemy
 import telegram
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode
 from telegram.ext import CallbackContext, CallbackQueryHandler
 
+from ... import helpers
 from ... import loader
+from ... import metrics
+from ... import outbound
 
 from ...client import TGFloofbotClient
 from ...helpers import em
@@ -16,10 +23,75 @@ from . import models
 from . import exceptions
 
 
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f} ms"
+
+
 @loader.command(help="Checks if the bot is alive")
 def ping(client: TGFloofbotClient, update: Update, context: CallbackContext) -> None:
-    ## TODO: Measure approximate latency by sending a message, receiving it, then editing it
-    context.bot.send_message(chat_id=update.effective_chat.id, text="Pong!")
+    """Replies, then edits the reply to show where the time went
+
+    Telegram's message dates have a one second resolution, so the time an update took
+    to reach the bot is approximate.
+    """
+    chat_id = update.effective_chat.id
+    lag = max(0.0, time.time() - update.effective_message.date.timestamp())
+    age = client.tracker.age(update.update_id) if client.tracker else None
+    if age is None:
+        lines = [f"Update lag: ~{lag:.1f} s from sending to handling"]
+    else:
+        lines = [
+            f"Update lag: ~{max(0.0, lag - age):.1f} s until received, "
+            f"{_ms(age)} until handled"
+        ]
+    lines.append(
+        f"Queues: {client.dispatcher.update_queue.qsize()} updates, "
+        f"{client.workers.backlog if client.workers else 0} commands queued or running, "
+        f"{client.outbound.depth} messages"
+    )
+
+    started = time.perf_counter()
+    with client.session() as db:
+        db.execute(sqlalchemy.text("SELECT 1"))
+    lines.append(f"Database round trip: {_ms(time.perf_counter() - started)}")
+
+    started = time.perf_counter()
+    reply = client.wait(
+        client.send_message(chat_id=chat_id, text="Pong!", report=False),
+        "Sending the reply",
+    )
+    lines.append(f"Send round trip: {_ms(time.perf_counter() - started)}")
+
+    ## Only known admins, looking up every user who pings would cost a Bot API call
+    is_admin = chat_id in helpers.admin_group_ids(client) or helpers.known_admin(
+        client, update.effective_user.id
+    )
+    if client.tracker and is_admin:
+        durations = client.tracker.durations
+        p50, p95 = durations.quantiles(0.5, 0.95)
+        lines.append(
+            f"Last {len(durations)} updates: p50 {_ms(p50)}, p95 {_ms(p95)} "
+            "from receiving to done"
+        )
+
+    ## The edit time can only be shown by a second edit
+    started = time.perf_counter()
+    client.wait(
+        client.outbound.submit(
+            "edit_message_text",
+            chat_id,
+            message_id=reply.message_id,
+            text="\n".join(["Pong!"] + lines),
+        ),
+        "Editing the reply",
+    )
+    lines.append(f"Edit round trip: {_ms(time.perf_counter() - started)}")
+    client.outbound.submit(
+        "edit_message_text",
+        chat_id,
+        message_id=reply.message_id,
+        text="\n".join(["Pong!"] + lines),
+    )
 
 
 class IDCommandArgs(pydantic.BaseModel):
@@ -38,18 +110,23 @@ def id_command(
     entities = update.effective_message.entities
     user = update.effective_user
 
-    if len(entities) > 1 and entities[1].type in ("text_mention", "mention"):
+    if len(entities) > 1 and entities[1].type == "text_mention":
         user = entities[1].user
     elif args.identifier:
-        try:
-            user = context.bot.get_chat(args.identifier)  # type: ignore
-        except telegram.error.BadRequest:
+        ## The Bot API cannot look up users by @username, so those only resolve locally
+        user = client.users.resolve(args.identifier)
+        if user is None and args.identifier.startswith("@"):
             raise exceptions.UserNotFoundException(args.identifier)
+        if user is None:
+            try:
+                user = context.bot.get_chat(args.identifier)  # type: ignore
+            except telegram.error.BadRequest:
+                raise exceptions.UserNotFoundException(args.identifier)
 
     user_id = user.id
     full_name = user.full_name
     text = f"User ID for [@{full_name}](tg://user?id={user_id}): `{user_id}`"
-    context.bot.send_message(
+    client.send_message(
         chat_id=update.effective_chat.id, text=text, parse_mode=ParseMode.MARKDOWN_V2
     )
 
@@ -60,11 +137,111 @@ def groupid(client: TGFloofbotClient, update: Update, context: CallbackContext)
         f"Group ID for {em(update.effective_chat['title'])}: "
         f"`{update.effective_chat.id}`"
     )
-    context.bot.send_message(
+    client.send_message(
         chat_id=update.effective_chat.id, text=text, parse_mode=ParseMode.MARKDOWN_V2
     )
 
 
+MAX_STATS_ROWS = 15
+
+
+@loader.command(
+    help="Shows handler latency, Bot API usage and queue statistics", admin=True
+)
+def stats(client: TGFloofbotClient, update: Update, context: CallbackContext) -> None:
+    histograms, counters = client.metrics.snapshot()
+    api_calls: collections.Counter = collections.Counter()
+    errors: collections.Counter = collections.Counter()
+    for (metric, labels), value in counters.items():
+        if metric == metrics.API_CALLS:
+            api_calls[labels[0]] += value
+        elif metric == metrics.ERRORS:
+            errors[labels[0]] += value
+
+    totals = sorted(
+        (
+            (labels, histogram)
+            for (metric, labels), histogram in histograms.items()
+            if metric == metrics.HANDLER_SECONDS and labels[2] == "total"
+        ),
+        key=lambda row: row[1].count,
+        reverse=True,
+    )
+    lines = ["*Handlers* " + em("(calls, p50 / p95 ms, Bot API calls per call)")]
+    for (kind, name, _), histogram in totals[:MAX_STATS_ROWS]:
+        label = f"/{name}" if kind == "command" else f"{name} button"
+        lines.append(
+            em(
+                f"{label}: {histogram.count}, "
+                f"{histogram.quantile(0.5) * 1000:.0f} / "
+                f"{histogram.quantile(0.95) * 1000:.0f}, "
+                f"{api_calls[name] / histogram.count:.1f}"
+            )
+        )
+    if not totals:
+        lines.append(em("No commands handled yet"))
+
+    if errors:
+        lines.append("\n*Errors*")
+        for error, count in errors.most_common(MAX_STATS_ROWS):
+            lines.append(em(f"{error}: {count:.0f}"))
+
+    for prefix, values in client.metrics.collect().items():
+        gauges = ", ".join(f"{name} {value:g}" for name, value in values.items())
+        title = prefix.replace("_", " ").capitalize()
+        lines.append(f"\n*{em(title)}*\n{em(gauges)}")
+
+    client.send_message(
+        chat_id=update.effective_chat.id,
+        text="\n".join(lines),
+        parse_mode=ParseMode.MARKDOWN_V2,
+    )
+
+
+class ErrorsCommandArgs(pydantic.BaseModel):
+    count: int = pydantic.Field(10, description="How many recent errors to show")
+
+
+@loader.command(
+    name="errors",
+    help="Shows the most recent errors and how often they occur",
+    admin=True,
+)
+def errors_command(
+    client: TGFloofbotClient,
+    update: Update,
+    context: CallbackContext,
+    args: ErrorsCommandArgs,
+) -> None:
+    recent = client.errors.snapshot()
+    if not recent:
+        client.send_message(
+            chat_id=update.effective_chat.id,
+            text="No errors since the bot started\\.",
+            parse_mode=ParseMode.MARKDOWN_V2,
+        )
+        return
+
+    lines = [f"*Most common of the last {len(recent)} errors*"]
+    counts = collections.Counter(record.fingerprint for record in recent)
+    for (error_type, site), count in counts.most_common(MAX_STATS_ROWS):
+        lines.append(em(f"{error_type} at {site}: {count}"))
+    lines.append("\n*Most recent errors*")
+    for record in reversed(recent[-max(1, min(args.count, MAX_STATS_ROWS)) :]):
+        when = time.strftime("%H:%M:%S", time.gmtime(record.time))
+        chat = f" in {record.chat_id}" if record.chat_id is not None else ""
+        lines.append(
+            em(f"{when} {record.fingerprint[0]}{chat}: {record.message[:200]}")
+        )
+    if client.breaker.state != "closed":
+        lines.append(em("\nError replies are paused, the Bot API is failing"))
+    client.send_message(
+        chat_id=update.effective_chat.id,
+        text="\n".join(lines),
+        parse_mode=ParseMode.MARKDOWN_V2,
+    )
+
+
 @loader.custom
 def help_custom(client: TGFloofbotClient):
 
@@ -83,30 +260,22 @@ def help_custom(client: TGFloofbotClient):
 
     buttons = [
         [
-            InlineKeyboardButton("Previous", callback_data="help_menu_page;a: p"),
-            InlineKeyboardButton("Next", callback_data="help_menu_page;a: n"),
+            InlineKeyboardButton(
+                "Previous",
+                callback_data=loader.callback_data(
+                    "help_menu_page", HelpMenuButtonArgs(a="p")
+                ),
+            ),
+            InlineKeyboardButton(
+                "Next",
+                callback_data=loader.callback_data(
+                    "help_menu_page", HelpMenuButtonArgs(a="n")
+                ),
+            ),
         ],
     ]
     button_reply_markup = InlineKeyboardMarkup(buttons)
 
-    def generate_commands_help_page(page_index: int) -> str:
-        """Helper function for generating a page displaying the list of commands"""
-        all_commands: List[str] = list()
-        for command_data in loader.commands.values():
-            if command_data.help_data.description:
-                description = f": {command_data.help_data.description}"
-            else:
-                description = ""
-            all_commands.append(f"/{command_data.name}{description}")
-        all_commands.sort()
-        segments = list(
-            all_commands[it : it + MAX_COMMANDS_PER_PAGE]
-            for it in range(0, len(all_commands), MAX_COMMANDS_PER_PAGE)
-        )
-        page_text = f"Commands list: page {page_index + 1}/{len(segments)}\n"
-        page_text += "\n".join(segments[page_index])
-        return page_text
-
     @loader.command(
         help="Shows the help text of a command or lists all commands", name="help"
     )
@@ -117,24 +286,26 @@ def help_custom(client: TGFloofbotClient):
         args: HelpCommandArgs,
     ) -> None:
         if args.command is None:
-            text = generate_commands_help_page(0)
-            context.bot.send_message(
+            text = loader.get_help_pages(MAX_COMMANDS_PER_PAGE)[0]
+            client.send_message(
                 chat_id=update.effective_chat.id,
                 text=text,
                 parse_mode=ParseMode.MARKDOWN_V2,
                 reply_markup=button_reply_markup,
+                priority=outbound.PRIORITY_COSMETIC,
             )
         else:
             command_name = args.command.casefold()
-            command_data = loader.commands.get(command_name)
+            command_data = loader.resolve_command(command_name)
             if command_data:
                 text = loader.get_command_help_text(command_data)
             else:
                 text = f"Command `{em(command_name)}` not found"
-            context.bot.send_message(
+            client.send_message(
                 chat_id=update.effective_chat.id,
                 text=text,
                 parse_mode=ParseMode.MARKDOWN_V2,
+                priority=outbound.PRIORITY_COSMETIC,
             )
 
     @loader.callback_query_handler(key="help_menu_page")
@@ -148,13 +319,9 @@ def help_custom(client: TGFloofbotClient):
         header_text = message.text.splitlines()[0]
         current_page_number = int(header_text.rsplit(" ", 1)[-1].split("/")[0])
         delta = 1 if args.a == "n" else -1
-        page_index = current_page_number + delta - 1
-        max_index = int((len(loader.commands) - 1) / MAX_COMMANDS_PER_PAGE)
-        if page_index > max_index:
-            page_index = 0
-        elif page_index < 0:
-            page_index = max_index
+        pages = loader.get_help_pages(MAX_COMMANDS_PER_PAGE)
+        page_index = (current_page_number + delta - 1) % len(pages)
         update.callback_query.edit_message_text(
-            text=generate_commands_help_page(page_index),
+            text=pages[page_index],
             reply_markup=button_reply_markup,
         )
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from typing import List, Optional, Tuple
+
+
+class StartupProfile:
+    """Records how long each phase of the bot's startup takes"""
+
+    def __init__(self, started: Optional[float] = None, enabled: bool = False):
+        self.enabled = enabled
+        self.started = time.perf_counter() if started is None else started
+        self.phases: List[Tuple[str, float]] = list()
+        self._last = self.started
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def mark(self, name: str) -> None:
+        """Ends the phase that started when the previous one ended"""
+        with self._lock:
+            now = time.perf_counter()
+            self.phases.append((name, now - self._last))
+            self._last = now
+
+    def report(self) -> str:
+        total = self._last - self.started
+        width = max(len(name) for name, _ in self.phases) if self.phases else 0
+        lines = ["Startup profile:"]
+        for name, duration in self.phases:
+            lines.append(
+                f"  {name:<{width}} {duration * 1000:>9.1f} ms "
+                f"{duration / total * 100 if total else 0:>5.1f}%"
+            )
+        lines.append(f"  {'total':<{width}} {total * 1000:>9.1f} ms")
+        return "\n".join(lines)
+
+    def finish(self) -> None:
+        """Prints the report once, if profiling was requested"""
+        with self._lock:
+            if self._finished or not self.enabled:
+                return
+            self._finished = True
+        print(self.report(), flush=True)
@@ -0,0 +1,94 @@
+from typing import Dict, List, Optional, Tuple
+
+import telegram
+import telegram.ext
+
+from telegram import MessageEntity, Update
+
+from . import models
+from . import tracking
+from . import workers
+
+
+class CommandRouter(telegram.ext.Handler):
+    """Single dispatcher handler that routes every registered command
+
+    The leading bot_command entity is parsed once per update and the command is
+    looked up in a dict of case-folded names and aliases, so the cost of routing does
+    not grow with the number of registered commands.
+
+    With a worker pool, pooled commands are handed to it keyed by chat, so they run
+    in order within a chat without blocking the dispatcher thread.
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, models.CommandData],
+        pool: Optional[workers.ChatOrderedExecutor] = None,
+    ):
+        ## handle_update is overridden and calls the routed command itself, so the
+        ## callback Handler requires is never used
+        super().__init__(self._routed_per_update)
+        self.routes = routes
+        self.pool = pool
+        self._bot_username: Optional[str] = None
+
+    @staticmethod
+    def _routed_per_update(
+        update: Update, context: telegram.ext.CallbackContext
+    ) -> None:
+        """Placeholder callback, commands are looked up in check_update"""
+
+    def bot_username(self, bot: telegram.Bot) -> str:
+        if self._bot_username is None:
+            self._bot_username = bot.username.casefold()
+        return self._bot_username
+
+    def check_update(
+        self, update: object
+    ) -> Optional[Tuple[models.CommandData, List[str]]]:
+        if not isinstance(update, Update):
+            return None
+        message = update.message or update.edited_message
+        if not message or not message.text or not message.entities:
+            return None
+        entity = message.entities[0]
+        if entity.offset != 0 or entity.type != MessageEntity.BOT_COMMAND:
+            return None
+
+        command_name, _, bot_username = message.text[1 : entity.length].partition("@")
+        if bot_username and bot_username.casefold() != self.bot_username(message.bot):
+            return None
+        command_data = self.routes.get(command_name.casefold())
+        if command_data is None or command_data.callback is None:
+            return None
+        return command_data, message.text.split()[1:]
+
+    def handle_update(
+        self,
+        update: Update,
+        dispatcher: telegram.ext.Dispatcher,
+        check_result: Tuple[models.CommandData, List[str]],
+        context: telegram.ext.CallbackContext = None,
+    ) -> object:
+        command_data, args = check_result
+        context.args = args
+        if self.pool is None or not command_data.pooled:
+            return command_data.callback(update, context)
+
+        chat, user = update.effective_chat, update.effective_user
+        key = chat.id if chat else user.id if user else None
+        ## The update is only done once the pooled command is
+        release = tracking.hold()
+
+        def run_command() -> object:
+            try:
+                return command_data.callback(update, context)
+            finally:
+                if release is not None:
+                    release()
+
+        self.pool.submit(
+            key, run_command, lambda error: dispatcher.dispatch_error(update, error)
+        )
+        return None
@@ -0,0 +1,79 @@
+import dataclasses
+
+from typing import Optional, Set
+
+import alembic.command
+import alembic.config
+import alembic.runtime.migration
+import alembic.script
+import alembic.util
+import sqlalchemy
+
+from . import constants
+
+from .logger import LOG
+
+
+@dataclasses.dataclass
+class SchemaState:
+    current: Set[str]
+    heads: Set[str]
+    ## True when the database has no tables at all
+    empty: bool
+    ## Revisions in the database that the migration scripts do not know about
+    unknown: Set[str]
+
+    @property
+    def up_to_date(self) -> bool:
+        return self.current == self.heads
+
+    def describe(self) -> str:
+        current = ", ".join(sorted(self.current)) or "unversioned"
+        return f"database at {current}, migrations at {', '.join(sorted(self.heads))}"
+
+
+def migrations_available() -> bool:
+    return (constants.MIGRATIONS_DIRECTORY / "env.py").is_file()
+
+
+def alembic_config(
+    connection: Optional[sqlalchemy.engine.Connection] = None,
+) -> alembic.config.Config:
+    """Alembic config for the bot's migrations, optionally bound to a connection"""
+    config = alembic.config.Config()
+    config.set_main_option("script_location", str(constants.MIGRATIONS_DIRECTORY))
+    if connection is not None:
+        config.attributes["connection"] = connection
+    return config
+
+
+def check(engine: sqlalchemy.engine.Engine) -> SchemaState:
+    """Compares the database's alembic stamp with the migration heads
+
+    This reads the version table, and only lists the tables if it is missing.
+    """
+    script = alembic.script.ScriptDirectory.from_config(alembic_config())
+    heads = set(script.get_heads())
+    with engine.connect() as connection:
+        context = alembic.runtime.migration.MigrationContext.configure(connection)
+        current = set(context.get_current_heads())
+        empty = not current and not engine.dialect.get_table_names(connection)
+    unknown = set()
+    for revision in current:
+        try:
+            script.get_revision(revision)
+        except alembic.util.CommandError:
+            unknown.add(revision)
+    return SchemaState(current=current, heads=heads, empty=empty, unknown=unknown)
+
+
+def upgrade(engine: sqlalchemy.engine.Engine) -> None:
+    LOG.info("Applying pending database migrations")
+    with engine.begin() as connection:
+        alembic.command.upgrade(alembic_config(connection), "head")
+
+
+def stamp(engine: sqlalchemy.engine.Engine) -> None:
+    """Marks the database as being at the latest revision"""
+    with engine.begin() as connection:
+        alembic.command.stamp(alembic_config(connection), "head")
@@ -0,0 +1,199 @@
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import signal
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import telegram
+
+from . import models
+
+from .logger import LOG, setup_logging
+
+
+## Shard processes are spawned, since forking the threads of the ingest process is unsafe
+CONTEXT = multiprocessing.get_context("spawn")
+
+## The ingest process coordinates shutdown, so signals sent to the whole process group,
+## such as Ctrl+C, must not stop a shard before it has handled its queued updates
+SHARD_IGNORED_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+@contextlib.contextmanager
+def _ignored_signals() -> Iterator[None]:
+    """Ignores the shard signals while processes started inside inherit the setting"""
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = {it: signal.signal(it, signal.SIG_IGN) for it in SHARD_IGNORED_SIGNALS}
+    try:
+        yield
+    finally:
+        for signal_number, handler in previous.items():
+            signal.signal(signal_number, handler)
+
+
+def shard_key(update: telegram.Update) -> int:
+    """The ID updates are partitioned by: the chat, else the user, else 0"""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+
+def shard_config(config: models.Config, shard: int, shards: int) -> models.Config:
+    """The config of one shard process
+
+    Each shard writes its own log file, leaves the metrics endpoint to the ingest
+    process and gets an equal share of the global outbound rate limit. Chats belong to
+    exactly one shard, so the per chat limits stay as they are.
+    """
+    config = config.copy(deep=True)
+    filename = config.log.filename
+    config.log.filename = filename.with_name(
+        f"{filename.stem}.shard{shard}{filename.suffix}"
+    )
+    config.metrics.port = None
+    ## The ingest process persists the update offset for every shard
+    config.update_tracking.enabled = False
+    config.outbound.global_rate /= shards
+    config.outbound.global_burst = max(1.0, config.outbound.global_burst / shards)
+    return config
+
+
+def shard_main(config: models.Config, shard: int, updates: Any, done: Any) -> None:
+    """Entry point of a shard process"""
+    from . import client
+    from . import exceptions
+
+    for signal_number in SHARD_IGNORED_SIGNALS:
+        signal.signal(signal_number, signal.SIG_IGN)
+    setup_logging(config)
+    try:
+        bot_client = client.TGFloofbotClient(config)
+    except exceptions.FloofbotLoaderException as err:
+        LOG.error(f"Shard {shard} cannot start: {err}")
+        raise SystemExit(1)
+    LOG.info(f"Shard {shard} is ready")
+    bot_client.run_shard(updates, done)
+
+
+class ShardPool:
+    """Worker processes that each handle the updates of a fixed share of the chats
+
+    Updates are partitioned by ``shard_key() % shards``, so all updates of a chat go to
+    the same process, through a single queue, and keep their order. Each shard runs
+    the full plugin stack with its own database connections. ``on_exit`` is called
+    with the shard number if a shard exits before the pool is stopped, and
+    ``on_done`` with the ID of every update a shard has finished handling.
+    """
+
+    def __init__(
+        self,
+        config: models.Config,
+        shards: int,
+        on_exit: Optional[Callable[[int], Any]] = None,
+        on_done: Optional[Callable[[int], Any]] = None,
+    ):
+        self.config = config
+        self.shards = shards
+        self.on_exit = on_exit
+        self.on_done = on_done
+        self.queues = [CONTEXT.Queue() for _ in range(shards)]
+        ## Shared by every shard to report finished update IDs
+        self.done = CONTEXT.Queue()
+        self.processes: List[multiprocessing.process.BaseProcess] = list()
+        self.routed = [0] * shards
+        self._running = False
+        self._supervisor: Optional[threading.Thread] = None
+        self._collector: Optional[threading.Thread] = None
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            "shards": self.shards,
+            "alive": sum(process.is_alive() for process in self.processes),
+        }
+        for shard, routed in enumerate(self.routed):
+            stats[f"routed_{shard}"] = routed
+        return stats
+
+    def start(self) -> None:
+        self._running = True
+        with _ignored_signals():
+            for shard, updates in enumerate(self.queues):
+                process = CONTEXT.Process(
+                    target=shard_main,
+                    args=(
+                        shard_config(self.config, shard, self.shards),
+                        shard,
+                        updates,
+                        self.done,
+                    ),
+                    name=f"tgfb-shard-{shard}",
+                )
+                process.start()
+                self.processes.append(process)
+        self._supervisor = threading.Thread(
+            target=self._supervise, name="tgfb-shard-supervisor", daemon=True
+        )
+        self._supervisor.start()
+        self._collector = threading.Thread(
+            target=self._collect_done, name="tgfb-shard-done", daemon=True
+        )
+        self._collector.start()
+        LOG.info(f"Started {self.shards} shard processes")
+
+    def route(self, update: telegram.Update) -> None:
+        shard = shard_key(update) % self.shards
+        self.routed[shard] += 1
+        self.queues[shard].put(update.to_dict())
+
+    def _collect_done(self) -> None:
+        while True:
+            update_id = self.done.get()
+            if update_id is None:
+                return
+            if self.on_done:
+                self.on_done(update_id)
+
+    def _supervise(self) -> None:
+        sentinels = {
+            process.sentinel: shard for shard, process in enumerate(self.processes)
+        }
+        while self._running:
+            ready = multiprocessing.connection.wait(list(sentinels), 1.0)
+            if not ready or not self._running:
+                continue
+            shard = sentinels[ready[0]]
+            process = self.processes[shard]
+            process.join()
+            LOG.error(f"Shard {shard} exited unexpectedly with code {process.exitcode}")
+            ## The other shards are stopped along with the bot, so one report is enough
+            if self.on_exit:
+                self.on_exit(shard)
+            return
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Lets every shard handle its queued updates, then waits for it to exit"""
+        if not self._running:
+            return
+        self._running = False
+        deadline = time.monotonic() + timeout
+        for updates in self.queues:
+            updates.put(None)
+        for shard, process in enumerate(self.processes):
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                LOG.warning(f"Shard {shard} did not stop in time, terminating it")
+                process.terminate()
+                process.join()
+        self.done.put(None)
+        if self._collector is not None:
+            self._collector.join()
+        for updates in self.queues + [self.done]:
+            updates.close()
+        LOG.debug("Shard processes stopped")
@@ -0,0 +1,404 @@
+import collections
+import functools
+import threading
+import time
+
+from typing import Any, Callable, ContextManager, Deque, Dict, Optional, Set
+
+import sqlalchemy.orm
+
+from . import metrics
+from . import models
+
+from .logger import LOG
+
+
+## Max updates in a getUpdates response, which starts with the received updates that
+## are not acknowledged yet. The poller waits once they would fill half of it.
+MAX_UNACKNOWLEDGED = 100
+
+## Seconds the oldest update may stay in flight before it is acknowledged anyway, so a
+## stuck handler cannot stop new updates from arriving
+STALL_TIMEOUT = 30.0
+
+## Finished update IDs remembered to drop redelivered duplicates
+RECENT_UPDATES = 10_000
+
+## Handling times of the most recent updates kept for quantiles
+RECENT_DURATIONS = 1024
+
+## Telegram picks a random update ID once a bot got no updates for a week. Updates are
+## only delivered again while unacknowledged, which keeps them close to the last
+## received ID, so one further below it means the IDs were restarted.
+RESET_DISTANCE = RECENT_UPDATES
+
+_context = threading.local()
+
+
+def hold() -> Optional[Callable[[], None]]:
+    """Keeps the update handled on this thread in flight until the returned callable
+    is called
+
+    Used for work that outlives the dispatcher's handling of the update, such as
+    commands run on the worker pool. Returns None if no update is tracked.
+    """
+    scope = getattr(_context, "scope", None)
+    if scope is None or scope.update_id is None:
+        return None
+    return scope.tracker.hold(scope.update_id)
+
+
+class UpdateTracker:
+    """Tracks which updates are in flight and which are done, and persists it
+
+    The persisted state is the last processed update ID, below which every update is
+    done, the last received update ID, and the IDs still in flight between the two.
+    It is written in one small transaction every ``flush_interval`` seconds. When
+    polling, Telegram only forgets the updates up to the last persisted processed ID,
+    so the updates that were in flight when the bot died are delivered again after a
+    restart, while those that were already done are skipped.
+
+    An update is in flight from ``receive()`` until every ``release()`` matching its
+    ``receive()`` and ``hold()`` calls. Without a ``session_factory`` nothing is
+    persisted and ``on_done`` is called with the ID of every finished update instead,
+    which is how shard processes report back to the ingest process.
+
+    ``before_flush`` is called before an update is persisted as done, so writes the
+    update queued, such as on the write-behind queue, can be committed first.
+    """
+
+    def __init__(
+        self,
+        session_factory: Optional[Callable[[], ContextManager[sqlalchemy.orm.Session]]],
+        flush_interval: float = 0.5,
+        on_done: Optional[Callable[[int], Any]] = None,
+        before_flush: Optional[Callable[[], Any]] = None,
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.on_done = on_done
+        self.before_flush = before_flush
+        self.last_received = 0
+        ## In flight update IDs and the number of holds on each
+        self._in_flight: Dict[int, int] = dict()
+        ## When each in flight update was received, in time.monotonic()
+        self._received_at: Dict[int, float] = dict()
+        ## Seconds from receiving each recent update until it was done
+        self.durations = metrics.LatencyWindow(RECENT_DURATIONS)
+        ## Received by the poller but not yet picked up by the dispatcher
+        self._unclaimed: Set[int] = set()
+        self._recent: Deque[int] = collections.deque(maxlen=RECENT_UPDATES)
+        self._recent_set: Set[int] = set()
+        ## State of the previous run: updates up to its last received ID are done,
+        ## except for the ones that were still in flight and are expected again
+        self._previous_received = 0
+        self._replays: Set[int] = set()
+        self._persisted = (0, 0, frozenset())
+        self._progressed_at = time.monotonic()
+        self._stalled_at = 0
+        ## Acknowledged despite still being in flight, see STALL_TIMEOUT
+        self._skipped = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.counters = {
+            "received": 0,
+            "duplicates": 0,
+            "replayed": 0,
+            "flushes": 0,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": len(self._in_flight),
+                "last_received": self.last_received,
+                "last_processed": self._watermark(),
+                "persisted": self._persisted[0],
+                **self.counters,
+            }
+
+    def load(self) -> None:
+        """Reads the state persisted by the previous run"""
+        if self.session_factory is None:
+            return
+        with self.session_factory() as db:
+            row = db.query(models.UpdateOffset).get(1)
+            in_flight = {
+                update_id for (update_id,) in db.query(models.UpdateInFlight.update_id)
+            }
+        if row is None:
+            return
+        with self._lock:
+            self.last_received = self._previous_received = row.last_received
+            self._replays = in_flight
+            self._persisted = (row.last_processed, row.last_received, frozenset())
+        if in_flight:
+            LOG.info(
+                f"{len(in_flight)} updates were in flight when the bot stopped and "
+                "will be handled again"
+            )
+        LOG.debug(f"Resuming after update {row.last_processed}")
+
+    def offset(self) -> Optional[int]:
+        """The getUpdates offset that acknowledges every persisted processed update"""
+        with self._lock:
+            if not self.last_received:
+                return None
+            return self._offset()
+
+    def _offset(self) -> int:
+        return max(self._persisted[0], self._skipped) + 1
+
+    def backlogged(self) -> bool:
+        """Whether the poller should wait for updates to finish before fetching more
+
+        Every getUpdates response starts with the received updates that are not
+        acknowledged yet, so fetching is only worth it while they fill less than half
+        of a response.
+        """
+        with self._lock:
+            if not self._backlogged():
+                return False
+            watermark = self._watermark()
+            if watermark != self._stalled_at:
+                self._stalled_at = watermark
+                self._progressed_at = time.monotonic()
+            if time.monotonic() - self._progressed_at < STALL_TIMEOUT:
+                return True
+            LOG.warning(
+                f"Update {watermark + 1} is taking too long, acknowledging newer "
+                "updates regardless"
+            )
+            self._skipped = self.last_received - MAX_UNACKNOWLEDGED // 4
+            return False
+
+    def _backlogged(self) -> bool:
+        ## Without updates in flight, the backlog is made of updates a previous run
+        ## handled, and only fetching them again can clear it
+        if not self._in_flight:
+            return False
+        acknowledgeable = max(self._watermark(), self._skipped)
+        return self.last_received - acknowledgeable >= MAX_UNACKNOWLEDGED // 2
+
+    def receive(self, update_id: int) -> bool:
+        """Marks an update as in flight, returns False if it is a duplicate"""
+        with self._lock:
+            if not self._receive(update_id):
+                return False
+            self._unclaimed.add(update_id)
+            return True
+
+    def claim(self, update_id: int) -> bool:
+        """Called by the dispatcher, receives the update unless the poller already did"""
+        with self._lock:
+            if update_id in self._unclaimed:
+                self._unclaimed.discard(update_id)
+                return True
+            return self._receive(update_id)
+
+    def _receive(self, update_id: int) -> bool:
+        if (
+            update_id < self.last_received - RESET_DISTANCE
+            and update_id not in self._replays
+        ):
+            self._reset(update_id)
+        if self._replays:
+            ## Telegram redelivers in order, so earlier ones are not coming back
+            lost = {it for it in self._replays if it < update_id}
+            if lost:
+                self._replays -= lost
+                LOG.warning(
+                    f"{len(lost)} interrupted updates were not delivered again: "
+                    f"{', '.join(str(it) for it in sorted(lost))}"
+                )
+        if update_id in self._replays:
+            self._replays.discard(update_id)
+            self.counters["replayed"] += 1
+            LOG.debug("Handling update %s again, it was interrupted", update_id)
+        elif (
+            update_id in self._in_flight
+            or update_id in self._recent_set
+            or update_id <= self._previous_received
+        ):
+            self.counters["duplicates"] += 1
+            LOG.debug("Skipping update %s, it was already handled", update_id)
+            return False
+        self._in_flight[update_id] = 1
+        self._received_at[update_id] = time.monotonic()
+        self.last_received = max(self.last_received, update_id)
+        self.counters["received"] += 1
+        return True
+
+    def _reset(self, update_id: int) -> None:
+        """Forgets the IDs of the previous sequence, after Telegram restarted them
+
+        Otherwise every new update would be skipped as already handled, and the
+        persisted offset would acknowledge them before they arrive.
+        """
+        LOG.warning(
+            f"Update {update_id} is far below the last received update "
+            f"{self.last_received}, Telegram restarted the update IDs"
+        )
+        if self._replays or self._in_flight:
+            LOG.warning(
+                f"Forgetting {len(self._replays) + len(self._in_flight)} updates "
+                "of the previous sequence that were not done"
+            )
+        self.last_received = self._previous_received = 0
+        self._replays = set()
+        self._in_flight.clear()
+        self._received_at.clear()
+        self._unclaimed.clear()
+        self._recent.clear()
+        self._recent_set.clear()
+        self._persisted = (0, 0, frozenset())
+        self._skipped = self._stalled_at = 0
+        self._changed.notify_all()
+
+    def hold(self, update_id: int) -> Optional[Callable[[], None]]:
+        """Keeps an in flight update in flight until the returned callable is called"""
+        with self._lock:
+            if update_id not in self._in_flight:
+                return None
+            self._in_flight[update_id] += 1
+        return functools.partial(self.release, update_id)
+
+    def release(self, update_id: int) -> None:
+        with self._lock:
+            holds = self._in_flight.get(update_id)
+            if holds is None:
+                return
+            if holds > 1:
+                self._in_flight[update_id] = holds - 1
+                return
+            del self._in_flight[update_id]
+            received_at = self._received_at.pop(update_id)
+            if len(self._recent) == self._recent.maxlen:
+                self._recent_set.discard(self._recent[0])
+            self._recent.append(update_id)
+            self._recent_set.add(update_id)
+            self._changed.notify_all()
+        self.durations.observe(time.monotonic() - received_at)
+        if self.on_done is not None:
+            self.on_done(update_id)
+
+    def age(self, update_id: int) -> Optional[float]:
+        """Seconds since an in flight update was received"""
+        with self._lock:
+            received_at = self._received_at.get(update_id)
+        if received_at is None:
+            return None
+        return time.monotonic() - received_at
+
+    def handling(self, update_id: Optional[int]) -> "handling_scope":
+        return handling_scope(self, update_id)
+
+    def _watermark(self) -> int:
+        pending = list(self._in_flight) + list(self._replays)
+        if pending:
+            return min(pending) - 1
+        return self.last_received
+
+    def pending(self) -> bool:
+        """Whether the processed watermark moved past the persisted one"""
+        with self._lock:
+            return self._watermark() > self._persisted[0]
+
+    def wait_for_room(self, timeout: float) -> None:
+        """Waits up to ``timeout`` seconds for the poller to stop being backlogged"""
+        with self._changed:
+            self._changed.wait_for(lambda: not self._backlogged(), timeout)
+
+    def wait_for_progress(self, timeout: float) -> None:
+        """Waits up to ``timeout`` seconds for the processed watermark to move"""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: not self._in_flight or self._watermark() > self._persisted[0],
+                timeout,
+            )
+
+    def start(self) -> None:
+        if self.session_factory is None or self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="tgfb-update-tracker", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Writes the final state and stops the writer thread"""
+        if self._thread is None:
+            return
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self) -> None:
+        """Persists the processed watermark and the in-flight IDs if they changed"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        with self._lock:
+            state = (
+                self._watermark(),
+                self.last_received,
+                frozenset(self._in_flight) | self._replays,
+            )
+            if state == self._persisted:
+                return
+        last_processed, last_received, in_flight = state
+        try:
+            if self.before_flush is not None:
+                self.before_flush()
+            with self.session_factory() as db:  # type: ignore
+                db.merge(
+                    models.UpdateOffset(
+                        id=1,
+                        last_processed=last_processed,
+                        last_received=last_received,
+                    )
+                )
+                db.execute(models.UpdateInFlight.__table__.delete())
+                if in_flight:
+                    db.execute(
+                        models.UpdateInFlight.__table__.insert(),
+                        [{"update_id": update_id} for update_id in in_flight],
+                    )
+        except Exception:
+            LOG.exception("Failed to persist the update offset")
+            return
+        with self._lock:
+            self._persisted = state
+            self.counters["flushes"] += 1
+
+
+class handling_scope:
+    """Marks the update handled on this thread, and releases it when handling ends"""
+
+    __slots__ = ("tracker", "update_id", "previous")
+
+    def __init__(self, tracker: UpdateTracker, update_id: Optional[int]):
+        self.tracker = tracker
+        self.update_id = update_id
+
+    def __enter__(self) -> None:
+        self.previous = getattr(_context, "scope", None)
+        _context.scope = self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        _context.scope = self.previous
+        if self.update_id is not None:
+            self.tracker.release(self.update_id)
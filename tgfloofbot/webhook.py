@@ -0,0 +1,124 @@
+import hmac
+import http.server
+import json
+import logging
+import queue
+import threading
+
+from typing import Optional
+
+import telegram
+
+from . import models
+
+from .logger import LOG
+
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts update POSTs from Telegram and puts them into the dispatcher's queue"""
+
+    server: "WebhookServer"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self) -> None:
+        server = self.server
+        if self.path != server.config.path:
+            self._respond(404)
+            return
+        if server.config.secret_token and not hmac.compare_digest(
+            self.headers.get(SECRET_TOKEN_HEADER, ""), server.config.secret_token
+        ):
+            LOG.warning(
+                f"Rejected webhook request with a bad secret from {self.client_address[0]}"
+            )
+            self._respond(403)
+            return
+
+        ## Telegram retries rejected deliveries, so shed load instead of queueing forever
+        if not server.connections.acquire(blocking=False):
+            self._respond(503)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length <= 0 or length > server.config.max_body_size:
+                self._respond(413 if length > 0 else 400)
+                return
+            try:
+                data = json.loads(self.rfile.read(length))
+                update = telegram.Update.de_json(data, server.bot)
+            except ValueError:
+                self._respond(400)
+                return
+            try:
+                server.update_queue.put(update, timeout=server.config.queue_timeout)
+            except queue.Full:
+                LOG.warning("Webhook intake queue is full, asking Telegram to retry")
+                self._respond(503)
+                return
+            self._respond(200)
+        finally:
+            server.connections.release()
+
+    def _respond(self, status: int) -> None:
+        ## Rejected requests may have an unread body, so the connection cannot be reused
+        if status != 200:
+            self.close_connection = True
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("Webhook request: %s", format % args)
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    """Local HTTP listener that receives updates pushed by Telegram"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        config: models.WebhookConfig,
+        bot: telegram.Bot,
+        update_queue: queue.Queue,
+    ):
+        super().__init__((config.listen, config.port), WebhookRequestHandler)
+        self.config = config
+        self.bot = bot
+        self.update_queue = update_queue
+        self.connections = threading.BoundedSemaphore(config.max_connections)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="tgfb-webhook", daemon=True
+        )
+        self._thread.start()
+        LOG.info(
+            f"Listening for webhook updates on "
+            f"{self.config.listen}:{self.server_address[1]}{self.config.path}"
+        )
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        self._thread = None
+
+    def register(self) -> None:
+        """Points the bot's webhook at this listener"""
+        api_kwargs = dict()
+        if self.config.secret_token:
+            api_kwargs["secret_token"] = self.config.secret_token
+        self.bot.set_webhook(
+            url=self.config.url,
+            max_connections=self.config.max_connections,
+            api_kwargs=api_kwargs,
+        )
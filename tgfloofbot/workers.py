@@ -0,0 +1,142 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+from .logger import LOG
+
+
+Task = Tuple[Callable[[], Any], Optional[Callable[[BaseException], Any]], float]
+
+
+class ChatOrderedExecutor:
+    """Worker pool that runs tasks concurrently across chats but in order within one
+
+    Tasks are queued per key, normally a chat ID. A key is served by at most one worker
+    at a time, which drains its queue in submission order, so a slow task only delays
+    later tasks for the same chat. After ``batch_size`` tasks a worker hands the key
+    back to the pool so busy chats cannot starve the others.
+    """
+
+    def __init__(self, workers: int = 8, batch_size: int = 16):
+        self.workers = workers
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._backlogs: Dict[Hashable, Deque[Task]] = dict()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="tgfb-worker"
+        )
+        self._running = True
+        self.busy = 0
+        self.backlog = 0
+        self.max_backlog = 0
+        self.max_wait = 0.0
+        self.counters = {
+            "completed": 0,
+            "failed": 0,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of the pool's saturation and backlog gauges"""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "saturation": self.busy / self.workers,
+                "backlog": self.backlog,
+                "max_backlog": self.max_backlog,
+                "active_chats": len(self._backlogs),
+                "max_wait": self.max_wait,
+                **self.counters,
+            }
+
+    def submit(
+        self,
+        key: Hashable,
+        task: Callable[[], Any],
+        on_error: Optional[Callable[[BaseException], Any]] = None,
+    ) -> None:
+        """Queues ``task`` behind earlier tasks with the same key
+
+        Exceptions raised by the task are passed to ``on_error``, or logged if there is
+        no error callback.
+        """
+        with self._lock:
+            if not self._running:
+                raise RuntimeError("The worker pool has been stopped")
+            self.backlog += 1
+            self.max_backlog = max(self.max_backlog, self.backlog)
+            pending = self._backlogs.get(key)
+            if pending is not None:
+                pending.append((task, on_error, time.monotonic()))
+                return
+            self._backlogs[key] = collections.deque(
+                [(task, on_error, time.monotonic())]
+            )
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: Hashable) -> None:
+        with self._lock:
+            self.busy += 1
+        try:
+            for _ in range(self.batch_size):
+                with self._lock:
+                    pending = self._backlogs[key]
+                    if not pending:
+                        del self._backlogs[key]
+                        return
+                    task, on_error, submitted = pending[0]
+                    self.max_wait = max(self.max_wait, time.monotonic() - submitted)
+                self._run(task, on_error)
+                with self._lock:
+                    ## The task stays queued while it runs, so new tasks for the key
+                    ## line up behind it instead of starting a second drain
+                    pending.popleft()
+                    self.backlog -= 1
+                    if not self.backlog:
+                        self._idle.notify_all()
+            with self._lock:
+                if not self._backlogs[key]:
+                    del self._backlogs[key]
+                    return
+            self._executor.submit(self._drain, key)
+        finally:
+            with self._lock:
+                self.busy -= 1
+
+    def _run(
+        self,
+        task: Callable[[], Any],
+        on_error: Optional[Callable[[BaseException], Any]],
+    ) -> None:
+        try:
+            task()
+        except Exception as err:
+            with self._lock:
+                self.counters["failed"] += 1
+            if on_error is None:
+                LOG.exception("Unhandled exception in a pooled task:")
+                return
+            try:
+                on_error(err)
+            except Exception:
+                LOG.exception("Error callback of a pooled task failed:")
+        else:
+            with self._lock:
+                self.counters["completed"] += 1
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Waits at most ``timeout`` seconds for queued tasks, then stops the workers"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._running = False
+            while self.backlog and time.monotonic() < deadline:
+                self._idle.wait(max(0, deadline - time.monotonic()))
+            if self.backlog:
+                LOG.warning(
+                    f"Stopping the worker pool with {self.backlog} queued tasks"
+                )
+        self._executor.shutdown(wait=False)
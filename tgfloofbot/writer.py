@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+
+from typing import Any, Callable, ContextManager, List, Optional
+
+import sqlalchemy.orm
+
+from .logger import LOG
+
+
+class _FlushRequest:
+    """Queue marker that is acknowledged once every item queued before it is written"""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Inserts ORM objects in batched transactions on a single background thread
+
+    Objects are written once ``batch_size`` objects are pending or the oldest
+    pending object has waited ``flush_interval`` seconds, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], ContextManager[sqlalchemy.orm.Session]],
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="tgfb-write-behind", daemon=True
+        )
+        self._thread.start()
+
+    def add(self, *objects: Any) -> None:
+        """Queues ORM objects to be inserted by the writer thread"""
+        for obj in objects:
+            self._queue.put(obj)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until every object queued so far has been written"""
+        if self._thread is None:
+            return self._queue.empty()
+        request = _FlushRequest()
+        self._queue.put(request)
+        return request.done.wait(timeout)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Writes all pending objects and stops the writer thread"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        batch: List[Any] = list()
+        acknowledgements: List[_FlushRequest] = list()
+        deadline = None
+        stopping = False
+
+        while not stopping:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                stopping = True
+            elif isinstance(item, _FlushRequest):
+                acknowledgements.append(item)
+            elif item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            timed_out = deadline is not None and time.monotonic() >= deadline
+            if (
+                stopping
+                or acknowledgements
+                or timed_out
+                or len(batch) >= self.batch_size
+            ):
+                self._write(batch)
+                batch = list()
+                deadline = None
+                for request in acknowledgements:
+                    request.done.set()
+                acknowledgements = list()
+
+    def _write(self, batch: List[Any]) -> None:
+        if not batch:
+            return
+        try:
+            with self.session_factory() as db:
+                db.add_all(batch)
+            LOG.debug("Write-behind queue wrote %s objects", len(batch))
+            return
+        except Exception:
+            LOG.exception(
+                f"Write-behind batch of {len(batch)} objects failed, retrying one by one"
+            )
+
+        ## Isolate the failing objects so that one bad row does not drop the whole batch
+        for obj in batch:
+            try:
+                with self.session_factory() as db:
+                    db.add(obj)
+            except Exception:
+                LOG.exception(f"Write-behind queue dropped object: {obj}")